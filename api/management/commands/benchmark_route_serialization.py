@@ -0,0 +1,64 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from api.models.path import Path
+from api.renderers import FastJSONRenderer
+from api.serializers.route_serializer import RouteSerializer
+from api.serializers.path_serializer import path_data_to_representation
+
+# Origin and waypoints of the benchmarked route, in San Borja
+ROUTE_LATLONS = [(-12.095, -76.99), (-12.08, -76.975), (-12.07, -76.985), (-12.09, -77.0), (-12.1, -76.98)]
+
+class Command(BaseCommand):
+    help = (
+        'Computes a route and compares how long it takes to build and render its response going through '
+        'the <Path> models and their serializers against the fast path used by the route views'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help='Times each way of serializing the route is timed')
+
+    def handle(self, *args, **options):
+        # torch and stable_baselines3 take a while to import, so the agent is only imported when running the benchmark
+        from bike_router_ai.agent import Agent
+        from bike_router_ai.routing_pool import compute_route
+
+        route_data = compute_route(Agent(), ROUTE_LATLONS[0], ROUTE_LATLONS[1:])
+        request_data = {
+            'origin': {'coordinates': {'latitude': ROUTE_LATLONS[0][0], 'longitude': ROUTE_LATLONS[0][1]}},
+            'waypoints': [{'coordinates': {'latitude': lat, 'longitude': lon}} for lat, lon in ROUTE_LATLONS[1:]],
+        }
+
+        for context in ({'encoding': 'full'}, {'encoding': 'compact'}):
+            serializer = RouteSerializer(data=request_data, context=context)
+            serializer.is_valid(raise_exception=True)
+            route = serializer.save()
+
+            def serializers_way():
+                route.option1 = [Path.from_path_data(path_data) for path_data in route_data['option1']]
+                route.option2 = [Path.from_path_data(path_data) for path_data in route_data['option2']]
+                return JSONRenderer().render(RouteSerializer(route, context=context).data)
+
+            def fast_way():
+                route.option1, route.option2 = [], []
+                data = RouteSerializer(route, context=context).data
+                data['option1'] = [path_data_to_representation(path_data, context) for path_data in route_data['option1']]
+                data['option2'] = [path_data_to_representation(path_data, context) for path_data in route_data['option2']]
+                return FastJSONRenderer().render(data)
+
+            # Both ways must return the same JSON, besides the arrival times of the paths
+            responses = [json.loads(way()) for way in (serializers_way, fast_way)]
+            for response in responses:
+                for option in ('option1', 'option2', 'option3'):
+                    for path in response[option]: path.pop('arrival_time')
+            assert responses[0] == responses[1], 'The fast path returned a different response'
+
+            seconds = {}
+            for name, way in (('serializers', serializers_way), ('fast path', fast_way)):
+                start = time.perf_counter()
+                for _ in range(options['repeat']): body = way()
+                seconds[name] = (time.perf_counter() - start) / options['repeat']
+                self.stdout.write(f"{context['encoding']:>8} {name:>12}: {seconds[name]*1000:8.2f} ms  {len(body)} bytes")
+            self.stdout.write(f"{context['encoding']:>8} speedup: {seconds['serializers'] / seconds['fast path']:.1f}x")
@@ -1,4 +1,6 @@
 class Coordinates:
+    __slots__ = ('latitude', 'longitude')
+
     def __init__(self, latitude, longitude):
         self.latitude = latitude
         self.longitude = longitude
\ No newline at end of file
@@ -1,4 +1,6 @@
 class Direction:
+    __slots__ = ('ending_action', 'street_name', 'covered_edges_indexes', 'covered_polyline_points_indexes')
+
     def __init__(self, ending_action, street_name, covered_edges_indexes, covered_polyline_points_indexes):
         self.ending_action = ending_action
         self.street_name = street_name
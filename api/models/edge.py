@@ -1,4 +1,6 @@
 class Edge:
+    __slots__ = ('source', 'target', 'attributes')
+
     def __init__(self, source, target, attributes):
         self.source = source
         self.target = target
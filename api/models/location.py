@@ -1,6 +1,8 @@
 from api.models.coordinates import Coordinates
 
 class Location:
+    __slots__ = ('coordinates', 'name', 'address')
+
     def __init__(self, coordinates):
         self.coordinates = coordinates
 
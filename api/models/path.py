@@ -6,6 +6,8 @@ from api.models.edge import Edge
 from datetime import datetime
 
 class Path:
+    __slots__ = ('nodes', 'edges', 'directions', 'polyline_points', 'distance_meters', 'eta_seconds', 'arrival_time')
+
     def __init__(
             self,
             nodes: Iterable[Coordinates],
@@ -21,4 +23,24 @@ class Path:
         self.polyline_points = polyline_points
         self.distance_meters = distance_meters
         self.eta_seconds = eta_seconds
-        self.arrival_time = datetime.now()
\ No newline at end of file
+        self.arrival_time = datetime.now()
+
+    @classmethod
+    def from_path_data(cls, path_data):
+        """
+        Returns the <Path> of the data of a path computed by a routing worker, see `graph_utils.get_path_data`
+        """
+        return cls(
+            nodes=[Coordinates(**node) for node in path_data['nodes']],
+            edges=[
+                Edge(
+                    source=Coordinates(**edge['source']),
+                    target=Coordinates(**edge['target']),
+                    attributes=edge['attributes'],
+                ) for edge in path_data['edges']
+            ],
+            directions=[Direction(**direction) for direction in path_data['directions']],
+            polyline_points=[Coordinates(**point) for point in path_data['polyline_points']],
+            distance_meters=path_data['distance_meters'],
+            eta_seconds=path_data['eta_seconds'],
+        )
\ No newline at end of file
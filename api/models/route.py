@@ -3,6 +3,8 @@ from typing import Iterable
 from api.models.location import Location
 
 class Route:
+    __slots__ = ('origin', 'waypoints', 'departure_time', 'option1', 'option2', 'option3', 'paths_geojson')
+
     def __init__(self, origin:Location, waypoints:Iterable[Location]):
         # Required values
         self.origin = origin
@@ -0,0 +1,20 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError: # optional, the standard json module is used without it
+    orjson = None
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Same JSON as <JSONRenderer>, rendered with orjson when it's installed, which is several times faster
+    on big payloads like the routes. Indented (browsable) output still goes through <JSONRenderer>
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_SERIALIZE_NUMPY)
+        # Same as <JSONRenderer>, these characters are valid JSON but not valid JavaScript
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
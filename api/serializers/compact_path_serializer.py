@@ -0,0 +1,47 @@
+from googlemaps.convert import encode_polyline
+from rest_framework import serializers
+
+def to_index_range(indexes):
+    """
+    A list of consecutive indexes as its `[start, end)` range, eg. `[3, 4, 5]` -> `[3, 6]`
+    """
+    if not indexes: return [0, 0]
+    return [indexes[0], indexes[-1] + 1]
+
+
+class EncodedPolylineField(serializers.Field):
+    """
+    A list of <Coordinates> as a Google encoded polyline string
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, points):
+        return encode_polyline([(point.latitude, point.longitude) for point in points])
+
+
+class IndexRangeField(serializers.Field):
+    """
+    A list of consecutive indexes as its `[start, end)` range, see `to_index_range`
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, indexes):
+        return to_index_range(indexes)
+
+
+class CompactEdgeSerializer(serializers.Serializer):
+    # The i-th edge always goes from the i-th to the (i+1)-th node of the path, so its coordinates aren't repeated
+    attributes = serializers.DictField()
+
+
+class CompactDirectionSerializer(serializers.Serializer):
+    ending_action = serializers.CharField(max_length=30)
+    street_name = serializers.CharField(max_length=100)
+    covered_edges_range = IndexRangeField(source='covered_edges_indexes')
+    covered_polyline_points_range = IndexRangeField(source='covered_polyline_points_indexes')
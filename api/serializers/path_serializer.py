@@ -1,3 +1,5 @@
+from datetime import datetime
+from googlemaps.convert import encode_polyline
 from rest_framework import serializers
 from api.models.edge import Edge
 from api.models.path import Path
@@ -5,6 +7,7 @@ from api.models.coordinates import Coordinates
 from api.serializers.coordinates_serializer import CoordinatesSerializer
 from api.serializers.direction_serializer import DirectionSerializer
 from api.serializers.edge_serializer import EdgeSerializer
+from api.serializers.compact_path_serializer import EncodedPolylineField, CompactEdgeSerializer, CompactDirectionSerializer, to_index_range
 
 class PathSerializer(serializers.Serializer):
     nodes = CoordinatesSerializer(many=True)
@@ -16,6 +19,25 @@ class PathSerializer(serializers.Serializer):
     eta_seconds = serializers.FloatField()
     arrival_time = serializers.DateTimeField(required=False)
 
+    def get_fields(self):
+        """
+        Reads from the context of the root serializer (see `RouteViewSet.get_serializer_context`):
+        - `path_fields`: Optional list with the only fields to return, eg. without `edges`
+        - `encoding`: 'compact' returns the nodes and polyline points as Google encoded polylines,
+                the edges without their coordinates (the i-th edge goes from the i-th to the (i+1)-th node)
+                and the covered indexes of each direction as `[start, end)` ranges
+        """
+        fields = super().get_fields()
+        if self.context.get('encoding') == 'compact':
+            fields['nodes'] = EncodedPolylineField()
+            fields['edges'] = CompactEdgeSerializer(many=True)
+            fields['directions'] = CompactDirectionSerializer(many=True)
+            fields['polyline_points'] = EncodedPolylineField()
+        path_fields = self.context.get('path_fields')
+        if path_fields is not None:
+            fields = {name: field for name, field in fields.items() if name in path_fields}
+        return fields
+
     def create(self, data):
         return Path(
             nodes=[
@@ -31,4 +53,78 @@ class PathSerializer(serializers.Serializer):
                 CoordinatesSerializer().create(point_data) for point_data in data.pop('polyline_points')
             ],
             **data
-        )
\ No newline at end of file
+        )
+
+
+_datetime_field = serializers.DateTimeField()
+
+def _coordinates_representation(point):
+    return {'latitude': float(point['latitude']), 'longitude': float(point['longitude'])}
+
+
+def path_data_to_representation(path_data, context=None):
+    """
+    Same as `PathSerializer(path, context=context).data` for the <Path> built from `path_data`,
+    the data of a path computed by a routing worker (see `graph_utils.get_path_data`).
+    Builds the dicts straight from `path_data`, without creating any model or going through
+    a nested serializer for every coordinate, edge and direction
+    """
+    context = context or {}
+    compact = context.get('encoding') == 'compact'
+    path_fields = context.get('path_fields')
+    representation = {}
+
+    if path_fields is None or 'nodes' in path_fields:
+        if compact:
+            representation['nodes'] = encode_polyline([(node['latitude'], node['longitude']) for node in path_data['nodes']])
+        else:
+            representation['nodes'] = [_coordinates_representation(node) for node in path_data['nodes']]
+
+    if path_fields is None or 'edges' in path_fields:
+        if compact:
+            representation['edges'] = [
+                {'attributes': {str(key): value for key, value in edge['attributes'].items()}}
+                for edge in path_data['edges']
+            ]
+        else:
+            representation['edges'] = [
+                {
+                    'source': _coordinates_representation(edge['source']),
+                    'target': _coordinates_representation(edge['target']),
+                    'attributes': {str(key): value for key, value in edge['attributes'].items()},
+                } for edge in path_data['edges']
+            ]
+
+    if path_fields is None or 'directions' in path_fields:
+        if compact:
+            representation['directions'] = [
+                {
+                    'ending_action': str(direction['ending_action']),
+                    'street_name': str(direction['street_name']),
+                    'covered_edges_range': to_index_range(direction['covered_edges_indexes']),
+                    'covered_polyline_points_range': to_index_range(direction['covered_polyline_points_indexes']),
+                } for direction in path_data['directions']
+            ]
+        else:
+            representation['directions'] = [
+                {
+                    'ending_action': str(direction['ending_action']),
+                    'street_name': str(direction['street_name']),
+                    'covered_edges_indexes': list(direction['covered_edges_indexes']),
+                    'covered_polyline_points_indexes': list(direction['covered_polyline_points_indexes']),
+                } for direction in path_data['directions']
+            ]
+
+    if path_fields is None or 'polyline_points' in path_fields:
+        if compact:
+            representation['polyline_points'] = encode_polyline([(point['latitude'], point['longitude']) for point in path_data['polyline_points']])
+        else:
+            representation['polyline_points'] = [_coordinates_representation(point) for point in path_data['polyline_points']]
+
+    if path_fields is None or 'distance_meters' in path_fields:
+        representation['distance_meters'] = float(path_data['distance_meters'])
+    if path_fields is None or 'eta_seconds' in path_fields:
+        representation['eta_seconds'] = float(path_data['eta_seconds'])
+    if path_fields is None or 'arrival_time' in path_fields:
+        representation['arrival_time'] = _datetime_field.to_representation(datetime.now()) # same as <Path>
+    return representation
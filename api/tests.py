@@ -1,3 +1,53 @@
-from django.test import TestCase
+import io
+import contextlib
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from api.models.path import Path
+from api.serializers.path_serializer import PathSerializer, path_data_to_representation
+from bike_router_ai.compiled_graph import CompiledGraph
+from bike_router_ai.edge_index import EdgeIndex
+from bike_router_ai.graph_overlay import GraphOverlay
+from bike_router_ai.graph_utils import get_path_data, insert_node_in_graph_v2
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+class PathRepresentationTests(SimpleTestCase):
+    """
+    `path_data_to_representation` must give the same paths as going through <Path> and <PathSerializer>
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        graph = make_grid_graph()
+        overlay = GraphOverlay(graph, CompiledGraph.from_graph(graph), EdgeIndex.from_graph(graph))
+        with contextlib.redirect_stdout(io.StringIO()):
+            origin = insert_node_in_graph_v2(overlay, 10**12, (-12.0995, -76.9995))
+            destination = insert_node_in_graph_v2(overlay, 10**12 + 1, (-12.0935, -76.9935))
+        cls.paths_data = [
+            get_path_data(overlay, overlay.shortest_path(origin, destination)),
+            get_path_data(overlay, overlay.shortest_path(origin, 1063)), # the far corner of the grid
+            get_path_data(overlay, [origin]),
+        ]
+
+    def assert_same_representation(self, context):
+        for path_data in self.paths_data:
+            representation = path_data_to_representation(path_data, context)
+            expected = PathSerializer(Path.from_path_data(path_data), context=context).data
+            # the arrival time is the time each one was built at
+            self.assertEqual('arrival_time' in representation, 'arrival_time' in expected)
+            representation.pop('arrival_time', None)
+            expected.pop('arrival_time', None)
+            self.assertEqual(representation, expected)
+
+    def test_full_encoding(self):
+        self.assert_same_representation({})
+        self.assert_same_representation({'encoding': 'full'})
+
+    def test_compact_encoding(self):
+        self.assert_same_representation({'encoding': 'compact'})
+
+    def test_fields(self):
+        for encoding in ('full', 'compact'):
+            self.assert_same_representation({'encoding': encoding, 'path_fields': ['nodes', 'directions', 'eta_seconds']})
+            self.assert_same_representation({'encoding': encoding, 'path_fields': ['edges', 'polyline_points', 'arrival_time']})
@@ -1,10 +1,12 @@
 from rest_framework import routers
 from django.urls import path, include
-from api.views import route_views
+from api.views import route_views, route_job_views, readiness_views
 
 router = routers.DefaultRouter()
 router.register(r'routes', route_views.RouteViewSet, basename='routes')
 router.register(r'trips', route_views.RouteViewSet, basename='trips')
+router.register(r'route-jobs', route_job_views.RouteJobViewSet, basename='route-jobs')
+router.register(r'readiness', readiness_views.ReadinessViewSet, basename='readiness')
 
 urlpatterns = [
     path('', include(router.urls)),
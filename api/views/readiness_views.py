@@ -0,0 +1,18 @@
+from rest_framework import viewsets
+from rest_framework.response import Response
+
+from api.views.route_views import routing_pool
+
+class ReadinessViewSet(viewsets.ViewSet):
+
+    permission_classes = ()
+
+    def list(self, request):
+        """
+        Reports the loading stages of every routing worker.
+        The first call starts the workers if no route was requested yet.
+        Responds 200 once every worker is ready to take routes, 503 while they are still loading
+        """
+        routing_pool.start()
+        status = routing_pool.get_status()
+        return Response(status, status=200 if status['ready'] else 503)
@@ -0,0 +1,26 @@
+from rest_framework import viewsets
+from rest_framework.response import Response
+
+from api.views.route_views import route_job_store
+from bike_router_ai.route_jobs import ROUTE_JOB_MAX_WAIT
+
+class RouteJobViewSet(viewsets.ViewSet):
+
+    permission_classes = ()
+
+    def retrieve(self, request, pk=None):
+        """
+        Returns the status of a route job created with `POST routes/?async=true`, and its route once it's done.
+        With `?wait=<seconds>` the request is held until the job is no longer pending (long polling),
+        for at most `ROUTE_JOB_MAX_WAIT` seconds.
+        Responds 202 while the job is pending, 200 once it's done or failed and 404 if it doesn't exist or expired
+        """
+        try:
+            wait = min(max(float(request.query_params.get('wait', 0)), 0), ROUTE_JOB_MAX_WAIT)
+        except ValueError:
+            return Response({'detail': 'wait must be a number of seconds'}, status=400)
+
+        job = route_job_store.wait(pk, wait) if wait > 0 else route_job_store.get(pk)
+        if job is None:
+            return Response({'detail': 'Route job not found'}, status=404)
+        return Response(job, status=202 if job['status'] == 'pending' else 200)
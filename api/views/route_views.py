@@ -1,17 +1,38 @@
 from datetime import date
 from rest_framework import viewsets
+import json
 from rest_framework.response import Response
-from api.models.direction import Direction
-from api.models.edge import Edge
-from api.models.path import Path
-from api.models.coordinates import Coordinates
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from django.urls import reverse
+from django.http import StreamingHttpResponse
 from api.serializers.route_serializer import RouteSerializer
+from api.serializers.path_serializer import path_data_to_representation
+from api.renderers import FastJSONRenderer
 from rest_framework.permissions import IsAuthenticated
-from bike_router_ai.agent import Agent
-from bike_router_ai.graph_utils import *
-import copy
+from bike_router_ai.routing_pool import RoutingWorkerPool, RoutingJobError
+from bike_router_ai.route_jobs import RouteJobStore, ROUTE_JOB_FINISH_THREADS
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
 
-base_agent = Agent()
+# Workers start loading the graph, crime data and PPO policy in the background
+# on the first route request or readiness check (see readiness_views.py), not when this module is imported
+routing_pool = RoutingWorkerPool(lazy=True)
+# Asynchronous route jobs (POST ?async=true), shared with route_job_views.py
+route_job_store = RouteJobStore()
+# Serializes and stores the routes of the finished jobs, so the thread of the routing pool
+# that delivers the routes of every request never waits for it
+route_job_executor = ThreadPoolExecutor(max_workers=ROUTE_JOB_FINISH_THREADS, thread_name_prefix='route-jobs')
+
+# Content types of the streaming formats (POST ?stream=<format>)
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+# Encodings of the paths of a route (POST ?encoding=<encoding>), see `PathSerializer.get_fields`
+PATH_ENCODINGS = ('full', 'compact')
+# Fields of the paths of a route that can be requested (POST ?fields=<field>,<field>,...)
+PATH_FIELDS = ('nodes', 'edges', 'directions', 'polyline_points', 'distance_meters', 'eta_seconds', 'arrival_time')
 
 class RouteViewSet(viewsets.ViewSet):
 
@@ -19,75 +40,133 @@ class RouteViewSet(viewsets.ViewSet):
 
     serializer_class = RouteSerializer
 
-    def _generate_paths_data(self, graph, paths):
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+
+    def get_serializer_context(self):
         """
-        Given a list of paths, represented by a list of node ID's from a graph,
-        returns a list of <class Path> with their respective information
+        Options of the response taken from the query params:
+        `?encoding=compact` for the compact encoding of the paths and `?fields=` to return only some of their fields,
+        eg. `?encoding=compact&fields=nodes,directions,polyline_points,distance_meters,eta_seconds` leaves out the edges
         """
-        route_paths = []
-        avg_km_s = 18
-        for path in paths:
-            path_edges = []
-            distance = 0
-            # arrival_time = None
-            for edge, attr in zip(path_to_edges(path), get_path_edges_attrs(graph, path)):
-                distance+=attr['length']
-                coords_src = get_node_coordinates(graph, edge[0])
-                coords_trg = get_node_coordinates(graph, edge[1])
-                
-                path_edges.append(
-                    Edge(
-                        source=Coordinates(latitude=coords_src[0], longitude=coords_src[1]),
-                        target=Coordinates(latitude=coords_trg[0], longitude=coords_trg[1]),
-                        attributes={k:v for k,v in attr.items() if k != 'geometry'}
-                        # this copies the keys and values of the dict if they meet the criteria
-                    )
-                )
-            route_paths.append(
-                Path(
-                    nodes=[
-                        Coordinates(
-                            latitude=graph.nodes[node]['y'],
-                            longitude=graph.nodes[node]['x'],
-                        ) for node in path
-                    ],
-                    edges=path_edges,
-                    directions=[Direction(**direction) for direction in generate_route_directions(graph, path)],
-                    polyline_points=[
-                        Coordinates(
-                            latitude=point[0],
-                            longitude=point[1],
-                        ) for point in get_route_polyline_coordinates(graph, path)
-                    ],
-                    distance_meters=distance,
-                    eta_seconds=distance/(avg_km_s*1000/3600) #converting to m/s,
-                )
-            )
-        return route_paths
+        context = {'encoding': self.request.query_params.get('encoding', 'full')}
+        if context['encoding'] not in PATH_ENCODINGS:
+            raise ValidationError({'encoding': f'Must be one of: {", ".join(PATH_ENCODINGS)}'})
+        if 'fields' in self.request.query_params:
+            context['path_fields'] = [field for field in self.request.query_params['fields'].split(',') if field]
+            unknown_fields = [field for field in context['path_fields'] if field not in PATH_FIELDS]
+            if unknown_fields:
+                raise ValidationError({'fields': f'Unknown fields {", ".join(unknown_fields)}, must be some of: {", ".join(PATH_FIELDS)}'})
+        return context
+
+    def _get_route_data(self, serializer, route_data):
+        """
+        Returns `serializer.data` with both options of the route computed by the routing workers.
+        Their paths are built straight from the paths data (see `path_data_to_representation`),
+        which is way faster than creating a <Path> for each one and going through <PathSerializer>
+        """
+        data = serializer.data
+        data['option1'] = [path_data_to_representation(path_data, serializer.context) for path_data in route_data['option1']]
+        data['option2'] = [path_data_to_representation(path_data, serializer.context) for path_data in route_data['option2']]
+
+        # DEPRECATED
+        # route.paths_geojson = get_routes_as_geojson(graph, dijkstra_paths, coords_format='lonlat')
+        return data
+
+    def _create_route_job(self, request, serializer, route):
+        """
+        Queues the route in the routing pool and responds right away with the id of the job computing it,
+        its result can be polled from the route job resource (see route_job_views.py).
+        The job fails if its route can't be computed, also when the worker computing it dies
+        """
+        job_id = route_job_store.create()
+
+        def on_route_computed(future):
+            try:
+                route_job_store.finish(job_id, self._get_route_data(serializer, future.result()))
+            except TimeoutError:
+                route_job_store.fail(job_id, 'The route took too long to compute')
+            except Exception as e:
+                print(e)
+                route_job_store.fail(job_id, 'The route could not be computed')
+
+        future = routing_pool.submit(
+            origin_latlon=(route.origin.coordinates.latitude, route.origin.coordinates.longitude),
+            waypoints_latlons=[(waypoint.coordinates.latitude, waypoint.coordinates.longitude) for waypoint in route.waypoints],
+        )
+        future.add_done_callback(lambda future: route_job_executor.submit(on_route_computed, future))
+
+        job_url = request.build_absolute_uri(reverse('route-jobs-detail', args=[job_id]))
+        return Response({'id': job_id, 'status': 'pending', 'url': job_url}, status=202, headers={'Location': job_url})
+    
+    def _stream_route(self, serializer, route, stream_format):
+        """
+        Streams the route as a sequence of events, written as one JSON object per line (`ndjson`)
+        or as Server-Sent Events (`sse`):
+        - `route`: the route without any option, sent right away
+        - `leg`: `{'index', 'option1', 'option2'}` with both paths of a leg, sent as soon as the leg is computed
+        - `done`: once every leg was sent
+        - `error`: `{'status', 'detail'}` if the route couldn't be computed, no more events are sent after it
+        """
+        def format_event(event, data):
+            if stream_format == 'sse': return f'event: {event}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n'
+            return json.dumps({'event': event, 'data': data}, cls=JSONEncoder) + '\n'
+
+        def events():
+            yield format_event('route', serializer.data)
+            try:
+                for leg_index, leg in routing_pool.stream_route(
+                    origin_latlon=(route.origin.coordinates.latitude, route.origin.coordinates.longitude),
+                    waypoints_latlons=[(waypoint.coordinates.latitude, waypoint.coordinates.longitude) for waypoint in route.waypoints],
+                ):
+                    yield format_event('leg', {
+                        'index': leg_index,
+                        'option1': path_data_to_representation(leg['option1'], serializer.context),
+                        'option2': path_data_to_representation(leg['option2'], serializer.context),
+                    })
+            except TimeoutError:
+                yield format_event('error', {'status': 504, 'detail': 'The route took too long to compute'})
+                return
+            except RoutingJobError as e:
+                print(e)
+                yield format_event('error', {'status': 500, 'detail': 'The route could not be computed'})
+                return
+            yield format_event('done', {})
+
+        response = StreamingHttpResponse(events(), content_type=STREAM_CONTENT_TYPES[stream_format], status=200)
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no' # so a proxy like nginx doesn't hold the legs until the route is done
+        return response
     
     def create(self, request):
-        serializer = self.serializer_class(data=request.data)
+        serializer = self.serializer_class(data=request.data, context=self.get_serializer_context())
         
         if serializer.is_valid():
             # since we don't need data persistance,
             # save() will only return the serialized entity
             route = serializer.save()  
 
+            # ?async=true responds 202 with a job to poll instead of waiting for the route
+            if request.query_params.get('async', '').lower() in ('1', 'true', 'yes'):
+                return self._create_route_job(request, serializer, route)
+
+            # ?stream=ndjson or ?stream=sse sends each leg as soon as it's computed
+            stream_format = request.query_params.get('stream')
+            if stream_format:
+                if stream_format not in STREAM_CONTENT_TYPES:
+                    return Response({'detail': f'stream must be one of: {", ".join(STREAM_CONTENT_TYPES)}'}, status=400)
+                return self._stream_route(serializer, route, stream_format)
+
             print('\nComputing route...')
-            agent = copy.deepcopy(base_agent)
-            
-            predicted_paths, dijkstra_paths = agent.predict_route(
-                origin_latlon=(route.origin.coordinates.latitude, route.origin.coordinates.longitude),
-                waypoints_latlons=[(waypoint.coordinates.latitude, waypoint.coordinates.longitude) for waypoint in route.waypoints],
-            )
-
-            graph = agent.env.unwrapped.graph
-            route.option1 = self._generate_paths_data(graph, predicted_paths)
-            route.option2 = self._generate_paths_data(graph, dijkstra_paths)
-
-            # DEPRECATED
-            # route.paths_geojson = get_routes_as_geojson(graph, dijkstra_paths, coords_format='lonlat')
-            
-            # the serializer variable saves every change done to the route instance
-            return Response(serializer.data, status=201) # 201 means CREATED, while 200 only means OK
+            try:
+                route_data = routing_pool.predict_route(
+                    origin_latlon=(route.origin.coordinates.latitude, route.origin.coordinates.longitude),
+                    waypoints_latlons=[(waypoint.coordinates.latitude, waypoint.coordinates.longitude) for waypoint in route.waypoints],
+                )
+            except TimeoutError:
+                return Response({'detail': 'The route took too long to compute'}, status=504)
+            except RoutingJobError as e:
+                print(e)
+                return Response({'detail': 'The route could not be computed'}, status=500)
+
+            return Response(self._get_route_data(serializer, route_data), status=201) # 201 means CREATED, while 200 only means OK
         return Response(serializer.errors, status=400)
\ No newline at end of file
@@ -3,29 +3,70 @@ from stable_baselines3 import PPO
 from sb3_contrib import RecurrentPPO
 from stable_baselines3.common.vec_env import DummyVecEnv 
 from bike_router_ai.bike_router_env import BikeRouterEnv
+from bike_router_ai.inference_scheduler import InferenceScheduler
+from bike_router_ai.route_cache import get_file_hash, get_route_key
+from bike_router_ai.graph_snapshot import GRAPHML_PATH, GRAPH_SNAPSHOT_PATH, ensure_graph_snapshot, get_graph_snapshot_hash
 from gymnasium.wrappers import FlattenObservation
+from decouple import config
 
 from bike_router_ai.graph_utils import *
 
 import os
-import copy
+import random
 
-# Initializing the Env
-flatten_base_env = FlattenObservation(
-    BikeRouterEnv(
-        graphml_path=f'{os.getcwd()}/SafeRideApi/bike_router_ai/graph_SB_SI_w_cycleways_simplified.graphml',
-        crime_data_excel_path=f'{os.getcwd()}/SafeRideApi/bike_router_ai/criminal_data.xlsx',
+CRIME_DATA_PATH = f'{os.getcwd()}/SafeRideApi/bike_router_ai/criminal_data.xlsx'
+PPO_PATH = f'{os.getcwd()}/SafeRideApi/bike_router_ai/trained_agents/ppo.zip'
+
+# Set to False to flatten the Dict observations of the env with <FlattenObservation> on every step
+AGENT_FLAT_OBSERVATIONS = config('AGENT_FLAT_OBSERVATIONS', default=True, cast=bool)
+
+# Loading stages of an <Agent>, in order
+AGENT_STAGES = ('graph', 'crime_data', 'policy')
+
+
+def load_base_env(on_stage=None, flat_observations=AGENT_FLAT_OBSERVATIONS):
+    """
+    Loads the env with the graph and crime data shared by every route request.
+    Its observations are flat vectors either way, written by the env itself when `flat_observations`
+    or flattened by <FlattenObservation> otherwise, so the same trained policy works with both
+    """
+    if on_stage: on_stage('graph')
+    ensure_graph_snapshot(GRAPHML_PATH, GRAPH_SNAPSHOT_PATH)
+    env = BikeRouterEnv(
+        graphml_path=GRAPH_SNAPSHOT_PATH,
+        crime_data_excel_path=CRIME_DATA_PATH,
         force_arriving=True,
+        on_stage=on_stage,
+        flat_observations=flat_observations,
     )
-)
+    return env if flat_observations else FlattenObservation(env)
+
 
 class Agent:
-    def __init__(self):
-        self.env = copy.deepcopy(flatten_base_env)
+    def __init__(self, on_stage=None):
+        """
+        on_stage: Optional callback, called with the name of each loading stage (see `AGENT_STAGES`) when it starts
+        """
+        self.env = load_base_env(on_stage)
+        if on_stage: on_stage('policy')
         self.ppo = PPO.load(
-            path=f'{os.getcwd()}/SafeRideApi/bike_router_ai/trained_agents/ppo.zip',
+            path=PPO_PATH,
             env=DummyVecEnv([lambda: self.env])
         )
+        # Batches the policy forward passes of every route being computed concurrently in this process
+        self.inference = InferenceScheduler(self.ppo)
+        # Version of the graph, crime data and model, a route computed with other versions can't be reused
+        self.version = '-'.join((
+            get_graph_snapshot_hash(GRAPH_SNAPSHOT_PATH),
+            get_file_hash(CRIME_DATA_PATH),
+            get_file_hash(PPO_PATH),
+        ))
+
+    def get_route_key(self, origin_latlon, waypoints_latlons: list):
+        """
+        Returns the key of the route in the <RouteCache>, see `route_cache.get_route_key`
+        """
+        return get_route_key(self.env.unwrapped.edge_index, self.version, origin_latlon, waypoints_latlons)
 
     def predict_route(self, origin_latlon, waypoints_latlons: list):
         """
@@ -33,31 +74,64 @@ class Agent:
         going throught all of the given waypoints in `waypoints_latlons`,
         where the final destination is the last waypoint.
         Returns both the path predicted by the agent as a list of nodes from the graph
-        and the Dijkstra path in the env, also as a list of nodes from the graph
+        and the Dijkstra path in the env, also as a list of nodes from the graph,
+        plus the <GraphOverlay> with the inserted origin and waypoints where those nodes live
         """
-        self.env = copy.deepcopy(flatten_base_env)
+        predicted_paths = []
+        dijkstra_paths = []
+        graph = None
+        for predicted_path, dijkstra_path, graph in self.predict_route_legs(origin_latlon, waypoints_latlons):
+            predicted_paths.append(predicted_path)
+            dijkstra_paths.append(dijkstra_path)
+        return predicted_paths, dijkstra_paths, graph
+
+    def predict_route_legs(self, origin_latlon, waypoints_latlons: list, leg_indexes=None):
+        """
+        Same as `predict_route`, but yields `(predicted_path, dijkstra_path, graph)` for each leg
+        of the route (origin to first waypoint, first to second waypoint, ...) as soon as it is computed.
+
+        leg_indexes: Optional list with the indexes of the only legs to compute.
+                The legs don't depend on each other, so different processes can compute different legs of the same route.
+                The origin and every waypoint are still inserted in the graph, so each leg is the same as
+                when the whole route is computed
+        """
+        # Every call works on its own env that reads the shared base graph through an overlay
+        # so the origin and waypoints insertions don't need a copy of the whole graph
+        env = self.env.unwrapped.with_graph_overlay()
 
-        self.env.unwrapped.set_origin_and_waypoints(
+        env.set_origin_and_waypoints(
             origin_latlon=origin_latlon,
             waypoints_latlons=waypoints_latlons
         )
 
-        predicted_paths = []
-        dijkstra_paths = []
-        while len(self.env.unwrapped.route_origin_and_waypoints_ids) >= 2:
-            obs, info = self.env.reset()
+        leg_envs = env.split_route_legs()
+        if leg_indexes is not None: leg_envs = [leg_envs[i] for i in leg_indexes]
+        for leg_env in leg_envs:
+            if not leg_env.flat_observations: leg_env = FlattenObservation(leg_env)
+            obs, info = leg_env.reset()
             terminated = False
             episode_reward = 0
 
-            while not terminated:
-                action = self.ppo.predict(obs)
-                action = action[0]
-                obs, reward, terminated, truncated, info = self.env.step(action)
-                episode_reward += reward
+            with self.inference.episode():
+                while not terminated:
+                    action = self.inference.predict(obs)
+                    obs, reward, terminated, truncated, info = leg_env.step(action)
+                    episode_reward += reward
 
             print(f'Finished with reward {episode_reward}')
-            print(f'Status: arrived:{self.env.unwrapped.arrived}  invalid_action:{self.env.unwrapped.selected_invalid_action} revisiting:{self.env.unwrapped.revisiting} went_too_far:{self.env.unwrapped.went_too_far} ')
-            predicted_paths.append(self.env.unwrapped.path)
-            dijkstra_paths.append(self.env.unwrapped.shortest_path)
-        
-        return predicted_paths, dijkstra_paths
\ No newline at end of file
+            print(f'Status: arrived:{leg_env.unwrapped.arrived}  invalid_action:{leg_env.unwrapped.selected_invalid_action} revisiting:{leg_env.unwrapped.revisiting} went_too_far:{leg_env.unwrapped.went_too_far} ')
+            yield leg_env.unwrapped.path, leg_env.unwrapped.shortest_path, env.graph
+
+    def warm_up(self, num_routes, seed=0):
+        """
+        Computes `num_routes` synthetic routes between random nodes of the graph, so the first
+        real requests don't pay for the lazy initializations of torch, numpy and the caches
+        """
+        rng = random.Random(seed)
+        compiled_graph = self.env.unwrapped.compiled_graph
+        for _ in range(num_routes):
+            origin, destination = rng.sample(range(len(compiled_graph)), 2)
+            self.predict_route(
+                origin_latlon=compiled_graph.node_latlon(compiled_graph.node_ids[origin].item()),
+                waypoints_latlons=[compiled_graph.node_latlon(compiled_graph.node_ids[destination].item())],
+            )
@@ -1,11 +1,21 @@
 from gymnasium import Env
 from gymnasium.spaces import Discrete, Box, Dict, Tuple
+from gymnasium.spaces.utils import flatten_space
 import numpy as np
 import random
 from decouple import config
-import pandas as pd
+import copy
+import os
 
 from bike_router_ai.graph_utils import *
+from bike_router_ai.graph_overlay import GraphOverlay
+from bike_router_ai.compiled_graph import CompiledGraph
+from bike_router_ai.edge_index import EdgeIndex
+from bike_router_ai.contraction_hierarchy import ContractionHierarchy
+from bike_router_ai.spatial_index import GridIndex
+from bike_router_ai.crime_knn_cache import CrimeKnnCache
+from bike_router_ai.crime_data import get_crime_points
+from bike_router_ai.od_sampler import ODSampler
 
 # Valores maximos y minimos de latitude y longitude de Lima Metropolitana
 MIN_LIM_LAT = -12.25    
@@ -13,6 +23,21 @@ MAX_LIM_LAT = -11.56
 MIN_LIM_LON = -77.18
 MAX_LIM_LON = -76.80
 
+# Layout of the flat observations (see `flat_observations` of <BikeRouterEnv>), the same order of
+# `gymnasium.spaces.flatten` over the Dict observation space, which sorts the keys of every Dict:
+FLAT_OBS_CLOSEST_CRIME_POINTS = slice(0, 15)  # 5 closest crime points as (distance, lat, lon)
+FLAT_OBS_CURRENT_LATLON = slice(15, 17)
+FLAT_OBS_DESTINATION_LATLON = slice(17, 19)
+FLAT_OBS_DISTANCE_TO_DESTINATION = 19
+FLAT_OBS_NUM_POSSIBLE_STEPS = 20
+FLAT_OBS_POSSIBLE_STEPS = slice(21, 53)       # 8 possible steps with the `FLAT_OBS_STEP_KEYS` of each one
+FLAT_OBS_PREVIOUS_STEP = slice(53, 57)        # `FLAT_OBS_STEP_KEYS` of the previous step
+FLAT_OBS_STEPS_COUNT = 57
+FLAT_OBS_STEPS_TOLERANCE = 58
+FLAT_OBS_TRAVELED_DISTANCE = 59
+FLAT_OBS_SIZE = 60
+FLAT_OBS_STEP_KEYS = ('cycleway_level', 'end_node_visited_status', 'maxspeed', 'relative_bearing')
+
 class BikeRouterEnv(Env):
 
     metadata = {"render_modes": ["human", "rgb_array"], "render_fps": 144}
@@ -32,6 +57,9 @@ class BikeRouterEnv(Env):
         window_resolution=1000,
         window_aspect_ratio=(1,1),
         difficultie=0.5,
+        on_stage=None,
+        flat_observations=False,
+        shared_data=None,
     ):
         """
         difficultie: Used on training. Determines how far away does the origin and destination need to be from each other.
@@ -46,6 +74,19 @@ class BikeRouterEnv(Env):
         If human-rendering is used (which is not), `self.window` will be a reference to the window that we draw to.
         `self.clock` will be a clock that is used to ensure that the environment is rendered at the correct framerate.
         They will remain `None` until human-mode is used for the first time.
+
+        on_stage: Optional callback, called with the name of each loading stage ('graph', 'crime_data') when it starts.
+
+        flat_observations: Returns the observations as the same flat vector that <FlattenObservation> returns
+                for the Dict observation space (see the FLAT_OBS_* layout), written straight into a preallocated
+                array instead of building the nested dicts of the Dict space. The vector is overwritten on every step.
+                The Dict observation space is kept at `self.dict_observation_space`.
+
+        shared_data: Optional <SharedEnvData> attached from the process that loaded the graph and crime data (see training.py).
+                The compiled graph, contraction hierarchy, crime points and closest crime points are read from it
+                instead of being built again, `place`, `graphml_path` and `crime_data_excel_path` are ignored.
+                No networkx graph is loaded, so the env only runs episodes with random origins and destinations,
+                `set_origin_and_waypoints` and `with_graph_overlay` need the env of a graph.
         """
 
         print('Initializing the env...')
@@ -54,6 +95,7 @@ class BikeRouterEnv(Env):
         self.randomize_ori_dest_on_reset = randomize_ori_dest_on_reset
         self.log = log
         self.difficultie = difficultie
+        self.flat_observations = flat_observations
 
         # Variables related to render()
         assert render_mode is None or render_mode in self.metadata["render_modes"]
@@ -67,19 +109,53 @@ class BikeRouterEnv(Env):
         GOOGLE_MAPS_API_KEY = config('GOOGLE_MAPS_API_KEY')
         configure(google_maps_api_key=GOOGLE_MAPS_API_KEY)
 
-        # Get the city/place Graph and setting origin and destination
-        if graphml_path:
-            print('Loading map graph from file...')
-            self.graph = load_graph_from_file(graphml_path)
+        if on_stage: on_stage('graph')
+        if shared_data is not None:
+            # The episodes with random origins and destinations only read the compiled graph and the contraction hierarchy,
+            # so the workers of a training run never load the networkx graph nor build the spatial index of its edges
+            self.compiled_graph = shared_data.compiled_graph
+            self.edge_index = None
+            self.hierarchy = shared_data.hierarchy
+            self.graph = GraphOverlay(None, self.compiled_graph, hierarchy=self.hierarchy)
         else:
-            print('Fetching map data from OSM api...')
-            self.graph = get_graph(place, simplify=simplify)
-            #save_graph_to_file(self.graph, 'city_graph.graphml')
-
-        self.crime_points = []
-        if crime_data_excel_path:
+            # Get the city/place Graph and setting origin and destination
+            if graphml_path:
+                print('Loading map graph from file...')
+                self.graph = load_graph_from_file(graphml_path)
+            else:
+                print('Fetching map data from OSM api...')
+                self.graph = get_graph(place, simplify=simplify)
+                #save_graph_to_file(self.graph, 'city_graph.graphml')
+
+            # Array backed copy of the road network, used on the hot path of reset() and step().
+            # The env always reads the graph through a <GraphOverlay>, the networkx graph is at `self.graph.base`
+            print('Compiling map graph...')
+            self.compiled_graph = CompiledGraph.from_graph(self.graph)
+            # Spatial index of the edges, used to snap the origin and waypoints of every route request
+            self.edge_index = EdgeIndex.from_graph(self.graph)
+            # Contraction hierarchy for the shortest path queries, persisted next to the graph file
+            if graphml_path:
+                self.hierarchy = ContractionHierarchy.load_or_build(
+                    f'{os.path.splitext(graphml_path)[0]}_ch.npz', self.graph, self.compiled_graph, log=log
+                )
+            else:
+                print('Building contraction hierarchy...')
+                self.hierarchy = ContractionHierarchy.build(
+                    len(self.compiled_graph), ContractionHierarchy.get_edges(self.graph, self.compiled_graph), log=log
+                )
+            self.graph = GraphOverlay(self.graph, self.compiled_graph, self.edge_index, self.hierarchy)
+        # Random origins and destinations of the training episodes
+        self.od_sampler = ODSampler(self.compiled_graph)
+
+        if on_stage: on_stage('crime_data')
+        self.crime_points = np.empty((0, 2), dtype=np.float64)
+        if shared_data is not None:
+            self.crime_points = shared_data.crime_points
+        elif crime_data_excel_path:
             # Set sheet_name to none to get the full crime points from SB and SI all together
             self.crime_points = self.get_crime_points(crime_data_excel_path, requested_district) 
+        # Spatial index for the closest crime points queries of each step
+        self.crime_points_index = GridIndex(self.crime_points)
 
         ##########################################################################################################################
         
@@ -116,6 +192,25 @@ class BikeRouterEnv(Env):
         # The max number of closest points the agent will be able to see,
         self.num_prox_crime_points = 5
 
+        # Closest crime points of every node of the graph, persisted next to the graph file
+        if shared_data is not None:
+            self.crime_knn_cache = CrimeKnnCache(
+                self.compiled_graph,
+                self.crime_points_index,
+                shared_data.crime_knn_k,
+                shared_data.crime_knn_indexes,
+                shared_data.crime_knn_distances,
+            )
+        elif graphml_path:
+            self.crime_knn_cache = CrimeKnnCache.load_or_build(
+                f'{os.path.splitext(graphml_path)[0]}_crime_knn.npz',
+                self.compiled_graph,
+                self.crime_points_index,
+                self.num_prox_crime_points,
+            )
+        else:
+            self.crime_knn_cache = CrimeKnnCache.build(self.compiled_graph, self.crime_points_index, self.num_prox_crime_points)
+
         self.observation_space = Dict({
             'current_latlon': Box(
                 low=np.array([MIN_LIM_LAT, MIN_LIM_LON]),
@@ -169,6 +264,11 @@ class BikeRouterEnv(Env):
                 })
             ]*self.num_prox_crime_points), #len(self.crime_points)
         })
+        self.dict_observation_space = self.observation_space
+        if flat_observations:
+            # Same Box as the observation space of <FlattenObservation>, so the trained policies work with both modes
+            self.observation_space = flatten_space(self.dict_observation_space)
+            assert self.observation_space.shape == (FLAT_OBS_SIZE,), 'The FLAT_OBS_* layout does not match the observation space'
 
         self.reset()
         print('Env succesfully initialized!')
@@ -185,16 +285,8 @@ class BikeRouterEnv(Env):
 
         # Assigning random origin and destination
         if self.randomize_ori_dest_on_reset == True:
-            random_index = random.randint(0, len(self.graph.nodes)-1)
-            self.origin_node = list(self.graph.nodes)[random_index]
-            while True:
-                random_index = random.randint(0, len(self.graph.nodes)-1)
-                self.destination_node = list(self.graph.nodes)[random_index]
-                dist = get_distance_between_nodes(self.graph, self.origin_node, self.destination_node)
-                # If origin and destination are different and the distance between them is within the range desire by the difficultie level, then we stop searching destination
-                if self.destination_node != self.origin_node: 
-                    if self.difficultie > 4: break
-                    if ((self.difficultie - 2)*1000 if self.difficultie > 1 else 0) < dist <= self.difficultie * 1000: break
+            # Origin and destination are different and the distance between them is within the range desire by the difficultie level
+            self.origin_node, self.destination_node = self.od_sampler.sample(self.difficultie)
         else:
             assert len(self.route_origin_and_waypoints_ids) >= 2, 'Not enough nodes to compute a route. At least 2 node IDs inside self.route_origin_and_waypoints_ids are neeeded. Please call set_origin_and_waypoints() to insert new origin and waypoints'
             # First path to compute will always go from the first ID to the second ID
@@ -209,25 +301,31 @@ class BikeRouterEnv(Env):
         # Returning to origin node
         self.current_node = self.origin_node
         self.path = [self.current_node]
+        # Same nodes as `self.path`, for the constant time `end_node_visited_status` of each step
+        self.visited_nodes = {self.current_node}
 
         # When inserting nodes with ids it returns a list of paths with just one element so we have to add [0] at the end. idk why
         self.shortest_path = get_shortest_path(self.graph, self.origin_node, self.destination_node)
+        self.steps_tolerance = int(len(self.shortest_path) * 1.2)
 
         self.traveled_distance = 0.0
         self.distance_origin_destination = get_distance_between_nodes(self.graph, self.origin_node, self.destination_node)
         self.distance_tolerance_multiplier = self._calculate_distance_tolerance(self.distance_origin_destination)        
 
-        self.current_node_neighbours = get_node_neighbours(self.graph, self.current_node) # Defining initial possible steps
-        # 1: possible action, 0: impossible action
-        self.action_mask = np.array(
-            [1] * len(self.current_node_neighbours) + [0] * (self.max_actions - len(self.current_node_neighbours)),
-            dtype=np.int8
-        )
+        # Defining initial possible steps
+        self.current_out_edges = self.graph.out_edges(self.current_node)
+        self.current_node_neighbours = self.current_out_edges.neighbors
+        # 1: possible action, 0: impossible action. Updated in place on each step,
+        # allocated on each episode since the copies of the env (see `split_route_legs`) can run concurrently
+        self.action_mask = np.zeros(self.max_actions, dtype=np.int8)
+        self.action_mask[:len(self.current_node_neighbours)] = 1
 
         # setting initial last step attributes all to -1 so the agent can learn that it means we haven't done a step yet
         self.previous_step = {key: -1 for key in self.edge_attributes_spaces}
-        
-        obs = self._get_obs()
+        # Allocated on each episode since the copies of the env (see `split_route_legs`) can run concurrently
+        if self.flat_observations: self.flat_obs = np.zeros(FLAT_OBS_SIZE, dtype=self.observation_space.dtype)
+
+        obs = self._observe()
         info = self._get_info()
 
         return obs, info
@@ -253,108 +351,126 @@ class BikeRouterEnv(Env):
         # WE DONT CALL RESET INSIDE, WE EXPECT RESET TO BE CALL
         # RIGHT AFTER SETTING THE ORIGIN AND WAYPOINTS.
         # IF WE DON'T, WEIRD BEHVAIOR IS GONNA HAPPEN
+
+    def split_route_legs(self):
+        """
+        Returns one shallow copy of the env for each leg of the route set with `set_origin_and_waypoints`
+        (origin to first waypoint, first to second waypoint, ...).
+        Every copy keeps its own episode state, but they all share this env's graph, with the origin and waypoints
+        already inserted, and its crime points, so the legs can be rolled out concurrently.
+        Call reset() on each copy to start its leg
+        """
+        ids = self.route_origin_and_waypoints_ids
+        legs = []
+        for origin_node, destination_node in zip(ids[:-1], ids[1:]):
+            env = copy.copy(self)
+            env.route_origin_and_waypoints_ids = [origin_node, destination_node]
+            legs.append(env)
+        return legs
+
+    def with_graph_overlay(self):
+        """
+        Returns a shallow copy of the env that reads the road network through a new <GraphOverlay> of `self.graph`.
+        The copy shares the graph and the crime points with this env, so it's cheap to create one per route request,
+        and inserting the origin and waypoints into it never modifies the graph of this env.
+        """
+        env = copy.copy(self)
+        env.graph = GraphOverlay(self.graph.base, self.compiled_graph, self.edge_index, self.hierarchy)
+        return env
         
 
     def get_crime_points(self, excel_path, sheet_name=None):
-        crime_data = pd.read_excel(excel_path, sheet_name=sheet_name)
-        crime_points = []
-        if not sheet_name: # if none, retrieve all crime data together
-            for key, data_frame in crime_data.items():
-                for index, row in data_frame.iterrows():
-                    crime_points.append((row['latitude'], row['longitude']))
-        elif isinstance(sheet_name, str): # retrieves the data only for the requested sheet
-            for index, row in crime_data.iterrows():
-                crime_points.append((row['latitude'], row['longitude']))
-        return crime_points
+        return get_crime_points(excel_path, sheet_name)
     
 
     def _is_close_to_crime_point(self, current_latlon, tolerance_radius_meters=120):
-        for crime_point_latlng in self.crime_points:
-            distance = get_distance_between_points(current_latlon, crime_point_latlng)
-            if distance <= tolerance_radius_meters:
-                return True
-        return False
+        indexes, _ = self.crime_points_index.query_radius(current_latlon, tolerance_radius_meters)
+        return len(indexes) > 0
     
-    def _get_reward_base_on_proximity_to_crime_points(self, crime_points, tolerance_radius_meters=120):
+    def _get_reward_base_on_proximity_to_crime_points(self, crime_points_distances, tolerance_radius_meters=120):
         reward = 6 # if we are not close to any crime point, then this will be our reward
-        for crime_point in crime_points:
-            if crime_point['distance'] <= tolerance_radius_meters:
+        for distance in crime_points_distances:
+            if distance <= tolerance_radius_meters:
                 # for each crime point that's within our tolerance range, we will be decreasing the reward
                 reward -= 3
         return reward
 
 
-    def _get_edge_attributes(self, u, v):
-
-        edge_attributes = self.graph[u][v][0]
-
-        if 'maxspeed' in edge_attributes:
-            maxspeed = edge_attributes['maxspeed']
-            if type(maxspeed) == type([]): # Sometimes 'maxspeed' returns as a LIST of speedlimits
-                maxspeed = int(maxspeed[0])
-            maxspeed = int(maxspeed)
-        else:
-            maxspeed = 30 if edge_attributes['highway'] == 'residential' else 50
-
-        # relative to the destination
-        relative_bearing = calculate_edge_relative_bearing(self.graph, u, v, self.destination_node)
+    def _get_out_edges_relative_bearings(self, u, out_edges):
+        """
+        Returns the bearings of the out edges of the node `u` relative to the destination
+        """
+        bearing_u_destination = compute_bearing_between_points(
+            self.graph.node_latlon(u), self.graph.node_latlon(self.destination_node)
+        )
+        return (out_edges.bearing - bearing_u_destination + 360) % 360
 
-        return {
-            'cycleway_level': int(edge_attributes['cycleway_level']) if 'cycleway_level' in edge_attributes else 0,
-            'maxspeed': maxspeed,
-            'relative_bearing': relative_bearing,
-            'end_node_visited_status': 1 if v in self.path else 0
-        }
+    def _get_out_edges_attributes(self, u, out_edges):
+        """
+        Returns the attributes of every out edge `(u, v)` of the node `u`,
+        computed at once from the <OutEdges> arrays of `u`
+        """
+        relative_bearings = self._get_out_edges_relative_bearings(u, out_edges)
+
+        return [
+            {
+                'cycleway_level': cycleway_level,
+                'maxspeed': maxspeed,
+                'relative_bearing': relative_bearing,
+                'end_node_visited_status': 1 if v in self.visited_nodes else 0
+            } for v, cycleway_level, maxspeed, relative_bearing in zip(
+                out_edges.neighbors,
+                out_edges.cycleway_level.tolist(),
+                out_edges.maxspeed, # numpy ints, so flattening them into the int8 Box wraps like `_get_flat_obs` does
+                relative_bearings.tolist(),
+            )
+        ]
 
 
     def _get_obs_possible_steps(self):
-        possible_steps = []
-        for neighbour in self.current_node_neighbours:
-            possible_steps.append(self._get_edge_attributes(self.current_node, neighbour))
+        possible_steps = self._get_out_edges_attributes(self.current_node, self.current_out_edges)
         possible_steps += [{key: -1 for key in self.edge_attributes_spaces}] * (self.max_actions - len(self.current_node_neighbours))
+        # Kept so step() can reuse the attributes of the chosen edge as the previous step
+        self.possible_steps = possible_steps
         return tuple(possible_steps)
 
-    def _get_closest_crime_points(self):
-        distances = [] # random number
-        crime_points = [] # random number
-        for crime_point_latlng in self.crime_points:
-            distance = get_distance_between_points(
-                [self.graph.nodes[self.current_node]['y'], self.graph.nodes[self.current_node]['x']],
-                crime_point_latlng,
-            )
-            crime_points.append((list(crime_point_latlng)))
-            distances.append(distance)
-            
-        sorted_indexes = np.argsort(distances)
-
-        crime_points_sorted_by_proximity = []
-        sorted_distances = []
-        for i in sorted_indexes:
-            crime_points_sorted_by_proximity.append(crime_points[i])
-            sorted_distances.append(distances[i])
+    def _get_possible_steps_table(self):
+        """
+        Same attributes as `_get_obs_possible_steps` as a `(max_actions, 4)` array with the `FLAT_OBS_STEP_KEYS` columns
+        """
+        out_edges = self.current_out_edges
+        table = np.full((self.max_actions, len(FLAT_OBS_STEP_KEYS)), -1, dtype=np.float64)
+        num_steps = len(out_edges.neighbors)
+        table[:num_steps, 0] = out_edges.cycleway_level
+        table[:num_steps, 1] = [1 if v in self.visited_nodes else 0 for v in out_edges.neighbors]
+        table[:num_steps, 2] = out_edges.maxspeed
+        table[:num_steps, 3] = self._get_out_edges_relative_bearings(self.current_node, out_edges)
+        return table
 
-        return crime_points_sorted_by_proximity, sorted_distances
+    def _get_closest_crime_points(self):
+        """
+        Returns `(latlons, distances)`, numpy arrays with the `num_prox_crime_points` crime points closest to the current node
+        """
+        return self.crime_knn_cache.query(self.current_node, self.graph.node_latlon(self.current_node))
     
 
+    def _observe(self):
+        return self._get_flat_obs() if self.flat_observations else self._get_obs()
+
     def _get_obs(self):
         crime_points_sorted_by_proximity, sorted_distances = self._get_closest_crime_points()
+        # Kept for the rewards of the step, same for `distance_to_destination`
+        self.closest_crime_points_distances = sorted_distances
+        self.distance_to_destination = get_distance_between_nodes(self.graph, self.current_node, self.destination_node)
         crime_points_sorted_by_proximity = tuple(
-            [{ "latlon": point, "distance": dist } for point, dist, _ in zip(crime_points_sorted_by_proximity, sorted_distances, range(self.num_prox_crime_points))]
+            [{ "latlon": point, "distance": dist } for point, dist in zip(crime_points_sorted_by_proximity, sorted_distances)]
         )
         return {
-            'current_latlon': [
-                self.graph.nodes[self.current_node]['y'],
-                self.graph.nodes[self.current_node]['x']
-            ],
-            'destination_latlon': [
-                self.graph.nodes[self.destination_node]['y'],
-                self.graph.nodes[self.destination_node]['x']
-            ],
+            'current_latlon': list(self.graph.node_latlon(self.current_node)),
+            'destination_latlon': list(self.graph.node_latlon(self.destination_node)),
             'steps_count': len(self.path) - 1,
-            'steps_tolerance': int(len(self.shortest_path) * 1.2),
-            'distance_to_destination': get_distance_between_nodes(
-                self.graph, self.current_node, self.destination_node
-            ),
+            'steps_tolerance': self.steps_tolerance,
+            'distance_to_destination': self.distance_to_destination,
             'traveled_distance': self.traveled_distance,
             'previous_step': self.previous_step,
             'num_possible_steps': len(self.current_node_neighbours),
@@ -362,6 +478,46 @@ class BikeRouterEnv(Env):
             'closest_crime_points': crime_points_sorted_by_proximity,
         }
 
+    @staticmethod
+    def _as_int8(maxspeed):
+        """
+        Casts the max speeds to the int8 of the `maxspeed` Box, out of range speeds wrap around
+        the same as when `gymnasium.spaces.flatten` casts the int16 speeds of the Dict observations
+        """
+        return np.asarray(maxspeed).astype(np.int16).astype(np.int8)
+
+    def _get_flat_obs(self):
+        """
+        Same as `gymnasium.spaces.flatten(self.dict_observation_space, self._get_obs())`, written straight
+        into the `flat_obs` array (see the FLAT_OBS_* layout), with the same float32 rounding and int8 casts of the Dict space
+        """
+        obs = self.flat_obs
+        crime_latlons, self.closest_crime_points_distances = self._get_closest_crime_points()
+        crime_points = obs[FLAT_OBS_CLOSEST_CRIME_POINTS].reshape(self.num_prox_crime_points, 3)
+        crime_points[:, 0] = self.closest_crime_points_distances.astype(np.float32)
+        crime_points[:, 1:] = crime_latlons
+
+        obs[FLAT_OBS_CURRENT_LATLON] = self.graph.node_latlon(self.current_node)
+        obs[FLAT_OBS_DESTINATION_LATLON] = self.graph.node_latlon(self.destination_node)
+        self.distance_to_destination = get_distance_between_nodes(self.graph, self.current_node, self.destination_node)
+        obs[FLAT_OBS_DISTANCE_TO_DESTINATION] = np.float32(self.distance_to_destination)
+        obs[FLAT_OBS_NUM_POSSIBLE_STEPS] = len(self.current_node_neighbours)
+
+        # Kept so step() can reuse the attributes of the chosen edge as the previous step
+        self.possible_steps_table = self._get_possible_steps_table()
+        possible_steps = obs[FLAT_OBS_POSSIBLE_STEPS].reshape(self.max_actions, len(FLAT_OBS_STEP_KEYS))
+        possible_steps[:] = self.possible_steps_table
+        possible_steps[:, 2] = self._as_int8(self.possible_steps_table[:, 2])
+        possible_steps[:, 3] = self.possible_steps_table[:, 3].astype(np.float32)
+
+        obs[FLAT_OBS_PREVIOUS_STEP] = [self.previous_step[key] for key in FLAT_OBS_STEP_KEYS]
+        obs[FLAT_OBS_PREVIOUS_STEP.start + 2] = self._as_int8(self.previous_step['maxspeed'])
+        obs[FLAT_OBS_PREVIOUS_STEP.stop - 1] = np.float32(self.previous_step['relative_bearing'])
+        obs[FLAT_OBS_STEPS_COUNT] = len(self.path) - 1
+        obs[FLAT_OBS_STEPS_TOLERANCE] = self.steps_tolerance
+        obs[FLAT_OBS_TRAVELED_DISTANCE] = np.float32(self.traveled_distance)
+        return obs
+
 
     def _get_info(self):
         # For some reason, in keras-rl2 the info is being check that it is not a list
@@ -400,38 +556,42 @@ class BikeRouterEnv(Env):
         return tolerance_multiplier
 
 
-    def _evaluate_observation(self, obs):
+    def _evaluate_observation(self):
+        """
+        Evaluates the state observed after a step, reads it from the env instead of the observation
+        so it works the same with the Dict and the flat observations
+        """
 
         reward = 0
+        steps_count = len(self.path) - 1
+        steps_tolerance = self.steps_tolerance
 
         # if we exceed the amount of steps done in the shortest_path
         # start taking off rewards. Will be a few points at the beggining
         # but it will increase over time.
-        if obs['steps_count'] > obs['steps_tolerance']:
-            exceeded_steps = obs['steps_count'] - obs['steps_tolerance']
+        if steps_count > steps_tolerance:
+            exceeded_steps = steps_count - steps_tolerance
             if exceeded_steps > 0: reward -= exceeded_steps # More steps means even less reward
 
         # Reward the agent if it travels in a low speed limit highway
-        if obs['previous_step']['maxspeed'] < 40: reward += 3
+        if self.previous_step['maxspeed'] < 40: reward += 3
 
         #0: no cycleway, 1: unsafe cycleway, 2: safe cycle_way
-        if obs['previous_step']['cycleway_level'] == 1: reward += 2
-        elif obs['previous_step']['cycleway_level'] == 2: reward += 4
+        if self.previous_step['cycleway_level'] == 1: reward += 2
+        elif self.previous_step['cycleway_level'] == 2: reward += 4
 
         # Reward if distance_to_destination is getting smaller
-        if obs['distance_to_destination'] < get_distance_between_nodes(
-            self.graph, self.path[-2], self.destination_node
-        ): reward += 20
+        if self.distance_to_destination < self.previous_distance_to_destination: reward += 20
         else: reward -= 10
 
         # if it's heading in the direction of the destination
         # relative_bearing(to the destination) == orientation
         # max_reward = 15, min_reward = -15
         reward += self._calculate_reward_based_on_orientation(
-            obs['previous_step']['relative_bearing']
+            self.previous_step['relative_bearing']
         )
 
-        reward += self._get_reward_base_on_proximity_to_crime_points(obs['closest_crime_points'])
+        reward += self._get_reward_base_on_proximity_to_crime_points(self.closest_crime_points_distances)
 
         # Episode Termination conditions
         if self.current_node == self.destination_node:
@@ -439,12 +599,12 @@ class BikeRouterEnv(Env):
             reward += 200
             terminated = True
         # If revisiting node
-        elif len(self.path) > 1 and obs['previous_step']['end_node_visited_status'] == 1: 
+        elif len(self.path) > 1 and self.previous_step['end_node_visited_status'] == 1: 
             self.revisiting = True
             reward -= 100
             terminated = True
         # If it's going too far away
-        elif obs['distance_to_destination'] > self.distance_origin_destination * self.distance_tolerance_multiplier:
+        elif self.distance_to_destination > self.distance_origin_destination * self.distance_tolerance_multiplier:
             self.went_too_far = True
             reward -= 100
             terminated = True
@@ -457,6 +617,7 @@ class BikeRouterEnv(Env):
             path_to_dest = get_shortest_path(self.graph, self.path[-1], self.destination_node)
             self.path.pop(-1)
             self.path += path_to_dest
+            self.visited_nodes.update(path_to_dest)
             self.arrived = True
 
         # Meaning that the episode got stuck (not supported)
@@ -489,35 +650,40 @@ class BikeRouterEnv(Env):
                 path_to_dest = get_shortest_path(self.graph, self.path[-1], self.destination_node)
                 self.path.pop(-1)
                 self.path += path_to_dest
+                self.visited_nodes.update(path_to_dest)
                 self.arrived = True
 
             #                obs, reward, terminated, trunc, info
-            return self._get_obs(), -100, terminated, False, self._get_info()
+            return self._observe(), -100, terminated, False, self._get_info()
         
         # Apply action
         self.current_node = self.current_node_neighbours[action]
-        self.previous_step = self._get_edge_attributes(self.path[-1], self.current_node)
+        # The path hasn't changed since the last observation, so the attributes
+        # of the chosen edge are the ones we already computed for the possible steps
+        if self.flat_observations: self.previous_step = dict(zip(FLAT_OBS_STEP_KEYS, self.possible_steps_table[action].tolist()))
+        else: self.previous_step = self.possible_steps[action]
         self.path.append(self.current_node)
+        self.visited_nodes.add(self.current_node)
+        # Same as the distance from `self.path[-2]` to the destination, computed on the last observation
+        self.previous_distance_to_destination = self.distance_to_destination
 
         # Adding to the traveled distance
-        # btw, self.path[-1] == self.current_node
-        last_edge_length = self.graph[self.path[-2]][self.path[-1]][0]['length']
+        last_edge_length = float(self.current_out_edges.length[action])
         self.traveled_distance+=last_edge_length
 
         # get the new neighbours from current node
-        self.current_node_neighbours = get_node_neighbours(self.graph, self.current_node)
+        self.current_out_edges = self.graph.out_edges(self.current_node)
+        self.current_node_neighbours = self.current_out_edges.neighbors
 
         # update the mask for possible actions
-        self.action_mask = np.array(
-            [1]*len(self.current_node_neighbours) + [0]*(self.max_actions - len(self.current_node_neighbours)),
-            dtype=np.int8
-        )
+        self.action_mask[:] = 0
+        self.action_mask[:len(self.current_node_neighbours)] = 1
 
         # Observe the resulting state after applying action
-        obs = self._get_obs()
+        obs = self._observe()
         
         # Calculates reward, verifies episode termination conditions, and more
-        reward, terminated, truncated, info = self._evaluate_observation(obs)
+        reward, terminated, truncated, info = self._evaluate_observation()
 
         return obs, reward, terminated, truncated, info
 
@@ -0,0 +1,123 @@
+import numpy as np
+import osmnx as ox
+from collections import namedtuple
+
+from bike_router_ai.edge_features import extract_edge_features
+from bike_router_ai.spatial_index import GridIndex
+from bike_router_ai.turn_geometry import extract_turn_geometry
+
+# Out edges of a node as parallel arrays, `neighbors` keeps the order of `graph.neighbors(node)`
+OutEdges = namedtuple('OutEdges', ['neighbors', 'length', 'bearing', 'cycleway_level', 'maxspeed'])
+
+
+class CompiledGraph:
+    """
+    Array backed, read-only view of a road graph (<networkx.MultiDiGraph>) for the hot paths of the env.
+
+    Nodes are remapped to indexes `0..N-1` (`node_ids[i]` is the original id of node `i`),
+    the adjacency is stored in CSR format: the out edges of node `i` are the positions `indptr[i]:indptr[i+1]`
+    of `indices` (end node index), of the parallel edge arrays `length` and `bearing`
+    and of the static features table `edge_features` (see `edge_features.EDGE_FEATURES_DTYPE`)
+    and the turn geometry table `turn_geometry` (see `turn_geometry.TURN_GEOMETRY_DTYPE`),
+    whose name ids are the indexes of `street_names` (`street_name_ids` is the reverse mapping).
+    Parallel edges are collapsed into the edge with key `0`, same as `graph[u][v][0]`.
+    `nodes_grid_index` is a <GridIndex> of the node coordinates for radius queries.
+    """
+
+    def __init__(self, node_ids, lat, lon, indptr, indices, length, bearing, edge_features, turn_geometry, street_name_ids):
+        self.node_ids = node_ids
+        self.node_index = {node: i for i, node in enumerate(node_ids.tolist())}
+        self.lat = lat
+        self.lon = lon
+        self.nodes_grid_index = GridIndex(np.column_stack((lat, lon)), cell_meters=100)
+        self.indptr = indptr
+        self.indices = indices
+        self.length = length
+        self.bearing = bearing
+        self.edge_features = edge_features
+        self.cycleway_level = edge_features['cycleway_level']
+        self.maxspeed = edge_features['maxspeed']
+        self.turn_geometry = turn_geometry
+        self.street_name_ids = street_name_ids
+        self.street_names = list(street_name_ids)
+
+    @classmethod
+    def from_graph(cls, graph):
+        node_ids = list(graph.nodes)
+        node_index = {node: i for i, node in enumerate(node_ids)}
+        lat = np.array([graph.nodes[node]['y'] for node in node_ids], dtype=np.float64)
+        lon = np.array([graph.nodes[node]['x'] for node in node_ids], dtype=np.float64)
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        indices = []
+        length = []
+        edges_attributes = []
+        for i, u in enumerate(node_ids):
+            for v, keydict in graph._adj[u].items():
+                attrs = keydict[0]
+                indices.append(node_index[v])
+                length.append(attrs['length'])
+                edges_attributes.append(attrs)
+            indptr[i+1] = len(indices)
+
+        indices = np.array(indices, dtype=np.int32)
+        sources = np.repeat(np.arange(len(node_ids)), np.diff(indptr))
+        # Bearing of the straight line u -> v, same as `graph_utils.get_edge_bearing`
+        bearing = ox.bearing.calculate_bearing(lat[sources], lon[sources], lat[indices], lon[indices])
+        u_latlons = np.column_stack((lat[sources], lon[sources]))
+        v_latlons = np.column_stack((lat[indices], lon[indices]))
+        street_name_ids = {}
+
+        return cls(
+            node_ids=np.array(node_ids),
+            lat=lat,
+            lon=lon,
+            indptr=indptr,
+            indices=indices,
+            length=np.array(length, dtype=np.float64),
+            bearing=np.asarray(bearing, dtype=np.float64),
+            edge_features=extract_edge_features(edges_attributes),
+            turn_geometry=extract_turn_geometry(edges_attributes, u_latlons, v_latlons, street_name_ids),
+            street_name_ids=street_name_ids,
+        )
+
+    def __contains__(self, node):
+        return node in self.node_index
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def node_latlon(self, node):
+        i = self.node_index[node]
+        return float(self.lat[i]), float(self.lon[i])
+
+    def edge_position(self, u, v):
+        """
+        Returns the position of the edge `u -> v` in the edge arrays
+        """
+        i = self.node_index[u]
+        return self.indptr[i] + self.node_ids[self.indices[self.indptr[i]:self.indptr[i+1]]].tolist().index(v)
+
+    def search_node_near(self, latlon, radius_meters):
+        """
+        Returns the first node (in graph order) closer than `radius_meters` to `latlon`, or None
+        """
+        indexes, distances = self.nodes_grid_index.query_radius(latlon, radius_meters)
+        indexes = indexes[distances < radius_meters]
+        if len(indexes) == 0: return None
+        return self.node_ids[indexes.min()].item()
+
+    def neighbors(self, node):
+        i = self.node_index[node]
+        return iter(self.node_ids[self.indices[self.indptr[i]:self.indptr[i+1]]].tolist())
+
+    def out_edges(self, node):
+        i = self.node_index[node]
+        edges = slice(self.indptr[i], self.indptr[i+1])
+        return OutEdges(
+            neighbors=self.node_ids[self.indices[edges]].tolist(),
+            length=self.length[edges],
+            bearing=self.bearing[edges],
+            cycleway_level=self.cycleway_level[edges],
+            maxspeed=self.maxspeed[edges],
+        )
@@ -0,0 +1,259 @@
+import heapq
+import hashlib
+import numpy as np
+
+from bike_router_ai.npz_files import save_npz, UNREADABLE_NPZ_ERRORS
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over the nodes of a <CompiledGraph> for length-weighted shortest path queries.
+
+    Preprocessing contracts the nodes one by one (least important first, by edge difference),
+    adding a shortcut `u -> w` with the middle node `v` whenever the only shortest path from `u` to `w`
+    goes through the contracted node `v`. Each node keeps only its edges towards more important nodes:
+    the up forward edges (`fw_*`) hold its out edges and the up backward edges (`bw_*`) its in edges (reversed), both in CSR format
+    (`*_indptr`, `*_targets`, `*_weights`, `*_middles`, middle is -1 for the original edges).
+    A query is a bidirectional Dijkstra that only goes up the hierarchy, so it settles a few hundred nodes
+    instead of the whole graph. Nodes are the indexes of the <CompiledGraph>, parallel edges use the shortest one,
+    same as `ox.distance.shortest_path`.
+    """
+
+    # Arrays persisted by `load_or_build`
+    ARRAYS = (
+        'rank',
+        'fw_indptr', 'fw_targets', 'fw_weights', 'fw_middles',
+        'bw_indptr', 'bw_targets', 'bw_weights', 'bw_middles',
+    )
+
+    def __init__(self, rank, fw_indptr, fw_targets, fw_weights, fw_middles, bw_indptr, bw_targets, bw_weights, bw_middles):
+        # Queries read these arrays as they are, so a hierarchy attached from shared memory (see <SharedEnvData>)
+        # is never copied into each process
+        self.rank = rank
+        self.fw_indptr, self.fw_targets, self.fw_weights, self.fw_middles = fw_indptr, fw_targets, fw_weights, fw_middles
+        self.bw_indptr, self.bw_targets, self.bw_weights, self.bw_middles = bw_indptr, bw_targets, bw_weights, bw_middles
+        # Memoryviews of the arrays (not copies), way faster than numpy arrays to read element by element on the query loop
+        self._rank = memoryview(np.ascontiguousarray(rank))
+        self._up_forward = tuple(memoryview(np.ascontiguousarray(array)) for array in (fw_indptr, fw_targets, fw_weights, fw_middles))
+        self._up_backward = tuple(memoryview(np.ascontiguousarray(array)) for array in (bw_indptr, bw_targets, bw_weights, bw_middles))
+
+    @staticmethod
+    def get_edges(graph, compiled_graph, weight='length'):
+        """
+        Returns `{u: {v: weight}}` with the shortest of the parallel edges `u -> v` of `graph`, as compiled graph indexes
+        """
+        node_index = compiled_graph.node_index
+        edges = {}
+        for u, v, data in graph.edges(data=True):
+            if u == v: continue
+            u, v = node_index[u], node_index[v]
+            length = data.get(weight, 1)
+            if v not in edges.setdefault(u, {}) or length < edges[u][v]: edges[u][v] = length
+        return edges
+
+    @staticmethod
+    def get_key(compiled_graph, edges):
+        key = hashlib.sha256(np.ascontiguousarray(compiled_graph.node_ids).tobytes())
+        for u in sorted(edges):
+            for v in sorted(edges[u]):
+                key.update(f'{u},{v},{edges[u][v]!r};'.encode())
+        return key.hexdigest()
+
+    @classmethod
+    def build(cls, num_nodes, edges, witness_settled_limit=100, log=False):
+        """
+        num_nodes: amount of nodes, nodes are `0..num_nodes-1`
+        edges: `{u: {v: weight}}`, see `get_edges`
+        witness_settled_limit: max nodes settled by each witness search. A witness search that stops early only
+                adds an unnecessary shortcut, so it never affects the correctness of the queries
+        """
+        out_edges = [dict() for _ in range(num_nodes)] # u -> {w: (weight, middle)} between not contracted nodes
+        in_edges = [dict() for _ in range(num_nodes)]  # w -> {u: (weight, middle)}
+        for u, targets in edges.items():
+            for v, weight in targets.items():
+                out_edges[u][v] = (weight, -1)
+                in_edges[v][u] = (weight, -1)
+
+        contracted = np.zeros(num_nodes, dtype=bool)
+        contracted_neighbors = np.zeros(num_nodes, dtype=np.int64)
+
+        def witness_distances(source, excluded, max_distance, settled_limit):
+            distances = {source: 0}
+            queue = [(0, source)]
+            settled = 0
+            while queue and settled < settled_limit:
+                dist, node = heapq.heappop(queue)
+                if dist > distances[node]: continue
+                if dist > max_distance: break
+                settled += 1
+                for neighbor, (weight, _) in out_edges[node].items():
+                    if neighbor == excluded: continue
+                    new_dist = dist + weight
+                    if new_dist < distances.get(neighbor, float('inf')):
+                        distances[neighbor] = new_dist
+                        heapq.heappush(queue, (new_dist, neighbor))
+            return distances
+
+        def get_shortcuts(v, settled_limit):
+            shortcuts = []
+            for u, (weight_uv, _) in in_edges[v].items():
+                targets = [(w, weight_uv + weight_vw) for w, (weight_vw, _) in out_edges[v].items() if w != u]
+                if not targets: continue
+                distances = witness_distances(u, v, max(weight for _, weight in targets), settled_limit)
+                for w, weight in targets:
+                    if distances.get(w, float('inf')) > weight: shortcuts.append((u, w, weight))
+            return shortcuts
+
+        def get_priority(v):
+            shortcuts = get_shortcuts(v, settled_limit=max(10, witness_settled_limit // 4))
+            return len(shortcuts) - len(in_edges[v]) - len(out_edges[v]) + contracted_neighbors[v]
+
+        queue = [(get_priority(v), v) for v in range(num_nodes)]
+        heapq.heapify(queue)
+        rank = np.zeros(num_nodes, dtype=np.int32)
+        up_forward = [None] * num_nodes  # v -> [(w, weight, middle)] with rank[w] > rank[v]
+        up_backward = [None] * num_nodes # v -> [(u, weight, middle)], edges u -> v with rank[u] > rank[v]
+        order = 0
+        while queue:
+            priority, v = heapq.heappop(queue)
+            if contracted[v]: continue
+            # Lazy update, priorities of the remaining nodes change as their neighbors are contracted
+            new_priority = get_priority(v)
+            if queue and new_priority > queue[0][0]:
+                heapq.heappush(queue, (new_priority, v))
+                continue
+
+            for u, w, weight in get_shortcuts(v, witness_settled_limit):
+                if w not in out_edges[u] or weight < out_edges[u][w][0]:
+                    out_edges[u][w] = (weight, v)
+                    in_edges[w][u] = (weight, v)
+
+            up_forward[v] = [(w, weight, middle) for w, (weight, middle) in out_edges[v].items()]
+            up_backward[v] = [(u, weight, middle) for u, (weight, middle) in in_edges[v].items()]
+            for w in out_edges[v]:
+                del in_edges[w][v]
+                contracted_neighbors[w] += 1
+            for u in in_edges[v]:
+                del out_edges[u][v]
+                contracted_neighbors[u] += 1
+            out_edges[v] = {}
+            in_edges[v] = {}
+            contracted[v] = True
+            rank[v] = order
+            order += 1
+            if log and order % 1000 == 0: print(f'Contracted {order}/{num_nodes} nodes')
+
+        return cls(rank, *cls._to_csr(up_forward), *cls._to_csr(up_backward))
+
+    @staticmethod
+    def _to_csr(adjacency):
+        indptr = np.zeros(len(adjacency) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(edges) for edges in adjacency])
+        flat = [edge for edges in adjacency for edge in edges]
+        targets = np.array([edge[0] for edge in flat], dtype=np.int32)
+        weights = np.array([edge[1] for edge in flat], dtype=np.float64)
+        middles = np.array([edge[2] for edge in flat], dtype=np.int32)
+        return indptr, targets, weights, middles
+
+    @classmethod
+    def load_or_build(cls, path, graph, compiled_graph, log=False):
+        """
+        Loads the hierarchy persisted at `path` if it was built for the same graph, otherwise builds it and saves it to `path`.
+        A hierarchy file that can't be read (eg. truncated) is built again
+        """
+        edges = cls.get_edges(graph, compiled_graph)
+        key = cls.get_key(compiled_graph, edges)
+        try:
+            with np.load(path) as data:
+                if str(data['key']) == key:
+                    return cls(*(data[name] for name in cls.ARRAYS))
+            print('Contraction hierarchy is outdated, rebuilding it...')
+        except UNREADABLE_NPZ_ERRORS:
+            print('Building contraction hierarchy...')
+
+        hierarchy = cls.build(len(compiled_graph), edges, log=log)
+        try:
+            save_npz(path, key=key, **{name: getattr(hierarchy, name) for name in cls.ARRAYS})
+        except OSError as e:
+            print(f'Could not save the contraction hierarchy to {path}: {e}')
+        return hierarchy
+
+    def query(self, sources, targets):
+        """
+        sources: `{node: initial distance}` to start the forward search from
+        targets: `{node: remaining distance}` to start the backward search from
+
+        Returns `(distance, source, target, path)` for the shortest of the paths from any of the `sources`
+        to any of the `targets`, counting their initial and remaining distances.
+        `path` is the list of nodes from `source` to `target` with the shortcuts already unpacked.
+        Returns `(inf, None, None, None)` if there is no path.
+        """
+        forward = {node: dist for node, dist in sources.items()}
+        backward = {node: dist for node, dist in targets.items()}
+        forward_parent = {node: None for node in sources}
+        backward_parent = {node: None for node in targets}
+        forward_queue = [(dist, node) for node, dist in forward.items()]
+        backward_queue = [(dist, node) for node, dist in backward.items()]
+        heapq.heapify(forward_queue)
+        heapq.heapify(backward_queue)
+
+        best = float('inf')
+        meeting_node = None
+        for node in forward.keys() & backward.keys():
+            if forward[node] + backward[node] < best: best, meeting_node = forward[node] + backward[node], node
+
+        # Each search stops once it can't find anything shorter than the best path found
+        while (forward_queue and forward_queue[0][0] < best) or (backward_queue and backward_queue[0][0] < best):
+            for queue, distances, parents, other, (indptr, up_targets, up_weights, _) in (
+                (forward_queue, forward, forward_parent, backward, self._up_forward),
+                (backward_queue, backward, backward_parent, forward, self._up_backward),
+            ):
+                if not queue or queue[0][0] >= best: continue
+                dist, node = heapq.heappop(queue)
+                if dist > distances[node]: continue
+                start, end = indptr[node], indptr[node+1]
+                for neighbor, weight in zip(up_targets[start:end], up_weights[start:end]):
+                    new_dist = dist + weight
+                    if new_dist < distances.get(neighbor, float('inf')):
+                        distances[neighbor] = new_dist
+                        parents[neighbor] = node
+                        heapq.heappush(queue, (new_dist, neighbor))
+                        if neighbor in other and new_dist + other[neighbor] < best:
+                            best, meeting_node = new_dist + other[neighbor], neighbor
+
+        if meeting_node is None: return float('inf'), None, None, None
+
+        up_path = [meeting_node]
+        while forward_parent[up_path[-1]] is not None: up_path.append(forward_parent[up_path[-1]])
+        up_path.reverse()
+        down_path = [meeting_node]
+        while backward_parent[down_path[-1]] is not None: down_path.append(backward_parent[down_path[-1]])
+
+        hierarchy_path = up_path + down_path[1:]
+        return best, hierarchy_path[0], hierarchy_path[-1], self.unpack(hierarchy_path)
+
+    def unpack(self, hierarchy_path):
+        """
+        Replaces every shortcut of a path of the hierarchy by the nodes it skips
+        """
+        path = [hierarchy_path[0]]
+        stack = list(zip(hierarchy_path[1:], hierarchy_path[:-1]))[::-1] # edges (v, u) to unpack, last edge at the bottom
+        while stack:
+            v, u = stack.pop()
+            middle = self.get_middle(u, v)
+            if middle < 0:
+                path.append(v)
+            else:
+                stack.append((v, middle))
+                stack.append((middle, u))
+        return path
+
+    def get_middle(self, u, v):
+        """
+        Returns the middle node of the shortcut `u -> v`, -1 if it's an original edge.
+        The edge is an up forward edge of `u` if `u` is less important than `v`, otherwise an up backward edge of `v`
+        """
+        if self._rank[u] < self._rank[v]: (indptr, targets, _, middles), node, target = self._up_forward, u, v
+        else: (indptr, targets, _, middles), node, target = self._up_backward, v, u
+        start, end = indptr[node], indptr[node+1]
+        return middles[start + targets[start:end].tolist().index(target)]
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pandas as pd
+
+from bike_router_ai.npz_files import save_npz, UNREADABLE_NPZ_ERRORS
+from bike_router_ai.route_cache import get_file_hash
+
+
+def get_crime_data_cache_path(excel_path):
+    return f'{os.path.splitext(excel_path)[0]}.npz'
+
+
+def convert_crime_data(excel_path, cache_path, source_hash):
+    """
+    Reads every sheet (one per district) of the crime data workbook and saves their points in a columnar cache:
+    `latlons` (N, 2) float64 array, `sheets` with the sheet name of each point and the `source_hash` of the workbook
+    """
+    crime_data = pd.read_excel(excel_path, sheet_name=None)
+    latlons = [data_frame[['latitude', 'longitude']].to_numpy(dtype=np.float64) for data_frame in crime_data.values()]
+    sheets = [np.full(len(data_frame), sheet_name) for sheet_name, data_frame in crime_data.items()]
+    latlons = np.ascontiguousarray(np.concatenate(latlons)) if latlons else np.empty((0, 2), dtype=np.float64)
+    sheets = np.concatenate(sheets) if sheets else np.empty(0, dtype=str)
+    try:
+        save_npz(cache_path, latlons=latlons, sheets=sheets, source_hash=source_hash)
+    except OSError as e:
+        print(f'Could not save the crime data cache to {cache_path}: {e}')
+    return latlons, sheets
+
+
+def load_crime_data(excel_path):
+    """
+    Returns `(latlons, sheets)`: a contiguous (N, 2) float64 array with the LATLON of every crime point
+    and an array with the sheet (district) each one comes from.
+    The workbook is only read the first time, or when it changes (or its cache can't be read),
+    afterwards the data is loaded from its cache
+    """
+    cache_path = get_crime_data_cache_path(excel_path)
+    source_hash = get_file_hash(excel_path)
+    try:
+        with np.load(cache_path) as data:
+            if str(data['source_hash']) == source_hash: return data['latlons'], data['sheets']
+    except UNREADABLE_NPZ_ERRORS:
+        pass
+    print('Converting crime data to cache...')
+    return convert_crime_data(excel_path, cache_path, source_hash)
+
+
+def get_crime_points(excel_path, sheet_name=None):
+    """
+    Returns a (N, 2) float64 array with the LATLON of the crime points of the sheet `sheet_name`,
+    or of every sheet if `sheet_name` is None
+    """
+    latlons, sheets = load_crime_data(excel_path)
+    if not sheet_name: return latlons # if none, retrieve all crime data together
+    if isinstance(sheet_name, str): # only the requested sheet
+        if sheet_name not in sheets: raise ValueError(f"Worksheet named '{sheet_name}' not found")
+        return latlons[sheets == sheet_name]
+    return np.empty((0, 2), dtype=np.float64)
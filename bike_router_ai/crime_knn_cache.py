@@ -0,0 +1,82 @@
+import hashlib
+import numpy as np
+
+from bike_router_ai.npz_files import save_npz, UNREADABLE_NPZ_ERRORS
+
+
+class CrimeKnnCache:
+    """
+    Precomputed `k` closest crime points of every node of a <CompiledGraph>.
+
+    The road graph and the crime points are static between deployments, so the closest crime points
+    of the observation only depend on the current node and can be read from `(N, k)` arrays:
+    `indexes[i]` are the positions in `crime_points_index.latlons` of the crime points closest to node `i`
+    (sorted by proximity) and `distances[i]` their distances in meters.
+    Nodes that are not part of the compiled graph (the virtual nodes inserted for a route request)
+    fall back to a query on the <GridIndex> of the crime points.
+    """
+
+    def __init__(self, compiled_graph, crime_points_index, k, indexes, distances):
+        self.compiled_graph = compiled_graph
+        self.crime_points_index = crime_points_index
+        self.k = k
+        self.indexes = indexes
+        self.distances = distances
+
+    @staticmethod
+    def get_key(compiled_graph, crime_points_index, k):
+        """
+        Hash of everything the cache depends on, a persisted cache is only reused if its key matches
+        """
+        key = hashlib.sha256()
+        for array in (compiled_graph.node_ids, compiled_graph.lat, compiled_graph.lon, crime_points_index.latlons):
+            key.update(np.ascontiguousarray(array).tobytes())
+        key.update(str(k).encode())
+        return key.hexdigest()
+
+    @classmethod
+    def build(cls, compiled_graph, crime_points_index, k):
+        k = min(k, len(crime_points_index))
+        indexes = np.empty((len(compiled_graph), k), dtype=np.int32)
+        distances = np.empty((len(compiled_graph), k), dtype=np.float64)
+        for i in range(len(compiled_graph)):
+            latlon = (compiled_graph.lat[i], compiled_graph.lon[i])
+            indexes[i], distances[i] = crime_points_index.query_knn(latlon, k)
+        return cls(compiled_graph, crime_points_index, k, indexes, distances)
+
+    @classmethod
+    def load_or_build(cls, path, compiled_graph, crime_points_index, k):
+        """
+        Loads the cache persisted at `path` if it was built for the same graph, crime points and `k`,
+        otherwise builds it and saves it to `path`. A cache that can't be read (eg. truncated) is built again
+        """
+        key = cls.get_key(compiled_graph, crime_points_index, k)
+        try:
+            with np.load(path) as data:
+                if str(data['key']) == key:
+                    return cls(compiled_graph, crime_points_index, int(data['k']), data['indexes'], data['distances'])
+            print('Closest crime points cache is outdated, rebuilding it...')
+        except UNREADABLE_NPZ_ERRORS:
+            print('Building closest crime points cache...')
+
+        cache = cls.build(compiled_graph, crime_points_index, k)
+        try:
+            cache.save(path, key)
+        except OSError as e:
+            print(f'Could not save the closest crime points cache to {path}: {e}')
+        return cache
+
+    def save(self, path, key=None):
+        if key is None: key = self.get_key(self.compiled_graph, self.crime_points_index, self.k)
+        save_npz(path, key=key, k=self.k, indexes=self.indexes, distances=self.distances)
+
+    def query(self, node, latlon):
+        """
+        Returns `(latlons, distances)`, numpy arrays with the `k` crime points closest to `node` sorted by proximity.
+        `latlon` is only used if `node` is not part of the compiled graph
+        """
+        i = self.compiled_graph.node_index.get(node)
+        if i is None:
+            indexes, distances = self.crime_points_index.query_knn(latlon, self.k)
+            return self.crime_points_index.latlons[indexes], distances
+        return self.crime_points_index.latlons[self.indexes[i]], self.distances[i]
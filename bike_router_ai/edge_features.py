@@ -0,0 +1,50 @@
+import numpy as np
+
+# Static features of an edge seen by the agent, they only depend on the edge attributes of the graph.
+# The dynamic ones (relative_bearing, end_node_visited_status) depend on the episode and are computed on each step
+EDGE_FEATURES_DTYPE = np.dtype([
+    ('cycleway_level', np.int8), # 0=none, 1=unsafe, 2=safe
+    ('maxspeed', np.int16),      # Max car speed
+])
+
+
+def get_edge_maxspeed(edge_attributes):
+    """
+    Returns the max car speed of an edge as an int, falling back to 30 for residential roads and 50 for any other road
+    """
+    if 'maxspeed' in edge_attributes:
+        maxspeed = edge_attributes['maxspeed']
+        if type(maxspeed) == type([]): # Sometimes 'maxspeed' returns as a LIST of speedlimits
+            maxspeed = maxspeed[0]
+        return int(maxspeed)
+    return 30 if edge_attributes['highway'] == 'residential' else 50
+
+
+def get_edge_cycleway_level(edge_attributes):
+    """
+    0=none, 1=unsafe, 2=safe
+    """
+    return int(edge_attributes['cycleway_level']) if 'cycleway_level' in edge_attributes else 0
+
+
+def extract_edge_features(edges_attributes):
+    """
+    edges_attributes: iterable with the attributes dict of each edge
+
+    Feature extraction stage, meant to run once when the graph is loaded.
+    Returns a table (numpy structured array of `EDGE_FEATURES_DTYPE`) with the static features of each edge, in the given order.
+    Most edges share the same raw values, so each distinct combination is only parsed once.
+    """
+    parsed = {}
+    rows = []
+    for attrs in edges_attributes:
+        maxspeed = attrs.get('maxspeed')
+        raw_key = (
+            tuple(maxspeed) if type(maxspeed) == type([]) else maxspeed,
+            attrs.get('highway') == 'residential',
+            attrs.get('cycleway_level'),
+        )
+        if raw_key not in parsed:
+            parsed[raw_key] = (get_edge_cycleway_level(attrs), get_edge_maxspeed(attrs))
+        rows.append(parsed[raw_key])
+    return np.array(rows, dtype=EDGE_FEATURES_DTYPE)
@@ -0,0 +1,72 @@
+from shapely import STRtree
+from shapely.geometry import Point
+from shapely.geometry import LineString
+
+# Degrees (about 0.1 mm), edges that much farther than the nearest one are also the nearest one
+EDGE_INDEX_TIE_DISTANCE = 1e-9
+
+
+def project_point_on_segment(latlon, a, b):
+    """
+    Returns the LATLON of the projection of `latlon` on the segment `a`--->`b`, same as `graph_utils.get_projection_point`
+    """
+    line = LineString((a, b))
+    return list(line.interpolate(line.project(Point(latlon))).coords[0])
+
+
+class EdgeIndex:
+    """
+    Long-lived spatial index (shapely <STRtree>) over the edges of a road graph (<networkx.MultiDiGraph>).
+
+    Built once per loaded graph and shared by every route request, replaces `ox.distance.nearest_edges`,
+    which rebuilds every edge geometry and a new R-tree on each call.
+    Uses the same geometries as `ox.distance.nearest_edges`, so the nearest edge is always at the same distance.
+    When several edges are equally near (eg. both directions of a two-way street) the first one in the order of
+    `graph.edges` is returned (see `EDGE_INDEX_TIE_DISTANCE`), osmnx returns any of them, so the tied edge may differ from the one of osmnx.
+    """
+
+    def __init__(self, edges, geometries, lengths):
+        self.edges = edges # (u, v, key) of each geometry
+        self.geometries = geometries
+        self.lengths = lengths
+        self.tree = STRtree(geometries)
+
+    @classmethod
+    def from_graph(cls, graph):
+        edges = []
+        geometries = []
+        lengths = []
+        for u, v, key, data in graph.edges(keys=True, data=True):
+            edges.append((u, v, key))
+            lengths.append(data['length'])
+            if 'geometry' in data:
+                geometries.append(data['geometry'])
+            else: # straight line between the nodes, same as `ox.graph_to_gdfs`
+                geometries.append(LineString([
+                    (graph.nodes[u]['x'], graph.nodes[u]['y']),
+                    (graph.nodes[v]['x'], graph.nodes[v]['y']),
+                ]))
+        return cls(edges, geometries, lengths)
+
+    def nearest_edge(self, latlon):
+        """
+        Returns the edge `(u, v, key)` nearest to `latlon`
+        """
+        return self.edges[self._nearest_position(latlon)]
+
+    def nearest_edge_offset(self, latlon):
+        """
+        Returns `(edge, offset)`: the edge `(u, v, key)` nearest to `latlon` and the distance in meters
+        from `u` to the projection of `latlon` along the edge
+        """
+        position = self._nearest_position(latlon)
+        offset = self.geometries[position].project(Point(latlon[1], latlon[0]), normalized=True) * self.lengths[position]
+        return self.edges[position], offset
+
+    def _nearest_position(self, latlon):
+        point = Point(latlon[1], latlon[0]) # geometries are in LONLAT
+        _, distance = self.tree.query_nearest(point, all_matches=False, return_distance=True)
+        # Ties go to the first edge, whatever the layout of the tree. The two directions of a street
+        # are not always exactly equidistant in floating point, so edges this close to the nearest count as tied
+        positions = self.tree.query(point, predicate='dwithin', distance=distance[0] + EDGE_INDEX_TIE_DISTANCE)
+        return int(positions.min())
@@ -0,0 +1,486 @@
+import heapq
+from collections import ChainMap
+import numpy as np
+import networkx as nx
+import osmnx as ox
+from shapely.geometry import Point
+from shapely.geometry import LineString
+
+from bike_router_ai.compiled_graph import OutEdges
+from bike_router_ai.edge_features import EDGE_FEATURES_DTYPE, extract_edge_features
+from bike_router_ai.edge_index import project_point_on_segment
+from bike_router_ai.turn_geometry import TURN_GEOMETRY_DTYPE, extract_turn_geometry
+
+# Share of the straight line distance between two nodes used as lower bound of their path length,
+# so the edge lengths rounded by osmnx never get shorter than it
+LOWER_BOUND_FACTOR = 0.99
+
+
+class GraphOverlay:
+    """
+    Read-only view of a base road graph (<networkx.MultiDiGraph>) plus a per-request layer
+    that holds the virtual nodes (origin and waypoints) and the edges created when splitting
+    the base edges they were inserted into.
+
+    `add_node`, `add_edge` and `remove_edge` only touch the overlay, so the base graph can be shared
+    by every route request and each request costs O(waypoints) extra memory instead of a copy of the whole graph.
+
+    Supports the subset of the networkx API used by `BikeRouterEnv` and `graph_utils`:
+    `graph.nodes[n]`, `graph.nodes(data=True)`, `graph.neighbors(n)`, `graph[u][v][0]`, `n in graph`.
+    Edges added on the overlay always have a single key `0`.
+
+    If the <CompiledGraph> of the base graph is given, `neighbors`, `node_latlon` and `out_edges`
+    read the nodes untouched by the overlay straight from its arrays.
+    If the <EdgeIndex> of the base graph is given, it's used to snap points to their nearest edge.
+    If the <ContractionHierarchy> of the compiled graph is given, it's used for the shortest path queries.
+    Without a base graph (`base_graph=None`) only the compiled graph and the hierarchy are read, enough for `node_latlon`,
+    `neighbors`, `out_edges` and `shortest_path` between base nodes, but no node can be inserted
+    """
+
+    def __init__(self, base_graph, compiled_graph=None, edge_index=None, hierarchy=None):
+        self.base = base_graph
+        self.compiled = compiled_graph
+        self.edge_index = edge_index
+        self.hierarchy = hierarchy
+        self.graph = base_graph.graph if base_graph is not None else {} # graph level attributes (crs, etc.)
+        self.nodes = _OverlayNodeView(self)
+
+        self.added_nodes = {}       # node_id -> node attributes
+        self.added_edges = {}       # u -> {v: {0: edge attributes}}, in insertion order
+        self.removed_edges = set()  # (u, v) edges of the base graph hidden by the overlay
+        # Nodes whose out edges differ from the base graph. Any other node can be read straight from the base graph
+        self.touched_nodes = set()
+        self.added_edge_features = {} # (u, v) -> static features of the added edge, extracted once on insertion
+        self.added_edge_turns = {}    # (u, v) -> turn geometry of the added edge, extracted once on insertion
+        # The street names of the added edges not in the compiled graph get new ids without modifying it
+        self.street_name_ids = ChainMap({}, compiled_graph.street_name_ids if compiled_graph is not None else {})
+        self._out_edges = {} # node -> <OutEdges> of the touched and virtual nodes
+
+    def __getitem__(self, u):
+        if u not in self.touched_nodes: return self.base._adj[u]
+        return _OverlayAdjacency(self, u)
+
+    def __contains__(self, node):
+        if self.base is None: return node in self.compiled
+        return node in self.added_nodes or node in self.base
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def neighbors(self, node):
+        if self.compiled is not None and node not in self.touched_nodes: return self.compiled.neighbors(node)
+        return iter(self[node])
+
+    def node_latlon(self, node):
+        if node in self.added_nodes: return self.added_nodes[node]['y'], self.added_nodes[node]['x']
+        if self.compiled is not None: return self.compiled.node_latlon(node)
+        return self.base.nodes[node]['y'], self.base.nodes[node]['x']
+
+    def out_edges(self, node):
+        """
+        Returns the <OutEdges> of `node`, see <CompiledGraph>
+        """
+        if self.compiled is not None and node not in self.touched_nodes: return self.compiled.out_edges(node)
+        if node not in self._out_edges:
+            neighbors = list(self[node])
+            lat, lon = self.node_latlon(node)
+            latlons = np.array([self.node_latlon(v) for v in neighbors], dtype=np.float64).reshape(-1, 2)
+            self._out_edges[node] = OutEdges(
+                neighbors=neighbors,
+                length=np.array([self[node][v][0]['length'] for v in neighbors], dtype=np.float64),
+                bearing=np.asarray(ox.bearing.calculate_bearing(lat, lon, latlons[:, 0], latlons[:, 1]), dtype=np.float64),
+                **self._out_edges_features(node, neighbors),
+            )
+        return self._out_edges[node]
+
+    def _out_edges_features(self, node, neighbors):
+        """
+        Static features of the out edges of a touched or virtual node, the remaining base edges are read
+        from the features table of the <CompiledGraph> and the added ones from `added_edge_features`
+        """
+        features = np.empty(len(neighbors), dtype=EDGE_FEATURES_DTYPE)
+        base_positions = {}
+        if self.compiled is not None and node in self.compiled:
+            i = self.compiled.node_index[node]
+            base_neighbors = self.compiled.node_ids[self.compiled.indices[self.compiled.indptr[i]:self.compiled.indptr[i+1]]].tolist()
+            base_positions = {v: self.compiled.indptr[i] + j for j, v in enumerate(base_neighbors)}
+        for j, v in enumerate(neighbors):
+            if (node, v) in self.added_edge_features: features[j] = self.added_edge_features[(node, v)]
+            elif v in base_positions: features[j] = self.compiled.edge_features[base_positions[v]]
+            else: features[j] = extract_edge_features([self[node][v][0]])[0] # no compiled graph given
+        return {'cycleway_level': features['cycleway_level'], 'maxspeed': features['maxspeed']}
+
+    def path_turn_geometry(self, path):
+        """
+        Returns the turn geometry (see `turn_geometry.TURN_GEOMETRY_DTYPE`) of the edges of `path`, the base edges
+        are read from the table of the <CompiledGraph> and the added ones from `added_edge_turns`
+        """
+        turns = np.empty(len(path) - 1, dtype=TURN_GEOMETRY_DTYPE)
+        base_positions = []
+        for i, (u, v) in enumerate(zip(path[:-1], path[1:])):
+            if (u, v) in self.added_edge_turns: turns[i] = self.added_edge_turns[(u, v)]
+            elif self.compiled is not None: base_positions.append((i, self.compiled.edge_position(u, v)))
+            else: turns[i] = extract_turn_geometry([self[u][v][0]], [self.node_latlon(u)], [self.node_latlon(v)], self.street_name_ids)[0]
+        if base_positions:
+            indexes, positions = zip(*base_positions)
+            turns[list(indexes)] = self.compiled.turn_geometry[list(positions)]
+        return turns
+
+    def has_edge(self, u, v):
+        return u in self and v in self[u]
+
+    def add_node(self, node_id, **attrs):
+        self.added_nodes[node_id] = attrs
+
+    def add_edge(self, u, v, **attrs):
+        self.added_edges.setdefault(u, {})[v] = {0: attrs}
+        self.added_edge_features[(u, v)] = extract_edge_features([attrs])[0]
+        self.added_edge_turns[(u, v)] = extract_turn_geometry(
+            [attrs], [self.node_latlon(u)], [self.node_latlon(v)], self.street_name_ids
+        )[0]
+        self.removed_edges.discard((u, v))
+        self.touched_nodes.add(u)
+        self._out_edges.pop(u, None)
+
+    def remove_edge(self, u, v):
+        if v in self.added_edges.get(u, {}):
+            del self.added_edges[u][v]
+            del self.added_edge_features[(u, v)]
+            del self.added_edge_turns[(u, v)]
+        elif u in self.base and v in self.base._adj[u] and (u, v) not in self.removed_edges:
+            self.removed_edges.add((u, v))
+        else:
+            raise nx.NetworkXError(f"The edge {u}-{v} is not in the graph")
+        self.touched_nodes.add(u)
+        self._out_edges.pop(u, None)
+
+    def nearest_edge(self, latlon):
+        """
+        Returns the edge `(u, v, key)` nearest to `latlon`.
+        The nearest edge is searched in the base graph, if that edge was already split by a previous
+        insertion, then the closest of the sub edges that replaced it is returned instead.
+        """
+        if self.edge_index is not None: u, v, key = self.edge_index.nearest_edge(latlon)
+        else: u, v, key = ox.distance.nearest_edges(self.base, latlon[1], latlon[0])
+        if (u, v) not in self.removed_edges: return u, v, key
+
+        chain = self._split_chain(u, v)
+        point = Point(latlon[1], latlon[0]) # geometries are in LONLAT
+        sub_edges = list(zip(chain[:-1], chain[1:]))
+        distances = [self._edge_linestring(a, b).distance(point) for a, b in sub_edges]
+        a, b = sub_edges[distances.index(min(distances))]
+        return a, b, 0
+
+    def search_node_near(self, latlon, radius_meters):
+        """
+        Returns the first node closer than `radius_meters` to `latlon`, or None.
+        Nodes are checked in the same order as `graph.nodes`: the base nodes through the grid index
+        of the <CompiledGraph>, then the virtual nodes, that are only a few per request
+        """
+        if self.compiled is not None:
+            node = self.compiled.search_node_near(latlon, radius_meters)
+            if node is not None: return node
+            nodes = (node for node in self.added_nodes if node not in self.base)
+        else:
+            nodes = iter(self.nodes)
+        for node in nodes:
+            distance = ox.distance.great_circle_vec(latlon[0], latlon[1], self.nodes[node]['y'], self.nodes[node]['x'])
+            if distance < radius_meters: return node
+        return None
+
+    def snap_to_nearest_edge(self, latlon):
+        """
+        Returns `(edge, projected_latlon)`: the edge `(u, v, key)` nearest to `latlon`
+        and the projection of `latlon` on the straight line between the nodes of that edge
+        """
+        edge = self.nearest_edge(latlon)
+        return edge, project_point_on_segment(latlon, self.node_latlon(edge[0]), self.node_latlon(edge[1]))
+
+    def _split_chain(self, u, v):
+        """
+        Returns the list of nodes `[u, virtual nodes..., v]` that replaced the base edge `(u, v)`
+        """
+        stack = [[u]]
+        while stack:
+            chain = stack.pop()
+            for neighbor in self[chain[-1]]:
+                if neighbor == v and len(chain) > 1: return chain + [v]
+                if neighbor in self.added_nodes and neighbor not in chain: stack.append(chain + [neighbor])
+        raise nx.NetworkXError(f"The edge {u}-{v} was removed but no virtual nodes replace it")
+
+    def _edge_linestring(self, u, v):
+        attrs = self[u][v][0]
+        if 'geometry' in attrs: return attrs['geometry']
+        return LineString([(self.nodes[u]['x'], self.nodes[u]['y']), (self.nodes[v]['x'], self.nodes[v]['y'])])
+
+    def shortest_path(self, origin, dest, weight='length'):
+        """
+        Length-weighted shortest path from `origin` to `dest` over the overlay.
+        Returns a list of node ids, or None if `dest` can't be reached, same as `ox.distance.shortest_path`.
+
+        Uses the <ContractionHierarchy> of the base graph if there is one, see `_hierarchy_shortest_path`,
+        otherwise runs a plain Dijkstra over the overlay
+        """
+        if origin == dest: return [origin]
+        if self.hierarchy is None or weight != 'length': return self._dijkstra_shortest_path(origin, dest, weight)
+        path = self._hierarchy_shortest_path(origin, dest)
+        if path is None: return None
+        # The hierarchy still has the base edges split by the overlay with their base length. A path only goes through one
+        # of them if its sub edges are as long or longer than the base edge, rare since the sub edges are straight lines,
+        # then the path can't be walked in the overlay and may not be the shortest one
+        if any((u, v) in self.removed_edges for u, v in zip(path[:-1], path[1:])) or len(set(path)) != len(path):
+            return self._dijkstra_shortest_path(origin, dest, weight)
+        return path
+
+    def _lower_bound(self, a, b):
+        """
+        Lower bound of the length of any path from `a` to `b`: the straight line distance between them,
+        every edge is at least as long as the straight line between its nodes (up to the rounding of osmnx)
+        """
+        (lat_a, lon_a), (lat_b, lon_b) = self.node_latlon(a), self.node_latlon(b)
+        return LOWER_BOUND_FACTOR * ox.distance.great_circle_vec(lat_a, lon_a, lat_b, lon_b)
+
+    def _get_shorter_split_edges(self, origin, dest, max_length):
+        """
+        Returns `{u: [(v, chain, length)]}` with the base edges `(u, v)` split by the overlay that got shorter
+        than in the base graph, as the `length` of the sub edges of their `chain` (see `_split_chain`).
+        Only the ones that could be part of a path from `origin` to `dest` shorter than `max_length` are returned.
+        The split edges `origin` or `dest` were inserted in are left out, `_virtual_search` goes through them
+        """
+        split_edges = {}
+        for u, v in self.removed_edges:
+            try:
+                chain = self._split_chain(u, v)
+            except nx.NetworkXError:
+                continue # removed without virtual nodes, a path through it falls back to Dijkstra anyway
+            if origin in chain or dest in chain: continue
+            length = sum(self[a][b][0]['length'] for a, b in zip(chain[:-1], chain[1:]))
+            if length >= min(attrs['length'] for attrs in self.base._adj[u][v].values()): continue
+            if self._lower_bound(origin, u) + length + self._lower_bound(v, dest) >= max_length: continue
+            split_edges.setdefault(u, []).append((v, chain, length))
+        return split_edges
+
+    def _hierarchy_shortest_path(self, origin, dest):
+        """
+        Shortest path using the <ContractionHierarchy> of the base graph for the base nodes.
+
+        The hierarchy knows nothing about the overlay, so first a small search from `origin` (and a reversed one from `dest`)
+        goes through the virtual nodes until reaching base nodes, those are the seeds of the hierarchy query
+        with their distance to `origin` (and `dest`) as initial distance.
+        Base edges split by the overlay are still part of the hierarchy with their base length. The ones that got shorter
+        are taken into account by `_split_edges_shortest_path`, the returned path may go through the other ones (see `shortest_path`)
+        """
+        reversed_added_edges = {}
+        for u, targets in self.added_edges.items():
+            for v, keydict in targets.items():
+                reversed_added_edges.setdefault(v, {})[u] = keydict
+
+        forward, forward_parents, sources = self._virtual_search(origin, self.added_edges)
+        backward, backward_parents, targets = self._virtual_search(dest, reversed_added_edges)
+        source, target = (sources, forward_parents), (targets, backward_parents)
+
+        # Paths that meet on a virtual node, eg. origin and destination inserted in the same edge
+        best, path = float('inf'), None
+        for node in forward.keys() & backward.keys():
+            if node in self.added_nodes and forward[node] + backward[node] < best:
+                best = forward[node] + backward[node]
+                path = self._parents_path(forward_parents, node)[::-1] + self._parents_path(backward_parents, node)[1:]
+
+        distance, hierarchy_path = self._hierarchy_query(source, target)
+        if distance < best: best, path = distance, hierarchy_path
+        if path is None: return None # the split edges don't connect anything the base edges didn't
+
+        split_edges = self._get_shorter_split_edges(origin, dest, best)
+        if not split_edges: return path
+        return self._split_edges_shortest_path(origin, dest, split_edges, source, target, best, path)
+
+    def _hierarchy_query(self, source, target):
+        """
+        Shortest path from `source` to `target` through the <ContractionHierarchy>, both given as `(seeds, parents)`:
+        the base nodes to start the query from with their initial distance, and the parents of the virtual search
+        that reached them (see `_virtual_search`). Returns `(distance, path)`, `(inf, None)` if there is no path
+        """
+        (sources, source_parents), (targets, target_parents) = source, target
+        node_index = self.compiled.node_index
+        distance, _, _, hierarchy_path = self.hierarchy.query(
+            {node_index[node]: dist for node, dist in sources.items()},
+            {node_index[node]: dist for node, dist in targets.items()},
+        )
+        if hierarchy_path is None: return distance, None
+        base_path = self.compiled.node_ids[hierarchy_path].tolist()
+        return distance, self._parents_path(source_parents, base_path[0])[::-1] + base_path[1:] + self._parents_path(target_parents, base_path[-1])[1:]
+
+    def _split_edges_shortest_path(self, origin, dest, split_edges, source, target, best, path):
+        """
+        Shortest path from `origin` to `dest` that may go through the `split_edges` (see `_get_shorter_split_edges`),
+        given the `best` length and `path` found by the hierarchy without them.
+
+        Dijkstra over the key nodes: `origin`, the nodes of the split edges and `dest`. A split edge `(u, v)` links `u` to `v`
+        with the length of its sub edges, `origin` and the `v` nodes are linked to `dest` and the `u` nodes by hierarchy queries,
+        only the ones that could give a path shorter than the best one found so far (see `_lower_bound`)
+        """
+        sources = {origin: source}
+        targets = {dest: target}
+        remaining = {dest: 0} # lower bound of the length from each target to `dest`
+        for u, edges in split_edges.items():
+            targets[u] = ({u: 0}, {u: None})
+            remaining[u] = min(length + self._lower_bound(v, dest) for v, _, length in edges)
+            for v, _, _ in edges: sources[v] = ({v: 0}, {v: None})
+
+        distances = {origin: 0, dest: best}
+        pieces = {dest: (origin, path)} # key node -> (previous key node, path from it)
+        queue = [(0, 0, origin), (best, 1, dest)]
+        counter = 2
+        while queue:
+            dist, _, node = heapq.heappop(queue)
+            if dist > distances[node]: continue
+            if node == dest: break
+            links = [(v, dist + length, chain) for v, chain, length in split_edges.get(node, ())]
+            if node in sources:
+                for key_node in targets:
+                    if key_node == node or (node, key_node) == (origin, dest): continue # the path without split edges is `path`
+                    lower_bound = dist + self._lower_bound(node, key_node)
+                    if lower_bound >= distances.get(key_node, float('inf')) or lower_bound + remaining[key_node] >= distances[dest]: continue
+                    distance, piece = self._hierarchy_query(sources[node], targets[key_node])
+                    if piece is not None: links.append((key_node, dist + distance, piece))
+            for key_node, new_dist, piece in links:
+                if new_dist < distances.get(key_node, float('inf')):
+                    distances[key_node] = new_dist
+                    pieces[key_node] = (node, piece)
+                    heapq.heappush(queue, (new_dist, counter, key_node))
+                    counter += 1
+
+        node, path = dest, [dest]
+        while node != origin:
+            node, piece = pieces[node]
+            path = piece + path[1:]
+        return path
+
+    def _virtual_search(self, start, added_edges):
+        """
+        Dijkstra from `start` over the `added_edges` (`u -> {v: {0: attrs}}`) that only goes through virtual nodes.
+        Returns the `distances` and `parents` of every node reached and the distances of the base nodes reached,
+        the search doesn't go beyond those
+        """
+        distances = {start: 0}
+        parents = {start: None}
+        base_nodes = {}
+        queue = [(0, 0, start)]
+        counter = 1
+        while queue:
+            dist, _, node = heapq.heappop(queue)
+            if dist > distances[node]: continue
+            if node in self.compiled:
+                base_nodes[node] = dist
+                if node != start: continue
+            for neighbor, keydict in added_edges.get(node, {}).items():
+                new_dist = dist + min(attrs['length'] for attrs in keydict.values())
+                if new_dist < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = new_dist
+                    parents[neighbor] = node
+                    heapq.heappush(queue, (new_dist, counter, neighbor))
+                    counter += 1
+        return distances, parents, base_nodes
+
+    @staticmethod
+    def _parents_path(parents, node):
+        path = [node]
+        while parents[path[-1]] is not None: path.append(parents[path[-1]])
+        return path
+
+    def _dijkstra_shortest_path(self, origin, dest, weight='length'):
+        """
+        Plain Dijkstra over the overlay, always gives the exact shortest path
+        """
+        distances = {origin: 0}
+        previous = {}
+        visited = set()
+        queue = [(0, 0, origin)]
+        counter = 1 # tie breaker so nodes never get compared
+        while queue:
+            dist, _, node = heapq.heappop(queue)
+            if node in visited: continue
+            if node == dest:
+                path = [dest]
+                while path[-1] != origin: path.append(previous[path[-1]])
+                path.reverse()
+                return path
+            visited.add(node)
+            for neighbor, keydict in self[node].items():
+                if neighbor in visited: continue
+                new_dist = dist + min(attrs.get(weight, 1) for attrs in keydict.values())
+                if new_dist < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = new_dist
+                    previous[neighbor] = node
+                    heapq.heappush(queue, (new_dist, counter, neighbor))
+                    counter += 1
+        return None
+
+
+class _OverlayNodeView:
+    """
+    Mimics `graph.nodes` of networkx for a <GraphOverlay>
+    """
+
+    def __init__(self, overlay):
+        self._overlay = overlay
+
+    def __getitem__(self, node):
+        if node in self._overlay.added_nodes: return self._overlay.added_nodes[node]
+        return self._overlay.base.nodes[node]
+
+    def __contains__(self, node):
+        return node in self._overlay
+
+    def __iter__(self):
+        yield from self._overlay.base.nodes
+        for node in self._overlay.added_nodes:
+            if node not in self._overlay.base: yield node
+
+    def __len__(self):
+        extra = sum(1 for node in self._overlay.added_nodes if node not in self._overlay.base)
+        return len(self._overlay.base.nodes) + extra
+
+    def __call__(self, data=False):
+        if not data: return iter(self)
+        return ((node, self[node]) for node in self)
+
+
+class _OverlayAdjacency:
+    """
+    Out edges of a touched node `u`, read through the overlay.
+    Keeps the same neighbor order networkx would have after applying the same insertions and removals to the graph:
+    the remaining base neighbors first, then the added ones in insertion order.
+    """
+
+    def __init__(self, overlay, u):
+        self._overlay = overlay
+        self._u = u
+
+    def _base_adj(self):
+        base = self._overlay.base
+        return base._adj[self._u] if self._u in base else {}
+
+    def _added_adj(self):
+        return self._overlay.added_edges.get(self._u, {})
+
+    def __getitem__(self, v):
+        added = self._added_adj()
+        if v in added: return added[v]
+        if (self._u, v) not in self._overlay.removed_edges: return self._base_adj()[v]
+        raise KeyError(v)
+
+    def __contains__(self, v):
+        return v in self._added_adj() or (v in self._base_adj() and (self._u, v) not in self._overlay.removed_edges)
+
+    def __iter__(self):
+        added = self._added_adj()
+        for v in self._base_adj():
+            if v not in added and (self._u, v) not in self._overlay.removed_edges: yield v
+        yield from added
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        return ((v, self[v]) for v in self)
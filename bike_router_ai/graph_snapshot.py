@@ -0,0 +1,171 @@
+"""
+Binary snapshot of a road graph (<networkx.MultiDiGraph>), loads in milliseconds instead of parsing a GraphML file.
+
+The snapshot is a npz file with:
+- `node_ids`, `edge_u`, `edge_v`, `edge_key`: the nodes and edges of the graph
+- one column per node/edge attribute (`node:<name>`, `edge:<name>`): numeric attributes are stored as typed arrays
+  with a `:present` mask, any other attribute (strings, lists) as a single JSON array with null where it's missing
+- `edge_geometry_coords` and `edge_geometry_offsets`: the LONLAT coordinates of every edge geometry, packed one after another
+- `graph_attributes`: the graph level attributes (crs, etc.) as JSON
+- `source_hash`: hash of the GraphML file the snapshot was converted from
+- `format_version`: `SNAPSHOT_FORMAT_VERSION` of the code that converted it
+- `content_hash`: hash of all of the above, changes whenever the graph changes
+
+Convert a GraphML file with:
+    python -m bike_router_ai.graph_snapshot <graph.graphml> [<graph.npz>]
+"""
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import networkx as nx
+import osmnx as ox
+import shapely
+
+from bike_router_ai.npz_files import save_npz, UNREADABLE_NPZ_ERRORS
+from bike_router_ai.route_cache import get_file_hash
+
+# Map graph of the agent
+GRAPHML_PATH = f'{os.getcwd()}/SafeRideApi/bike_router_ai/graph_SB_SI_w_cycleways_simplified.graphml'
+# Binary snapshot of the GraphML file, way faster to load
+GRAPH_SNAPSHOT_PATH = f'{os.getcwd()}/SafeRideApi/bike_router_ai/graph_SB_SI_w_cycleways_simplified.npz'
+# Version of the layout of the snapshots, the ones converted by another version are converted again
+SNAPSHOT_FORMAT_VERSION = 2
+
+
+def _get_column_type(values):
+    present = [value for value in values if value is not None]
+    if present and all(type(value) == bool for value in present): return np.bool_
+    if present and all(type(value) == int for value in present): return np.int64
+    if present and all(type(value) == float for value in present): return np.float64
+    return None # stored as JSON, also the columns that mix ints and floats so each value keeps its type
+
+
+def _add_columns(arrays, prefix, attributes_list):
+    names = []
+    for attributes in attributes_list:
+        for name in attributes:
+            if name not in names and name != 'geometry': names.append(name)
+
+    for name in names:
+        values = [attributes.get(name) for attributes in attributes_list]
+        column_type = _get_column_type(values)
+        if column_type is None:
+            arrays[f'{prefix}:{name}'] = np.array(json.dumps(values))
+        else:
+            arrays[f'{prefix}:{name}'] = np.array([0 if value is None else value for value in values], dtype=column_type)
+            arrays[f'{prefix}:{name}:present'] = np.array([value is not None for value in values], dtype=bool)
+
+
+def _read_columns(data, prefix, size):
+    columns = {}
+    for name in data.files:
+        if not name.startswith(f'{prefix}:') or name.endswith(':present'): continue
+        attribute = name[len(prefix)+1:]
+        if f'{name}:present' in data.files:
+            values = data[name].tolist()
+            present = data[f'{name}:present']
+            columns[attribute] = values if present.all() else [value if is_present else None for value, is_present in zip(values, present.tolist())]
+        else:
+            columns[attribute] = json.loads(str(data[name]))
+    return [
+        {name: values[i] for name, values in columns.items() if values[i] is not None}
+        for i in range(size)
+    ]
+
+
+def get_content_hash(arrays):
+    content_hash = hashlib.sha256()
+    for name in sorted(arrays):
+        content_hash.update(name.encode())
+        content_hash.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return content_hash.hexdigest()
+
+
+def save_graph_snapshot(graph, path, source_hash=''):
+    nodes = list(graph.nodes(data=True))
+    edges = list(graph.edges(keys=True, data=True))
+    arrays = {
+        'node_ids': np.array([node for node, _ in nodes], dtype=np.int64),
+        'edge_u': np.array([u for u, _, _, _ in edges], dtype=np.int64),
+        'edge_v': np.array([v for _, v, _, _ in edges], dtype=np.int64),
+        'edge_key': np.array([key for _, _, key, _ in edges], dtype=np.int64),
+        'graph_attributes': np.array(json.dumps(graph.graph, default=str)),
+        'source_hash': np.array(source_hash),
+        'format_version': np.array(SNAPSHOT_FORMAT_VERSION),
+    }
+    _add_columns(arrays, 'node', [data for _, data in nodes])
+    _add_columns(arrays, 'edge', [data for _, _, _, data in edges])
+
+    geometries = [data.get('geometry') for _, _, _, data in edges]
+    arrays['edge_geometry_present'] = np.array([geometry is not None for geometry in geometries], dtype=bool)
+    coords = [np.asarray(geometry.coords, dtype=np.float64).reshape(-1, 2) for geometry in geometries if geometry is not None]
+    arrays['edge_geometry_coords'] = np.concatenate(coords) if coords else np.empty((0, 2), dtype=np.float64)
+    arrays['edge_geometry_offsets'] = np.concatenate([[0], np.cumsum([len(c) for c in coords])]).astype(np.int64)
+
+    arrays['content_hash'] = np.array(get_content_hash(arrays))
+    save_npz(path, **arrays)
+    return str(arrays['content_hash'])
+
+
+def load_graph_snapshot(path):
+    """
+    Returns the <networkx.MultiDiGraph> stored in the snapshot at `path`,
+    same as the graph returned by `ox.load_graphml` for the GraphML file it was converted from
+    """
+    with np.load(path) as data:
+        node_ids = data['node_ids'].tolist()
+        edge_u = data['edge_u'].tolist()
+        edge_v = data['edge_v'].tolist()
+        edge_key = data['edge_key'].tolist()
+        nodes_attributes = _read_columns(data, 'node', len(node_ids))
+        edges_attributes = _read_columns(data, 'edge', len(edge_u))
+
+        # Every geometry is built in a single vectorized call
+        coords = data['edge_geometry_coords']
+        offsets = data['edge_geometry_offsets']
+        geometry_present = np.flatnonzero(data['edge_geometry_present'])
+        if len(geometry_present):
+            geometries = shapely.linestrings(coords, indices=np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)))
+            for i, geometry in zip(geometry_present.tolist(), geometries):
+                edges_attributes[i]['geometry'] = geometry
+
+        graph = nx.MultiDiGraph(**json.loads(str(data['graph_attributes'])))
+
+    graph.add_nodes_from(zip(node_ids, nodes_attributes))
+    graph.add_edges_from(zip(edge_u, edge_v, edge_key, edges_attributes))
+    return graph
+
+
+def get_graph_snapshot_hash(path, key='content_hash'):
+    with np.load(path) as data:
+        return str(data[key])
+
+
+def ensure_graph_snapshot(graphml_path, snapshot_path):
+    """
+    Converts the GraphML file at `graphml_path` into a snapshot at `snapshot_path`,
+    unless the snapshot was already converted from the same GraphML file by the current `SNAPSHOT_FORMAT_VERSION`.
+    A snapshot that can't be read (eg. truncated) is converted again.
+    If there is no GraphML file, the snapshot is used as it is
+    """
+    try:
+        source_hash = get_file_hash(graphml_path)
+    except FileNotFoundError:
+        return
+    try:
+        with np.load(snapshot_path) as data:
+            if str(data['source_hash']) == source_hash and int(data['format_version']) == SNAPSHOT_FORMAT_VERSION: return
+    except UNREADABLE_NPZ_ERRORS:
+        pass
+    print('Converting map graph to snapshot...')
+    save_graph_snapshot(ox.load_graphml(graphml_path), snapshot_path, source_hash)
+
+
+if __name__ == '__main__':
+    graphml_path = sys.argv[1]
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else graphml_path.rsplit('.', 1)[0] + '.npz'
+    content_hash = save_graph_snapshot(ox.load_graphml(graphml_path), snapshot_path, get_file_hash(graphml_path))
+    print(f'Saved {snapshot_path} ({content_hash})')
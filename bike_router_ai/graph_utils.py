@@ -6,6 +6,10 @@ import math
 from shapely.geometry import Point
 from shapely.geometry import LineString
 from copy import deepcopy
+from bike_router_ai.graph_overlay import GraphOverlay
+from bike_router_ai.compiled_graph import CompiledGraph
+from bike_router_ai.graph_snapshot import load_graph_snapshot
+from bike_router_ai.turn_geometry import get_edge_points, extract_turn_geometry, classify_turns
 
 configuration_completed = False
 google_maps = None
@@ -25,6 +29,10 @@ def save_graph_to_file(graph, path):
 
 
 def load_graph_from_file(path):
+    """
+    Loads a graph from a GraphML file, or from a snapshot if `path` is a `.npz` file (see `graph_snapshot`)
+    """
+    if path.endswith('.npz'): return load_graph_snapshot(path)
     return ox.load_graphml(path)
 
 
@@ -38,13 +46,19 @@ def get_max_node_neighbors(graph):
     return max_n
 
 
+def get_node_latlon(graph, node):
+    """
+    Returns the (lat, lon) of a node. Reads it from the compiled arrays
+    when `graph` is a <CompiledGraph> or a <GraphOverlay> instead of a networkx graph
+    """
+    if isinstance(graph, (GraphOverlay, CompiledGraph)): return graph.node_latlon(node)
+    return graph.nodes[node]['y'], graph.nodes[node]['x']
+
+
 def get_distance_between_nodes(graph, node1, node2):
-    return ox.distance.great_circle_vec(
-        graph.nodes[node1]['y'],
-        graph.nodes[node1]['x'],
-        graph.nodes[node2]['y'],
-        graph.nodes[node2]['x']
-    )
+    lat1, lon1 = get_node_latlon(graph, node1)
+    lat2, lon2 = get_node_latlon(graph, node2)
+    return ox.distance.great_circle_vec(lat1, lon1, lat2, lon2)
 
 
 def calculate_edge_relative_bearing(graph, u, v, ref):
@@ -58,18 +72,9 @@ def calculate_edge_relative_bearing(graph, u, v, ref):
     Given a graph edge `(u,v)`, calculates the relative bearing angle in degrees to the reference node `ref`
     """
     
-    bearing_u_v = ox.bearing.calculate_bearing(
-        graph.nodes[u]['y'],
-        graph.nodes[u]['x'],
-        graph.nodes[v]['y'],
-        graph.nodes[v]['x']
-    )
-    bearing_u_ref = ox.bearing.calculate_bearing(
-        graph.nodes[u]['y'],
-        graph.nodes[u]['x'],
-        graph.nodes[ref]['y'],
-        graph.nodes[ref]['x']
-    )
+    u_lat, u_lon = get_node_latlon(graph, u)
+    bearing_u_v = ox.bearing.calculate_bearing(u_lat, u_lon, *get_node_latlon(graph, v))
+    bearing_u_ref = ox.bearing.calculate_bearing(u_lat, u_lon, *get_node_latlon(graph, ref))
     relative_bearing = bearing_u_v - bearing_u_ref
     relative_bearing = (relative_bearing + 360) % 360
     return relative_bearing
@@ -104,12 +109,7 @@ def calculate_line_relative_bearing_to_point(line_start, line_end, ref_point):
 
 
 def get_edge_bearing(graph, node1, node2):
-    return ox.bearing.calculate_bearing(
-        graph.nodes[node1]['y'],
-        graph.nodes[node1]['x'],
-        graph.nodes[node2]['y'],
-        graph.nodes[node2]['x']
-    )
+    return ox.bearing.calculate_bearing(*get_node_latlon(graph, node1), *get_node_latlon(graph, node2))
 
 def compute_bearing_between_points(point1, point2):
     return ox.bearing.calculate_bearing(
@@ -218,10 +218,7 @@ def plot_graph(graph, highlighted_nodes=[], highlighted_edges=[], path=None, sho
     )
 
 def get_node_neighbours(graph, node):
-    steps = []
-    for neighbor in graph.neighbors(node):
-        steps.append(neighbor)
-    return steps
+    return list(graph.neighbors(node))
 
 
 def get_node_coordinates(graph, nodes, coords_format='latlon'):
@@ -231,12 +228,14 @@ def get_node_coordinates(graph, nodes, coords_format='latlon'):
     """
 
     if type(nodes) != type([]): # if nodes isnt a list, so its a single node
-        return [graph.nodes[nodes]['x'], graph.nodes[nodes]['y']] if coords_format=='lonlat' else [graph.nodes[nodes]['y'], graph.nodes[nodes]['x']]
+        lat, lon = get_node_latlon(graph, nodes)
+        return [lon, lat] if coords_format=='lonlat' else [lat, lon]
     
     coordinates_list = []
     for node in nodes:
-        if coords_format=='lonlat': coords = [graph.nodes[node]['x'], graph.nodes[node]['y']]
-        else: coords = [graph.nodes[node]['y'], graph.nodes[node]['x']]
+        lat, lon = get_node_latlon(graph, node)
+        if coords_format=='lonlat': coords = [lon, lat]
+        else: coords = [lat, lon]
         coordinates_list.append(coords)
 
     return coordinates_list
@@ -485,10 +484,11 @@ def generate_route_directions(graph, path, coords_format='latlon'):
     for i, node in enumerate(path):
         if i < len(path)-1:
             attrs = graph[node][path[i+1]][0]
-            if 'name' not in attrs: attrs['name'] = "Unknown"
-            if i == 0: current_street_name = attrs['name']
+            # Not setting it in attrs since the graph is shared between requests and must stay read-only
+            street_name = attrs.get('name', "Unknown")
+            if i == 0: current_street_name = street_name
             
-            if attrs['name'] != current_street_name: # means that we have reached a new direction
+            if street_name != current_street_name: # means that we have reached a new direction
                 previous_point = street_coords[-1]
                 current_edge_points = convert_edge_to_coordinates(
                     graph,
@@ -525,7 +525,7 @@ def generate_route_directions(graph, path, coords_format='latlon'):
                     }
                 )
                 polyline_index = directions[-1]['covered_polyline_points_indexes'][-1] + 1
-                current_street_name = attrs['name']
+                current_street_name = street_name
                 street_coords = []
                 covered_edges_indexes = []
 
@@ -552,6 +552,98 @@ def generate_route_directions(graph, path, coords_format='latlon'):
     return directions
 
 
+def get_path_turn_geometry(graph, path):
+    """
+    Returns the turn geometry (see `turn_geometry.TURN_GEOMETRY_DTYPE`) of the edges of `path`,
+    precomputed for a <GraphOverlay> or computed on the fly for a plain networkx graph
+    """
+    if isinstance(graph, GraphOverlay): return graph.path_turn_geometry(path)
+    return extract_turn_geometry(
+        [graph[u][v][0] for u, v in zip(path[:-1], path[1:])],
+        [get_node_latlon(graph, node) for node in path[:-1]],
+        [get_node_latlon(graph, node) for node in path[1:]],
+        {},
+    )
+
+
+def get_path_data(graph, path, avg_speed_km_h=18):
+    """
+    graph: the graph where the nodes of the path exist
+    path: a list of node_ids from the provided graph
+
+    Returns a dict with the nodes, edges, directions, polyline points, distance and ETA of the path.
+    It only contains builtin types and has the same fields as <api.models.path.Path>,
+    so it can be sent back from a routing worker process.
+
+    Everything is built in a single pass over the edges of the path, each edge's attributes and points
+    are read once and shared by the edges, the polyline and the directions (same as `generate_route_directions`).
+    The turns where the directions end are classified at once from the precomputed turn geometry of the edges.
+    The attributes of the edges without geometry are the same dicts of the graph, so they must not be modified
+    """
+    latlons = [get_node_latlon(graph, node) for node in path]
+    edges = []
+    polyline_points = []
+    directions = []
+    distance = 0
+
+    # Edges where a new direction starts (the street name changes) and the ending action of the previous direction
+    direction_changes, ending_actions = classify_turns(get_path_turn_geometry(graph, path))
+    direction_changes = dict(zip(direction_changes, ending_actions))
+
+    current_street_name = ""
+    covered_edges_indexes = []
+    direction_start = 0 # index of the first polyline point of the current direction
+    for i in range(len(path) - 1):
+        attrs = graph[path[i]][path[i+1]][0]
+        source, target = latlons[i], latlons[i+1]
+        distance += attrs['length']
+        edge_points = get_edge_points(attrs, source)
+
+        # Not setting it in attrs since the graph is shared between requests and must stay read-only
+        street_name = attrs.get('name', "Unknown")
+        if i == 0: current_street_name = street_name
+        if i in direction_changes: # means that we have reached a new direction
+            directions.append(
+                {
+                    'ending_action': direction_changes[i],
+                    'street_name': current_street_name,
+                    'covered_edges_indexes': covered_edges_indexes,
+                    'covered_polyline_points_indexes': list(range(direction_start, len(polyline_points))),
+                }
+            )
+            direction_start = len(polyline_points)
+            current_street_name = street_name
+            covered_edges_indexes = []
+
+        covered_edges_indexes.append(i)
+        polyline_points += edge_points
+        edges.append(
+            {
+                'source': {'latitude': source[0], 'longitude': source[1]},
+                'target': {'latitude': target[0], 'longitude': target[1]},
+                'attributes': {k:v for k,v in attrs.items() if k != 'geometry'} if 'geometry' in attrs else attrs,
+            }
+        )
+
+    polyline_points.append(list(latlons[-1]))
+    directions.append(
+        {
+            'ending_action': 'arrive', # since it's the ending node of the path, it means it's the destination
+            'street_name': current_street_name,
+            'covered_edges_indexes': covered_edges_indexes,
+            'covered_polyline_points_indexes': list(range(direction_start, len(polyline_points))),
+        }
+    )
+    return {
+        'nodes': [{'latitude': lat, 'longitude': lon} for lat, lon in latlons],
+        'edges': edges,
+        'directions': directions,
+        'polyline_points': [{'latitude': point[0], 'longitude': point[1]} for point in polyline_points],
+        'distance_meters': distance,
+        'eta_seconds': distance/(avg_speed_km_h*1000/3600), #converting to m/s
+    }
+
+
 
 #Deprecated
 def get_routes_geojson_layer(graph, paths, colors, stroke_weight=5, stroke_opacity=1.0):
@@ -636,6 +728,7 @@ def plan_path(graph, ori):
     return path
 
 def get_shortest_path(graph, origin, dest):
+    if isinstance(graph, GraphOverlay): return graph.shortest_path(origin, dest)
     return ox.distance.shortest_path(graph, origin, dest)
 
 
@@ -668,6 +761,24 @@ def get_nearest_road_coordinates(latlon):
     return (lat, lon)
 
 
+def get_nearest_edge(graph, latlon):
+    """
+    Returns the edge `(u, v, key)` of the graph nearest to the point `latlon`
+    """
+    if isinstance(graph, GraphOverlay): return graph.nearest_edge(latlon)
+    return ox.distance.nearest_edges(graph, latlon[1], latlon[0])
+
+
+def snap_to_nearest_edge(graph, latlon):
+    """
+    Returns `(edge, projected_latlon)`: the edge `(u, v, key)` of the graph nearest to the point `latlon`
+    and the projection of `latlon` on that edge
+    """
+    if isinstance(graph, GraphOverlay): return graph.snap_to_nearest_edge(latlon)
+    edge = get_nearest_edge(graph, latlon)
+    return edge, get_projection_point(latlon, get_node_coordinates(graph, edge[0]), get_node_coordinates(graph, edge[1]))
+
+
 # Calculates the road node closest to the origin coordinates (lat, lon)
 def get_projection_point(target:list, a:list, b:list, coordinates_format='latlon'):
     """
@@ -722,6 +833,7 @@ def find_nodes_by_attributes(graph, attributes):
 
 
 def search_node_with_similar_coordinates(graph, node_latlon, proximity_tolerance):
+    if isinstance(graph, GraphOverlay): return graph.search_node_near(node_latlon, proximity_tolerance)
     for node in graph.nodes(data=True):
         distance = get_distance_between_points(node_latlon, (node[1]['y'], node[1]['x']))
         if distance < proximity_tolerance:
@@ -844,12 +956,7 @@ def insert_node_in_graph_v2(graph, node_id, latlon, log=False):
     
     # Getting the nearest edge
     added_edges = []
-    nearest_edge = ox.distance.nearest_edges(graph, latlon[1], latlon[0])
-    node_latlon = get_projection_point(
-        latlon,
-        get_node_coordinates(graph, nearest_edge[0]),
-        get_node_coordinates(graph, nearest_edge[1])
-    )
+    nearest_edge, node_latlon = snap_to_nearest_edge(graph, latlon)
  
     if log:
         print("\nOld origin edge data:")
@@ -0,0 +1,81 @@
+import time
+import queue
+import threading
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import Future
+from decouple import config
+
+# Max amount of observations evaluated together in a single forward pass of the policy
+PPO_MAX_BATCH_SIZE = config('PPO_MAX_BATCH_SIZE', default=64, cast=int)
+# Max milliseconds an observation waits for other episodes to join its batch
+PPO_MAX_BATCH_WAIT_MS = config('PPO_MAX_BATCH_WAIT_MS', default=2, cast=float)
+
+
+class InferenceScheduler:
+    """
+    Micro-batches the policy inference of every episode running in this process.
+
+    Episodes call `predict(obs)` from their own threads, a single scheduler thread collects the pending
+    observations for at most `max_wait_ms`, runs one batched forward pass of the PPO policy and sends
+    each action back to the episode that asked for it.
+    The batch is closed early once every active episode (see `episode()`) has sent its observation,
+    so a lone episode never waits for the time window.
+    """
+
+    def __init__(self, ppo, max_batch_size=PPO_MAX_BATCH_SIZE, max_wait_ms=PPO_MAX_BATCH_WAIT_MS):
+        assert max_batch_size >= 1, 'max_batch_size must be at least 1'
+        self.ppo = ppo
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._requests = queue.Queue()
+        self._active_episodes = 0
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def episode(self):
+        """
+        Registers an in-flight episode for as long as the context is open
+        """
+        with self._lock: self._active_episodes += 1
+        try:
+            yield
+        finally:
+            with self._lock: self._active_episodes -= 1
+
+    def predict(self, obs):
+        """
+        Returns the action chosen by the policy for `obs`, same as `ppo.predict(obs)[0]`
+        """
+        future = Future()
+        self._requests.put((obs, future))
+        return future.result()
+
+    def _collect_batch(self):
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            with self._lock: active_episodes = self._active_episodes
+            if len(batch) >= active_episodes: break # nobody else is going to join this batch
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                actions, _ = self.ppo.predict(np.stack([obs for obs, _ in batch]))
+            except Exception as e:
+                for _, future in batch: future.set_exception(e)
+                continue
+            for (_, future), action in zip(batch, actions):
+                future.set_result(action)
@@ -0,0 +1,26 @@
+import os
+import zipfile
+import tempfile
+import contextlib
+import numpy as np
+
+# Errors of `np.load` (or of reading its arrays) on a npz file that doesn't exist, is truncated or isn't a npz file.
+# The npz caches treat them as a cache miss
+UNREADABLE_NPZ_ERRORS = (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile)
+
+
+def save_npz(path, **arrays):
+    """
+    Saves `arrays` in a npz file at the exact `path` (np.savez would append .npz to it).
+
+    The file is written next to `path` with a temporary name and then renamed to `path`, so the processes
+    reading it at the same time (eg. every routing worker) either get the previous file or the new one, never a half written one
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    file = tempfile.NamedTemporaryFile(dir=directory, prefix=f'.{name}.', suffix='.tmp', delete=False)
+    try:
+        with file: np.savez(file, **arrays)
+        os.replace(file.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError): os.unlink(file.name)
+        raise
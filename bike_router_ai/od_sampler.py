@@ -0,0 +1,122 @@
+import random
+from collections import OrderedDict
+import numpy as np
+import osmnx as ox
+
+# Max distance window of the difficultie levels (see <BikeRouterEnv>), any distance is allowed above it
+OD_SAMPLER_MAX_METERS = 4000
+# Width of the distance bands of the destinations of each origin
+OD_SAMPLER_BAND_METERS = 100
+# Max destinations kept in the rings of all the origins together (int32 each, so 16 MB),
+# the rings of the origins drawn least recently are dropped to make room
+OD_SAMPLER_MAX_CACHED_DESTINATIONS = 4_000_000
+
+
+def get_distance_window(difficultie):
+    """
+    Returns the `(min, max]` distance in meters between the origin and destination of a training episode
+    for the `difficultie` level (see <BikeRouterEnv>), or None if any distance is allowed
+    """
+    if difficultie > 4: return None
+    return ((difficultie - 2)*1000 if difficultie > 1 else 0), difficultie * 1000
+
+
+class ODSampler:
+    """
+    Samples random origin and destination nodes of a <CompiledGraph> for the training episodes.
+    Same distribution as drawing a random origin and retrying random destinations until one is within
+    the distance window of the difficultie level, but a draw never retries a destination.
+
+    The rings of an origin are the nodes within `OD_SAMPLER_MAX_METERS` of it sorted by great-circle distance,
+    plus the position of the first one of each band of `OD_SAMPLER_BAND_METERS` (`band_offsets[b]` is the first node
+    at `b * OD_SAMPLER_BAND_METERS` or farther).
+    The destinations within a window are a contiguous range of the rings, only the distances of the 2 bands
+    where the range starts and ends are computed to find its exact bounds.
+
+    The rings are not precomputed, a table for every origin would take O(N^2) memory. They are computed the first time
+    an origin is drawn, in O(N log N) (the distances to every node, then sorting the ones within `OD_SAMPLER_MAX_METERS`),
+    and kept while they fit in `max_cached_destinations`, the rings of the origins drawn least recently are dropped first.
+    A draw from an origin whose rings are kept costs O(log of the nodes in a band).
+    On a graph whose nodes are all within `OD_SAMPLER_MAX_METERS` of each other the rings of about
+    `max_cached_destinations / N` origins are kept, so most draws compute the rings of their origin again.
+    """
+
+    def __init__(self, compiled_graph, max_cached_destinations=OD_SAMPLER_MAX_CACHED_DESTINATIONS):
+        self.lat = compiled_graph.lat
+        self.lon = compiled_graph.lon
+        self.node_ids = compiled_graph.node_ids
+        self.num_bands = OD_SAMPLER_MAX_METERS // OD_SAMPLER_BAND_METERS + 1
+        self.max_cached_destinations = max_cached_destinations
+        self.rings = OrderedDict() # origin index -> (destinations, band_offsets), the ones drawn least recently first
+        self.cached_destinations = 0 # destinations in `rings`
+
+    def _distances(self, origin, indexes):
+        return np.asarray(
+            ox.distance.great_circle_vec(self.lat[origin], self.lon[origin], self.lat[indexes], self.lon[indexes]),
+            dtype=np.float64
+        )
+
+    def get_rings(self, origin):
+        """
+        Returns `(destinations, band_offsets)`, the rings of the node index `origin`
+        """
+        if origin in self.rings:
+            self.rings.move_to_end(origin)
+            return self.rings[origin]
+
+        distances = self._distances(origin, slice(None))
+        distances[origin] = np.inf # the origin is never its own destination
+        destinations = np.flatnonzero(distances <= OD_SAMPLER_MAX_METERS)
+        destinations = destinations[np.argsort(distances[destinations], kind='stable')]
+        bands = distances[destinations] // OD_SAMPLER_BAND_METERS
+        band_offsets = np.searchsorted(bands, np.arange(self.num_bands + 1), side='left')
+        rings = destinations.astype(np.int32), band_offsets
+
+        while self.rings and self.cached_destinations + len(destinations) > self.max_cached_destinations:
+            dropped_destinations, _ = self.rings.popitem(last=False)[1]
+            self.cached_destinations -= len(dropped_destinations)
+        if len(destinations) <= self.max_cached_destinations:
+            self.rings[origin] = rings
+            self.cached_destinations += len(destinations)
+        return rings
+
+    def _position_after(self, origin, rings, meters):
+        """
+        Returns the position in the `rings` of `origin` of its first destination farther than `meters`
+        """
+        destinations, band_offsets = rings
+        if meters < 0: return 0
+        band = min(int(meters // OD_SAMPLER_BAND_METERS), self.num_bands - 1)
+        start, end = band_offsets[band], band_offsets[band + 1]
+        return start + np.searchsorted(self._distances(origin, destinations[start:end]), meters, side='right')
+
+    def get_destinations(self, origin, difficultie):
+        """
+        Returns the indexes of the nodes within the distance window of `difficultie` from the node index `origin`,
+        sorted by distance, or None if any node is allowed
+        """
+        window = get_distance_window(difficultie)
+        if window is None: return None
+        min_distance, max_distance = window
+        rings = self.get_rings(origin)
+        return rings[0][self._position_after(origin, rings, min_distance):self._position_after(origin, rings, max_distance)]
+
+    def sample(self, difficultie, rng=random):
+        """
+        Returns `(origin, destination)`, ids of 2 different nodes within the distance window of `difficultie`.
+        Origins without any destination in the window are discarded and drawn again
+        """
+        num_nodes = len(self.node_ids)
+        assert num_nodes >= 2, 'The graph needs at least 2 nodes to sample an origin and a destination'
+        for _ in range(num_nodes):
+            origin = rng.randrange(num_nodes)
+            destinations = self.get_destinations(origin, difficultie)
+            if destinations is None:
+                # Any other node, counting from the node after the origin and wrapping around
+                destination = (origin + 1 + rng.randrange(num_nodes - 1)) % num_nodes
+            elif len(destinations):
+                destination = destinations[rng.randrange(len(destinations))].item()
+            else:
+                continue
+            return self.node_ids[origin].item(), self.node_ids[destination].item()
+        raise ValueError(f'Could not find an origin with any destination for the difficultie {difficultie}')
@@ -0,0 +1,105 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+from decouple import config
+
+# Set to False to compute every route from scratch
+ROUTE_CACHE_ENABLED = config('ROUTE_CACHE_ENABLED', default=True, cast=bool)
+# SQLite file shared by every server process and routing worker
+ROUTE_CACHE_PATH = config('ROUTE_CACHE_PATH', default=f'{os.getcwd()}/SafeRideApi/route_cache.sqlite3')
+# Seconds a cached route is served for
+ROUTE_CACHE_TTL = config('ROUTE_CACHE_TTL', default=24 * 60 * 60, cast=float)
+# Max amount of cached routes, the least recently used ones are evicted first
+ROUTE_CACHE_MAX_ENTRIES = config('ROUTE_CACHE_MAX_ENTRIES', default=10000, cast=int)
+# Points snapped to the same edge within this distance of each other share the cached route
+ROUTE_CACHE_OFFSET_METERS = config('ROUTE_CACHE_OFFSET_METERS', default=5, cast=float)
+
+
+def get_file_hash(path):
+    """
+    Returns the sha256 hex digest of the content of the file at `path`
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_route_key(edge_index, version, origin_latlon, waypoints_latlons, offset_meters=ROUTE_CACHE_OFFSET_METERS):
+    """
+    Returns the cache key of a route: the edge each point snaps to in the base graph (see <EdgeIndex>)
+    plus its offset along that edge, quantized to `offset_meters`, and the `version` of the data used to compute it
+    """
+    points = []
+    for latlon in [origin_latlon, *waypoints_latlons]:
+        (u, v, key), offset = edge_index.nearest_edge_offset(latlon)
+        points.append(f'{u}-{v}-{key}@{int(offset // offset_meters)}')
+    return hashlib.sha256(f'{version}|{"|".join(points)}'.encode()).hexdigest()
+
+
+class RouteCache:
+    """
+    LRU cache with TTL of computed routes, stored in a SQLite file so every process on the server shares it.
+
+    Connections are opened on each call, so the cache can be used from any thread or process.
+    Every `get` refreshes the last access time of the route, once there are more than `max_entries`
+    routes, the least recently used ones get evicted. Expired routes are never served and get evicted on `put`.
+    """
+
+    def __init__(self, path=ROUTE_CACHE_PATH, ttl=ROUTE_CACHE_TTL, max_entries=ROUTE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL') # readers don't block the writer
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS routes ('
+                '   key TEXT PRIMARY KEY,'
+                '   payload BLOB NOT NULL,'
+                '   created_at REAL NOT NULL,'
+                '   accessed_at REAL NOT NULL'
+                ')'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS routes_accessed_at ON routes (accessed_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        """
+        Returns the cached route for `key`, or None if there is none or it expired
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                row = connection.execute(
+                    'SELECT payload FROM routes WHERE key = ? AND created_at > ?', (key, now - self.ttl)
+                ).fetchone()
+                if row is None: return None
+                connection.execute('UPDATE routes SET accessed_at = ? WHERE key = ?', (now, key))
+        finally:
+            connection.close()
+        return pickle.loads(row[0])
+
+    def put(self, key, route):
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO routes (key, payload, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                    (key, pickle.dumps(route, protocol=pickle.HIGHEST_PROTOCOL), now, now),
+                )
+                connection.execute('DELETE FROM routes WHERE created_at <= ?', (now - self.ttl,))
+                connection.execute(
+                    'DELETE FROM routes WHERE key IN ('
+                    '   SELECT key FROM routes ORDER BY accessed_at DESC LIMIT -1 OFFSET ?'
+                    ')',
+                    (self.max_entries,),
+                )
+        finally:
+            connection.close()
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from decouple import config
+
+# SQLite file shared by every server process, so a job can be polled from any of them
+ROUTE_JOBS_PATH = config('ROUTE_JOBS_PATH', default=f'{os.getcwd()}/SafeRideApi/route_jobs.sqlite3')
+# Seconds a job and its result are kept after it was created
+ROUTE_JOB_TTL = config('ROUTE_JOB_TTL', default=60 * 60, cast=float)
+# Max seconds a long-poll request waits for a pending job
+ROUTE_JOB_MAX_WAIT = config('ROUTE_JOB_MAX_WAIT', default=30, cast=float)
+# Threads that serialize and store the routes of the finished jobs, see `route_views.RouteViewSet._create_route_job`
+ROUTE_JOB_FINISH_THREADS = config('ROUTE_JOB_FINISH_THREADS', default=2, cast=int)
+
+
+class RouteJobStore:
+    """
+    Status and result of the asynchronous route jobs, stored in a SQLite file so every process on the server shares it.
+
+    A job is 'pending' until its route is computed, then 'done' with the route data as `result`,
+    or 'failed' with the reason as `detail`. Jobs are deleted `ttl` seconds after they were created,
+    whatever their status, expired jobs are never returned and get deleted on `create`.
+    Connections are opened on each call, so the store can be used from any thread or process.
+    """
+
+    def __init__(self, path=ROUTE_JOBS_PATH, ttl=ROUTE_JOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._initialized = False # the file is created on first use, not when the server imports the views
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with connection:
+                connection.execute('PRAGMA journal_mode=WAL') # pollers don't block the writer
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS route_jobs ('
+                    '   id TEXT PRIMARY KEY,'
+                    '   status TEXT NOT NULL,'
+                    '   result TEXT,'
+                    '   detail TEXT,'
+                    '   created_at REAL NOT NULL,'
+                    '   updated_at REAL NOT NULL'
+                    ')'
+                )
+                connection.execute('CREATE INDEX IF NOT EXISTS route_jobs_created_at ON route_jobs (created_at)')
+            self._initialized = True
+        return connection
+
+    def _execute(self, query, parameters=()):
+        connection = self._connect()
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchone()
+        finally:
+            connection.close()
+
+    def create(self):
+        """
+        Creates a new pending job and returns its id
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM route_jobs WHERE created_at <= ?', (now - self.ttl,))
+                connection.execute(
+                    'INSERT INTO route_jobs (id, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                    (job_id, 'pending', now, now),
+                )
+        finally:
+            connection.close()
+        return job_id
+
+    def finish(self, job_id, result):
+        self._execute(
+            "UPDATE route_jobs SET status = 'done', result = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id),
+        )
+
+    def fail(self, job_id, detail):
+        self._execute(
+            "UPDATE route_jobs SET status = 'failed', detail = ?, updated_at = ? WHERE id = ?",
+            (detail, time.time(), job_id),
+        )
+
+    def get(self, job_id):
+        """
+        Returns the job as `{'id', 'status', 'result', 'detail', 'created_at', 'updated_at'}`,
+        or None if there is no such job or it expired
+        """
+        row = self._execute(
+            'SELECT id, status, result, detail, created_at, updated_at FROM route_jobs WHERE id = ? AND created_at > ?',
+            (job_id, time.time() - self.ttl),
+        )
+        if row is None: return None
+        job_id, status, result, detail, created_at, updated_at = row
+        return {
+            'id': job_id,
+            'status': status,
+            'result': json.loads(result) if result is not None else None,
+            'detail': detail,
+            'created_at': created_at,
+            'updated_at': updated_at,
+        }
+
+    def wait(self, job_id, timeout, poll_interval=0.1):
+        """
+        Returns the job (see `get`) as soon as it is no longer pending, or as it is after `timeout` seconds.
+        The job may be finished by another process, so the store is polled every `poll_interval` seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] != 'pending' or time.time() >= deadline: return job
+            time.sleep(min(poll_interval, max(0, deadline - time.time())))
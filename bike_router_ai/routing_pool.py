@@ -0,0 +1,458 @@
+import os
+import time
+import queue
+import itertools
+import threading
+import collections
+import traceback
+import multiprocessing
+from concurrent.futures import Future, TimeoutError, ThreadPoolExecutor
+from decouple import config
+
+from bike_router_ai.graph_utils import get_path_data
+from bike_router_ai.graph_snapshot import GRAPHML_PATH, GRAPH_SNAPSHOT_PATH, ensure_graph_snapshot
+from bike_router_ai.route_cache import RouteCache, ROUTE_CACHE_ENABLED
+
+# Amount of worker processes computing routes, each one holds its own graph, crime data and PPO policy
+ROUTING_POOL_SIZE = config('ROUTING_POOL_SIZE', default=os.cpu_count() or 1, cast=int)
+# Amount of routes each worker computes concurrently, their policy inference gets batched together
+ROUTING_WORKER_THREADS = config('ROUTING_WORKER_THREADS', default=4, cast=int)
+# Max seconds a caller waits for a route before giving up on it
+ROUTING_JOB_TIMEOUT = config('ROUTING_JOB_TIMEOUT', default=60, cast=float)
+# Amount of synthetic routes each worker computes after loading, before taking any job
+ROUTING_WARMUP_ROUTES = config('ROUTING_WARMUP_ROUTES', default=0, cast=int)
+# Set to False to compute every leg of a route in the same worker, one after the other
+ROUTING_SPLIT_LEGS = config('ROUTING_SPLIT_LEGS', default=True, cast=bool)
+
+# Startup stages of a worker, in order. See `RoutingWorkerPool.get_status`
+WORKER_STAGES = ('libraries', 'graph', 'crime_data', 'policy', 'warmup')
+
+
+class RoutingJobError(Exception):
+    """
+    Raised when a routing worker fails computing a route. The message contains the worker's traceback
+    """
+
+
+def compute_route_legs(agent, origin_latlon, waypoints_latlons, leg_indexes=None):
+    """
+    Computes the legs of the route with the given <Agent> and yields `(leg_index, leg)` for each one as soon as
+    it is computed, where `leg` is `{'option1': path_data, 'option2': path_data}`, see `graph_utils.get_path_data`.
+    leg_indexes: Optional list with the indexes of the only legs to compute, see `Agent.predict_route_legs`
+    """
+    if leg_indexes is None: leg_indexes = range(len(waypoints_latlons))
+    for leg_index, (predicted_path, dijkstra_path, graph) in zip(leg_indexes, agent.predict_route_legs(
+        origin_latlon=origin_latlon,
+        waypoints_latlons=list(waypoints_latlons),
+        leg_indexes=list(leg_indexes),
+    )):
+        yield leg_index, {
+            'option1': get_path_data(graph, predicted_path),
+            'option2': get_path_data(graph, dijkstra_path),
+        }
+
+
+def compute_route(agent, origin_latlon, waypoints_latlons, route_cache=None):
+    """
+    Computes the route with the given <Agent> and returns the data of both options for every leg:
+    `{'option1': [path_data, ...], 'option2': [path_data, ...]}`, see `graph_utils.get_path_data`.
+    If a <RouteCache> is given, the route is served from it when it was already computed
+    """
+    if route_cache is not None:
+        key = agent.get_route_key(origin_latlon, waypoints_latlons)
+        route = route_cache.get(key)
+        if route is not None: return route
+
+    route = {'option1': [], 'option2': []}
+    for _, leg in compute_route_legs(agent, origin_latlon, waypoints_latlons):
+        route['option1'].append(leg['option1'])
+        route['option2'].append(leg['option2'])
+    if route_cache is not None: route_cache.put(key, route)
+    return route
+
+
+def _run_job(agent, route_cache, split_legs, job, results):
+    job_id, deadline, origin_latlon, waypoints_latlons, leg_index = job
+
+    # Nobody is waiting for this route anymore, so we don't spend time on it
+    if deadline is not None and time.time() > deadline:
+        results.put(('expired', job_id, None))
+        return
+
+    try:
+        if leg_index is not None: # a single leg of a route split by another worker
+            for leg in compute_route_legs(agent, origin_latlon, waypoints_latlons, leg_indexes=[leg_index]):
+                results.put(('leg', job_id, leg))
+            return
+
+        if route_cache is not None:
+            key = agent.get_route_key(origin_latlon, waypoints_latlons)
+            route = route_cache.get(key)
+            if route is not None:
+                results.put(('done', job_id, route))
+                return
+            # The legs may be computed by different workers, so the pool stores the route once it has all of them
+            results.put(('route_key', job_id, key))
+
+        leg_indexes = range(len(waypoints_latlons))
+        if split_legs:
+            # The legs don't depend on each other, every leg but the first one is queued in the pool so any free worker can take it
+            other_legs = [(job_id, deadline, origin_latlon, waypoints_latlons, other_leg_index) for other_leg_index in leg_indexes[1:]]
+            if other_legs: results.put(('queue_jobs', job_id, other_legs))
+            leg_indexes = leg_indexes[:1]
+        for leg in compute_route_legs(agent, origin_latlon, waypoints_latlons, leg_indexes):
+            results.put(('leg', job_id, leg))
+    except Exception:
+        results.put(('error', job_id, traceback.format_exc()))
+
+
+def _worker_main(worker_id, jobs, results, threads, warmup_routes, split_legs):
+    def report_stage(stage):
+        results.put(('stage', worker_id, stage))
+
+    # torch and stable_baselines3 take a while to import, so the agent module is only imported inside the worker
+    report_stage('libraries')
+    from bike_router_ai.agent import Agent
+    agent = Agent(on_stage=report_stage)
+    if warmup_routes > 0:
+        report_stage('warmup')
+        try:
+            agent.warm_up(warmup_routes)
+        except Exception:
+            print(f'Routing worker {worker_id} failed warming up:\n{traceback.format_exc()}')
+    route_cache = RouteCache() if ROUTE_CACHE_ENABLED else None
+    results.put(('ready', worker_id, None))
+
+    # The pool never sends us more jobs than `threads` at a time, see `RoutingWorkerPool._dispatch_jobs`
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            job = jobs.get()
+            if job is None: break # shutting down
+            future = executor.submit(_run_job, agent, route_cache, split_legs, job, results)
+            # Sent after every result of the job, so the pool knows one of our threads is free again
+            future.add_done_callback(lambda _, job_id=job[0]: results.put(('released', worker_id, job_id)))
+
+
+class RoutingWorkerPool:
+    """
+    Pool of pre-warmed worker processes that compute routes.
+
+    Every worker loads its own graph, crime data and PPO policy in the background as soon as the pool starts.
+    Route jobs wait in the pool until a ready worker has a free thread and are then sent to its own job queue,
+    so a slow multi-waypoint route only keeps busy the worker computing it while the rest keep serving other requests.
+    Each worker computes up to `threads_per_worker` routes at the same time so their policy
+    inference can be batched together (see <InferenceScheduler>).
+
+    With `split_legs=True` the legs of a route with several waypoints are computed by different workers
+    at the same time: the worker that takes the route computes the first leg and queues the rest,
+    and the pool merges them back in order, so the route takes about as long as its slowest leg.
+
+    A worker that dies is restarted with a new job queue (a process killed while reading a queue keeps its lock),
+    and the jobs it was sent fail right away with <RoutingJobError> instead of keeping their callers waiting until the timeout.
+
+    With `lazy=True` no worker is started until the first job is submitted or `start()` is called,
+    so importing the module that creates the pool (eg. on `manage.py` commands) costs nothing.
+    """
+
+    def __init__(
+        self,
+        size=ROUTING_POOL_SIZE,
+        threads_per_worker=ROUTING_WORKER_THREADS,
+        job_timeout=ROUTING_JOB_TIMEOUT,
+        warmup_routes=ROUTING_WARMUP_ROUTES,
+        split_legs=ROUTING_SPLIT_LEGS,
+        lazy=False,
+    ):
+        assert size >= 1, 'The routing pool needs at least one worker'
+        assert threads_per_worker >= 1, 'Every routing worker needs at least one thread'
+        self.size = size
+        self.threads_per_worker = threads_per_worker
+        self.job_timeout = job_timeout
+        self.warmup_routes = warmup_routes
+        self.split_legs = split_legs
+
+        # 'spawn' so workers don't inherit the threads and state of the web server process
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+
+        self._job_ids = itertools.count()
+        self._pending = {} # job_id -> Future
+        self._queued_jobs = collections.deque() # jobs waiting for a worker with a free thread, see `_dispatch_jobs`
+        self._routes = {} # job_id -> legs received so far of the route, see `_add_leg`
+        self._route_cache = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._started = False
+
+        self.ready_workers = set()
+        self._workers = {}
+        self._worker_queues = {} # worker_id -> queue of the jobs sent to the worker
+        self._worker_jobs = {} # worker_id -> Counter of the job ids sent to the worker and not released yet (it can take several legs of a job)
+        self._worker_stages = {} # worker_id -> {stage: 'pending' | 'loading' | 'done' | 'skipped'}
+        self._worker_started_at = {}
+        self._worker_ready_at = {}
+        if not lazy: self.start()
+
+    def start(self):
+        """
+        Starts the workers, does nothing if they were already started
+        """
+        with self._lock:
+            if self._started: return
+            self._started = True
+        # Converted once here instead of by every worker at the same time, the workers then find it up to date
+        ensure_graph_snapshot(GRAPHML_PATH, GRAPH_SNAPSHOT_PATH)
+        # Workers only read the cache, the pool stores each route once it has every leg
+        if ROUTE_CACHE_ENABLED: self._route_cache = RouteCache()
+        for worker_id in range(self.size):
+            self._start_worker(worker_id)
+
+        self._collector = threading.Thread(target=self._collect_results, daemon=True)
+        self._collector.start()
+
+    def _start_worker(self, worker_id):
+        self._worker_stages[worker_id] = {stage: 'pending' for stage in WORKER_STAGES}
+        self._worker_started_at[worker_id] = time.time()
+        self._worker_ready_at.pop(worker_id, None)
+        self._worker_queues[worker_id] = self._context.Queue()
+        self._worker_jobs[worker_id] = collections.Counter()
+        worker = self._context.Process(
+            target=_worker_main,
+            args=(worker_id, self._worker_queues[worker_id], self._results, self.threads_per_worker, self.warmup_routes, self.split_legs),
+            name=f'routing-worker-{worker_id}',
+            daemon=True,
+        )
+        worker.start()
+        self._workers[worker_id] = worker
+
+    def _set_worker_stage(self, worker_id, stage):
+        """
+        Marks `stage` as loading and every stage before it as done, `stage=None` marks every stage as done
+        """
+        stages = self._worker_stages[worker_id]
+        for name in WORKER_STAGES:
+            if name == stage:
+                stages[name] = 'loading'
+                return
+            if stages[name] != 'skipped': stages[name] = 'done'
+
+    def _collect_results(self):
+        last_health_check = time.time()
+        while not self._closed:
+            if time.time() - last_health_check >= 1:
+                self._restart_dead_workers()
+                last_health_check = time.time()
+            try:
+                kind, key, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._handle_result(kind, key, payload)
+
+    def _handle_result(self, kind, key, payload):
+        if kind == 'stage':
+            self._set_worker_stage(key, payload)
+            return
+        if kind == 'released':
+            with self._lock:
+                worker_jobs = self._worker_jobs[key]
+                worker_jobs[payload] -= 1
+                if worker_jobs[payload] <= 0: del worker_jobs[payload]
+            self._dispatch_jobs()
+            return
+        if kind == 'queue_jobs': # the other legs of a split route, ahead of the routes that didn't start yet
+            with self._lock:
+                self._queued_jobs.extendleft(reversed(payload))
+            self._dispatch_jobs()
+            return
+        if kind == 'leg':
+            self._add_leg(key, *payload)
+            return
+        if kind == 'route_key':
+            with self._lock:
+                route = self._routes.get(key)
+            if route is not None: route['key'] = payload
+            return
+        if kind == 'ready':
+            if self.warmup_routes <= 0: self._worker_stages[key]['warmup'] = 'skipped'
+            self._set_worker_stage(key, None)
+            self._worker_ready_at[key] = time.time()
+            with self._lock:
+                self.ready_workers.add(key)
+            self._dispatch_jobs()
+            return
+
+        if kind == 'done': # served from the cache
+            for leg_index, leg in enumerate(zip(payload['option1'], payload['option2'])):
+                self._add_leg(key, leg_index, {'option1': leg[0], 'option2': leg[1]})
+        elif kind == 'error': self._finish_job(key, exception=RoutingJobError(payload))
+        elif kind == 'expired': self._finish_job(key, exception=TimeoutError('The route job expired before a worker could take it'))
+
+    def _dispatch_jobs(self):
+        """
+        Sends the queued jobs, in order, to the ready workers with a free thread, the least busy one first
+        """
+        with self._lock:
+            while self._queued_jobs:
+                busy_threads = {worker_id: sum(self._worker_jobs[worker_id].values()) for worker_id in self.ready_workers}
+                free_workers = [worker_id for worker_id, busy in busy_threads.items() if busy < self.threads_per_worker]
+                if not free_workers: return
+                worker_id = min(free_workers, key=busy_threads.get)
+                job = self._queued_jobs.popleft()
+                self._worker_jobs[worker_id][job[0]] += 1
+                self._worker_queues[worker_id].put(job)
+
+    def _add_leg(self, job_id, leg_index, leg):
+        """
+        Keeps a leg of a route, calls the `on_leg` of the job (see `submit`) with every leg that is now
+        next in order and finishes the job once every leg of the route is there
+        """
+        with self._lock:
+            route = self._routes.get(job_id)
+        if route is None: return # the caller already timed out, or another leg failed
+
+        legs = route['legs']
+        legs[leg_index] = leg
+        # Legs computed by different workers can arrive in any order
+        while route['sent'] < len(legs) and legs[route['sent']] is not None:
+            if route['on_leg'] is not None: route['on_leg'](route['sent'], legs[route['sent']])
+            route['sent'] += 1
+        if route['sent'] < len(legs): return
+
+        result = {
+            'option1': [leg['option1'] for leg in legs],
+            'option2': [leg['option2'] for leg in legs],
+        }
+        if route['key'] is not None and self._route_cache is not None:
+            try:
+                self._route_cache.put(route['key'], result)
+            except Exception as e:
+                print(f'Could not store the route in the cache: {e}')
+        self._finish_job(job_id, result=result)
+
+    def _finish_job(self, job_id, result=None, exception=None):
+        with self._lock:
+            future = self._pending.pop(job_id, None)
+            self._routes.pop(job_id, None)
+        if future is None: return # the caller already timed out
+
+        if exception is None: future.set_result(result)
+        else: future.set_exception(exception)
+
+    def _restart_dead_workers(self):
+        dead_workers = [worker_id for worker_id, worker in self._workers.items() if not self._closed and not worker.is_alive()]
+        if not dead_workers: return
+
+        # Whatever a dead worker sent is already in the results queue, so the legs it computed
+        # and the jobs it released are handled before failing the jobs it still held
+        while True:
+            try:
+                kind, key, payload = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._handle_result(kind, key, payload)
+
+        for worker_id in dead_workers:
+            exitcode = self._workers[worker_id].exitcode
+            print(f'Routing worker {worker_id} died with exit code {exitcode}, restarting it...')
+            with self._lock:
+                self.ready_workers.discard(worker_id)
+                orphaned_jobs = list(self._worker_jobs[worker_id])
+            self._start_worker(worker_id)
+            for job_id in orphaned_jobs:
+                self._finish_job(job_id, exception=RoutingJobError(f'Routing worker {worker_id} died with exit code {exitcode} while computing the route'))
+
+    def is_ready(self):
+        return len(self.ready_workers) == self.size
+
+    def get_status(self):
+        """
+        Returns the startup status of the pool and of each of its workers:
+        the status of every stage (see `WORKER_STAGES`) and the seconds it took the worker to be ready
+        """
+        now = time.time()
+        workers = {}
+        for worker_id in sorted(self._workers):
+            started_at = self._worker_started_at[worker_id]
+            workers[worker_id] = {
+                'ready': worker_id in self.ready_workers,
+                'stages': dict(self._worker_stages[worker_id]),
+                'seconds': round(self._worker_ready_at.get(worker_id, now) - started_at, 3),
+            }
+        return {
+            'started': self._started,
+            'ready': self.is_ready(),
+            'ready_workers': len(self.ready_workers),
+            'size': self.size,
+            'workers': workers,
+        }
+
+    def submit(self, origin_latlon, waypoints_latlons, timeout=None, on_leg=None):
+        """
+        Queues a route job and returns a <concurrent.futures.Future> with the result of `compute_route`.
+        If no worker takes the job before `timeout` seconds, it is dropped without being computed.
+        on_leg: Optional callback, called with `(leg_index, leg)` for each leg of the route, in order,
+                as soon as it is computed (see `compute_route_legs`)
+        """
+        assert not self._closed, 'The routing pool is closed'
+        self.start()
+        timeout = self.job_timeout if timeout is None else timeout
+        future = Future()
+        job_id = next(self._job_ids)
+        with self._lock:
+            self._pending[job_id] = future
+            self._routes[job_id] = {'legs': [None] * len(waypoints_latlons), 'sent': 0, 'key': None, 'on_leg': on_leg}
+            self._queued_jobs.append((job_id, time.time() + timeout, origin_latlon, list(waypoints_latlons), None))
+        self._dispatch_jobs()
+        future.job_id = job_id
+        return future
+
+    def predict_route(self, origin_latlon, waypoints_latlons, timeout=None):
+        """
+        Computes the route in one of the workers and waits at most `timeout` seconds for it.
+        Raises <TimeoutError> if the route wasn't ready in time and <RoutingJobError> if the worker failed.
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        future = self.submit(origin_latlon, waypoints_latlons, timeout=timeout)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self._drop_job(future.job_id)
+            raise
+
+    def stream_route(self, origin_latlon, waypoints_latlons, timeout=None):
+        """
+        Computes the route in one of the workers and yields `(leg_index, leg)` for each leg as soon as
+        the worker computes it, see `compute_route_legs`. Waits at most `timeout` seconds for the whole route.
+        Raises <TimeoutError> if the route wasn't done in time and <RoutingJobError> if the worker failed.
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        legs = queue.Queue()
+        future = self.submit(
+            origin_latlon,
+            waypoints_latlons,
+            timeout=timeout,
+            on_leg=lambda leg_index, leg: legs.put((leg_index, leg)),
+        )
+        # Both callbacks run on the collector thread in the order the worker sent them, so the legs always come first
+        future.add_done_callback(lambda _: legs.put(None))
+        try:
+            while True:
+                leg = legs.get(timeout=max(0, deadline - time.time()))
+                if leg is None: break
+                yield leg
+        except queue.Empty:
+            raise TimeoutError('The route took too long to compute')
+        finally:
+            self._drop_job(future.job_id) # also when the caller stops reading the legs
+        future.result() # raises the error of the worker, if any
+
+    def _drop_job(self, job_id):
+        with self._lock:
+            self._pending.pop(job_id, None)
+            self._routes.pop(job_id, None)
+
+    def close(self):
+        self._closed = True
+        for worker_queue in self._worker_queues.values(): worker_queue.put(None)
+        for worker in self._workers.values(): worker.join(timeout=5)
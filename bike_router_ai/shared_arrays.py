@@ -0,0 +1,77 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# Offset alignment of each array inside the shared memory block
+ALIGNMENT = 64
+
+# Blocks mapped by this process. A garbage collected <SharedMemory> unmaps its block even if
+# some array still points to it, so they are kept here until they are closed explicitly
+_mapped_blocks = {}
+
+
+class SharedArrays:
+    """
+    Numpy arrays packed one after another in a single block of shared memory, so several processes
+    can read the same arrays without a copy per process.
+
+    The process that owns the arrays creates the block with `create` and sends `handle` (picklable) to the others,
+    which map the block with `attach`. Attached arrays are read-only views of the block.
+    The owner must call `unlink` once no process needs the arrays anymore, the others just `close`.
+    """
+
+    def __init__(self, shm, arrays, handle, owner):
+        self.shm = shm
+        self.arrays = arrays
+        self.handle = handle
+        self.owner = owner
+
+    @classmethod
+    def create(cls, arrays):
+        """
+        arrays: dict of name -> numpy array, copied into a new shared memory block
+        """
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            layout.append((name, array.dtype, array.shape, size))
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        _mapped_blocks[shm.name] = shm
+        shared = cls(shm, cls._views(shm, layout), (shm.name, layout), owner=True)
+        for name, array in arrays.items():
+            shared.arrays[name][...] = array
+            shared.arrays[name].flags.writeable = False
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        name, layout = handle
+        shm = _mapped_blocks.get(name) or shared_memory.SharedMemory(name=name)
+        _mapped_blocks[name] = shm
+        arrays = cls._views(shm, layout)
+        for array in arrays.values(): array.flags.writeable = False
+        return cls(shm, arrays, handle, owner=False)
+
+    @staticmethod
+    def _views(shm, layout):
+        return {
+            name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in layout
+        }
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        """
+        Unmaps the block, no array of it can be read afterwards
+        """
+        # The views must be released before the block can be closed
+        self.arrays = {}
+        _mapped_blocks.pop(self.shm.name, None)
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner: self.shm.unlink()
@@ -0,0 +1,123 @@
+import math
+import numpy as np
+import osmnx as ox
+
+METERS_PER_DEGREE = 2 * math.pi * 6371009 / 360 # same earth radius used by `ox.distance.great_circle_vec`
+
+
+class GridIndex:
+    """
+    Spatial index of a fixed set of LATLON points for k-nearest and radius queries by great-circle distance.
+
+    Points are bucketed into a regular grid of cells at least `cell_meters` wide (similar to geohash cells),
+    queries only compute distances to the points of the cells around the query point, searching ring by ring
+    until no point outside the rings already visited can be closer than the ones found.
+    The cost of a query depends on the density of points around it instead of the total amount of points.
+    """
+
+    def __init__(self, latlons, cell_meters=250):
+        self.latlons = np.asarray(latlons, dtype=np.float64).reshape(-1, 2)
+        self.cell_meters = cell_meters
+        # Ring bounds are computed with a 1% margin so the flat grid approximation never
+        # discards a point that is closer by great-circle distance
+        self._ring_meters = cell_meters * 0.99
+
+        if len(self.latlons) == 0: return
+        max_abs_lat = np.abs(self.latlons[:, 0]).max()
+        self.origin = self.latlons.min(axis=0)
+        self.cell_size = np.array([
+            cell_meters / METERS_PER_DEGREE,
+            cell_meters / (METERS_PER_DEGREE * math.cos(math.radians(min(max_abs_lat, 89.0)))),
+        ])
+
+        cells = self._cells_of(self.latlons)
+        self.min_cell = cells.min(axis=0)
+        self.max_cell = cells.max(axis=0)
+        self.cells = {}
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        cells_sorted = cells[order]
+        boundaries = np.flatnonzero(np.any(np.diff(cells_sorted, axis=0) != 0, axis=1)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(order)]):
+            self.cells[tuple(cells_sorted[start].tolist())] = np.sort(order[start:end])
+
+    def __len__(self):
+        return len(self.latlons)
+
+    def _cells_of(self, latlons):
+        return np.floor((latlons - self.origin) / self.cell_size).astype(np.int64)
+
+    def _ring(self, ci, cj, r):
+        if r == 0:
+            yield ci, cj
+            return
+        for dj in range(-r, r+1):
+            yield ci - r, cj + dj
+            yield ci + r, cj + dj
+        for di in range(-r+1, r):
+            yield ci + di, cj - r
+            yield ci + di, cj + r
+
+    def _candidates(self, ci, cj, r):
+        found = [self.cells[cell] for cell in self._ring(ci, cj, r) if cell in self.cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def _rings_around(self, latlon):
+        """
+        Yields `(r, indexes)` with the indexes of the points in the cells at ring `r` around `latlon`,
+        starting at the first ring that can contain points and ending at the last one
+        """
+        ci, cj = self._cells_of(np.asarray(latlon, dtype=np.float64).reshape(1, 2))[0].tolist()
+        first_ring = max(0, self.min_cell[0] - ci, ci - self.max_cell[0], self.min_cell[1] - cj, cj - self.max_cell[1])
+        last_ring = max(ci - self.min_cell[0], self.max_cell[0] - ci, cj - self.min_cell[1], self.max_cell[1] - cj)
+        for r in range(first_ring, last_ring + 1):
+            yield r, self._candidates(ci, cj, r)
+
+    def _distances(self, latlon, indexes):
+        points = self.latlons[indexes]
+        return np.asarray(ox.distance.great_circle_vec(latlon[0], latlon[1], points[:, 0], points[:, 1]), dtype=np.float64)
+
+    def query_knn(self, latlon, k):
+        """
+        Returns `(indexes, distances)`, numpy arrays with the `k` points closest to `latlon` sorted by distance in meters.
+        If the index has less than `k` points, all of them are returned
+        """
+        k = min(k, len(self))
+        if k == 0: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        indexes = []
+        distances = []
+        found = 0
+        for r, candidates in self._rings_around(latlon):
+            if len(candidates):
+                indexes.append(candidates)
+                distances.append(self._distances(latlon, candidates))
+                found += len(candidates)
+            # Any point not visited yet is at least `r` cells away from the query point
+            if found >= k and np.partition(np.concatenate(distances), k-1)[k-1] <= r * self._ring_meters: break
+        indexes = np.concatenate(indexes)
+        distances = np.concatenate(distances)
+        by_index = np.argsort(indexes, kind='stable') # ties are broken by point order
+        indexes, distances = indexes[by_index], distances[by_index]
+        closest = np.argsort(distances, kind='stable')[:k]
+        return indexes[closest], distances[closest]
+
+    def query_radius(self, latlon, radius_meters):
+        """
+        Returns `(indexes, distances)`, numpy arrays with the points within `radius_meters` of `latlon` sorted by distance
+        """
+        if len(self) == 0: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        indexes = []
+        distances = []
+        for r, candidates in self._rings_around(latlon):
+            if (r - 1) * self._ring_meters > radius_meters: break
+            if len(candidates):
+                indexes.append(candidates)
+                distances.append(self._distances(latlon, candidates))
+        if not indexes: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        indexes = np.concatenate(indexes)
+        distances = np.concatenate(distances)
+        within = distances <= radius_meters
+        indexes, distances = indexes[within], distances[within]
+        by_index = np.argsort(indexes, kind='stable')
+        indexes, distances = indexes[by_index], distances[by_index]
+        closest = np.argsort(distances, kind='stable')
+        return indexes[closest], distances[closest]
@@ -0,0 +1,49 @@
+import random
+import networkx as nx
+import osmnx as ox
+from shapely.geometry import LineString
+
+
+def make_grid_graph(size=8, seed=0):
+    """
+    Small road graph for the tests, a `size` x `size` grid of streets about 110 meters apart
+    with the same attributes as the OSM graphs loaded by osmnx: some oneway streets, some curved (with a geometry),
+    lengths a bit longer than the straight line between their nodes and a few `maxspeed` lists
+    """
+    rng = random.Random(seed)
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    node_id = lambda i, j: 1000 + i * size + j
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(
+                node_id(i, j),
+                y=-12.10 + i * 0.001 + rng.uniform(-2e-4, 2e-4),
+                x=-77.0 + j * 0.001 + rng.uniform(-2e-4, 2e-4),
+                street_count=4,
+            )
+
+    def add_street(u, v):
+        oneway = rng.random() < 0.3
+        a, b = graph.nodes[u], graph.nodes[v]
+        attributes = {
+            'oneway': oneway,
+            'highway': rng.choice(['residential', 'primary']),
+            'name': rng.choice(['Av. Arequipa', 'Jr. Lampa', 'Calle Uno']),
+            'length': ox.distance.great_circle_vec(a['y'], a['x'], b['y'], b['x']) * 1.05,
+            'cycleway_level': rng.choice([0, 1, 2]),
+        }
+        if rng.random() < 0.3: attributes['maxspeed'] = rng.choice(['40', ['30', '50'], '60'])
+        if rng.random() < 0.5:
+            middle = ((a['x'] + b['x']) / 2 + 1e-4, (a['y'] + b['y']) / 2 + 1e-4)
+            attributes['geometry'] = LineString([(a['x'], a['y']), middle, (b['x'], b['y'])])
+        graph.add_edge(u, v, **attributes)
+        if not oneway:
+            attributes = dict(attributes)
+            if 'geometry' in attributes: attributes['geometry'] = attributes['geometry'].reverse()
+            graph.add_edge(v, u, **attributes)
+
+    for i in range(size):
+        for j in range(size):
+            if j + 1 < size: add_street(node_id(i, j), node_id(i, j + 1))
+            if i + 1 < size: add_street(node_id(i, j), node_id(i + 1, j))
+    return graph
@@ -0,0 +1,93 @@
+import io
+import os
+import random
+import tempfile
+import unittest
+import contextlib
+import numpy as np
+import osmnx as ox
+import pandas as pd
+from gymnasium.spaces import flatten
+
+from bike_router_ai.bike_router_env import BikeRouterEnv, FLAT_OBS_NUM_POSSIBLE_STEPS
+from bike_router_ai.shared_env_data import SharedEnvData
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+class FlatObservationsTests(unittest.TestCase):
+    """
+    The flat observations must be the same as flattening the Dict observations, value for value
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        graphml_path = os.path.join(directory.name, 'graph.graphml')
+        graph = make_grid_graph()
+        # speeds out of the range of the int8 `maxspeed` Box
+        for i, (_, _, attributes) in enumerate(graph.edges(data=True)):
+            if i % 5 == 0: attributes['maxspeed'] = ['300', '200', '130'][i % 3]
+        ox.save_graphml(graph, graphml_path)
+        crime_data_excel_path = os.path.join(directory.name, 'crime_data.xlsx')
+        rng = np.random.default_rng(0)
+        pd.DataFrame({
+            'latitude': rng.uniform(-12.1, -12.093, 40),
+            'longitude': rng.uniform(-77.0, -76.993, 40),
+        }).to_excel(crime_data_excel_path, sheet_name='SB', index=False)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.dict_env = BikeRouterEnv(graphml_path=graphml_path, crime_data_excel_path=crime_data_excel_path, render_mode=None, difficultie=5)
+            cls.flat_env = BikeRouterEnv(graphml_path=graphml_path, crime_data_excel_path=crime_data_excel_path, render_mode=None, difficultie=5, flat_observations=True)
+
+    def test_same_observations(self):
+        actions = random.Random(0)
+        for episode in range(20):
+            random.seed(episode)
+            dict_obs, _ = self.dict_env.reset()
+            random.seed(episode)
+            flat_obs, _ = self.flat_env.reset()
+            terminated = False
+            while not terminated:
+                np.testing.assert_array_equal(flat_obs, flatten(self.dict_env.dict_observation_space, dict_obs))
+                # mostly valid actions, sometimes an invalid one
+                action = actions.randrange(self.dict_env.max_actions if actions.random() < 0.1 else max(1, dict_obs['num_possible_steps']))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    dict_obs, dict_reward, terminated, _, _ = self.dict_env.step(action)
+                    flat_obs, flat_reward, flat_terminated, _, _ = self.flat_env.step(action)
+                self.assertEqual(flat_reward, dict_reward)
+                self.assertEqual(flat_terminated, terminated)
+            np.testing.assert_array_equal(flat_obs, flatten(self.dict_env.dict_observation_space, dict_obs))
+
+    def test_shared_data(self):
+        shared_data = SharedEnvData.publish(self.flat_env)
+        self.addCleanup(shared_data.unlink)
+        with contextlib.redirect_stdout(io.StringIO()):
+            shared_env = BikeRouterEnv(render_mode=None, difficultie=5, flat_observations=True, shared_data=SharedEnvData.attach(shared_data.handle))
+        self.assertIsNone(shared_env.graph.base) # only the shared arrays are read
+        self.assertIsNone(shared_env.edge_index)
+
+        actions = random.Random(1)
+        for episode in range(20):
+            random.seed(episode)
+            obs, _ = self.flat_env.reset()
+            random.seed(episode)
+            shared_obs, _ = shared_env.reset()
+            self.assertEqual(shared_env.shortest_path, self.flat_env.shortest_path)
+            terminated = False
+            while not terminated:
+                np.testing.assert_array_equal(shared_obs, obs)
+                action = actions.randrange(max(1, int(obs[FLAT_OBS_NUM_POSSIBLE_STEPS])))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    obs, reward, terminated, _, _ = self.flat_env.step(action)
+                    shared_obs, shared_reward, _, _, _ = shared_env.step(action)
+                self.assertEqual(shared_reward, reward)
+            np.testing.assert_array_equal(shared_obs, obs)
+
+    def test_out_of_range_maxspeed(self):
+        self.assertEqual(BikeRouterEnv._as_int8(300).tolist(), 44)
+        self.assertEqual(BikeRouterEnv._as_int8([-1.0, 40.0, 200.0]).tolist(), [-1, 40, -56])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import random
+import unittest
+import osmnx as ox
+from shapely.geometry import Point
+
+from bike_router_ai.edge_index import EdgeIndex
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+class EdgeIndexTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.graph = make_grid_graph()
+        cls.edge_index = EdgeIndex.from_graph(cls.graph)
+        cls.edges = list(cls.graph.edges(keys=True))
+
+    def get_distance(self, edge, latlon):
+        return self.edge_index.geometries[self.edges.index(edge)].distance(Point(latlon[1], latlon[0]))
+
+    def test_same_distance_as_osmnx(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            latlon = rng.uniform(-12.1, -12.093), rng.uniform(-77.0, -76.993)
+            expected = ox.distance.nearest_edges(self.graph, latlon[1], latlon[0])
+            self.assertAlmostEqual(self.get_distance(self.edge_index.nearest_edge(latlon), latlon), self.get_distance(expected, latlon), places=12)
+
+    def test_ties_go_to_the_first_edge(self):
+        two_way_edges = [(u, v, key) for u, v, key in self.edges if (v, u, key) in self.edges and 'geometry' not in self.graph[u][v][key]]
+        for u, v, key in two_way_edges[:20]:
+            (u_lat, u_lon), (v_lat, v_lon) = (self.graph.nodes[u]['y'], self.graph.nodes[u]['x']), (self.graph.nodes[v]['y'], self.graph.nodes[v]['x'])
+            latlon = (u_lat + v_lat) / 2, (u_lon + v_lon) / 2 # on both directions of the street
+            first = min((u, v, key), (v, u, key), key=self.edges.index)
+            self.assertEqual(self.edge_index.nearest_edge(latlon), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
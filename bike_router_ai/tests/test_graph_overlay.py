@@ -0,0 +1,95 @@
+import io
+import random
+import unittest
+from unittest import mock
+import contextlib
+import networkx as nx
+
+from bike_router_ai.compiled_graph import CompiledGraph
+from bike_router_ai.contraction_hierarchy import ContractionHierarchy
+from bike_router_ai.edge_index import EdgeIndex
+from bike_router_ai.graph_overlay import GraphOverlay
+from bike_router_ai.graph_utils import insert_node_in_graph_v2
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+def to_networkx(overlay):
+    """
+    Copy of the base graph of `overlay` with its insertions and removals applied
+    """
+    graph = overlay.base.copy()
+    graph.remove_edges_from([(u, v, key) for u, v in overlay.removed_edges for key in list(graph[u][v])])
+    graph.add_nodes_from(overlay.added_nodes.items())
+    for u, targets in overlay.added_edges.items():
+        for v, keydict in targets.items(): graph.add_edge(u, v, **keydict[0])
+    return graph
+
+
+def get_path_length(graph, path):
+    return sum(min(attrs['length'] for attrs in graph[u][v].values()) for u, v in zip(path[:-1], path[1:]))
+
+
+class HierarchyShortestPathTests(unittest.TestCase):
+    """
+    `GraphOverlay.shortest_path` with a <ContractionHierarchy> must give the same paths as networkx
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.graph = make_grid_graph()
+        cls.compiled_graph = CompiledGraph.from_graph(cls.graph)
+        cls.edge_index = EdgeIndex.from_graph(cls.graph)
+        cls.hierarchy = ContractionHierarchy.build(len(cls.compiled_graph), ContractionHierarchy.get_edges(cls.graph, cls.compiled_graph))
+
+    def new_overlay(self):
+        return GraphOverlay(self.graph, self.compiled_graph, self.edge_index, self.hierarchy)
+
+    def insert_points(self, overlay, latlons):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [insert_node_in_graph_v2(overlay, 10**12 + i, latlon) for i, latlon in enumerate(latlons)]
+
+    def assert_same_shortest_paths(self, overlay, nodes):
+        graph = to_networkx(overlay)
+        for origin in nodes:
+            for dest in nodes:
+                # The sub edges of the test graph are always shorter than the edges they split,
+                # so the hierarchy must find every path without falling back to Dijkstra
+                with mock.patch.object(overlay, '_dijkstra_shortest_path', side_effect=AssertionError('fell back to Dijkstra')):
+                    path = overlay.shortest_path(origin, dest)
+                try:
+                    expected = nx.shortest_path(graph, origin, dest, weight='length')
+                except nx.NetworkXNoPath:
+                    self.assertIsNone(path)
+                    continue
+                self.assertEqual((path[0], path[-1]), (origin, dest))
+                for u, v in zip(path[:-1], path[1:]): self.assertIn(v, overlay[u])
+                self.assertAlmostEqual(get_path_length(graph, path), get_path_length(graph, expected), places=6)
+
+    def test_base_graph(self):
+        rng = random.Random(0)
+        nodes = list(self.graph.nodes)
+        self.assert_same_shortest_paths(self.new_overlay(), rng.sample(nodes, 12))
+
+    def test_inserted_points(self):
+        rng = random.Random(1)
+        for num_points in (2, 3, 5, 5, 5):
+            overlay = self.new_overlay()
+            latlons = [(rng.uniform(-12.1, -12.093), rng.uniform(-77.0, -76.993)) for _ in range(num_points)]
+            inserted = self.insert_points(overlay, latlons)
+            self.assert_same_shortest_paths(overlay, inserted + rng.sample(list(self.graph.nodes), 3))
+
+    def test_points_in_same_edge(self):
+        rng = random.Random(2)
+        straight_edges = [(u, v) for u, v, attrs in self.graph.edges(data=True) if 'geometry' not in attrs]
+        for u, v in rng.sample(straight_edges, 5):
+            overlay = self.new_overlay()
+            (u_lat, u_lon), (v_lat, v_lon) = overlay.node_latlon(u), overlay.node_latlon(v)
+            latlons = [(u_lat + (v_lat - u_lat) * t, u_lon + (v_lon - u_lon) * t) for t in (0.3, 0.7)]
+            latlons.append((rng.uniform(-12.1, -12.093), rng.uniform(-77.0, -76.993)))
+            inserted = self.insert_points(overlay, latlons)
+            self.assertEqual(len(overlay._split_chain(u, v)), 4) # both points split the same edge
+            self.assert_same_shortest_paths(overlay, inserted + [u, v])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+import osmnx as ox
+
+from bike_router_ai.graph_snapshot import ensure_graph_snapshot, load_graph_snapshot, save_graph_snapshot
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+class GraphSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.graphml_path = os.path.join(directory.name, 'graph.graphml')
+        self.snapshot_path = os.path.join(directory.name, 'graph.npz')
+        ox.save_graphml(make_grid_graph(), self.graphml_path)
+
+    def assert_same_graph(self, graph, expected):
+        self.assertEqual(graph.graph, expected.graph)
+        self.assertEqual(list(graph.nodes), list(expected.nodes))
+        for node, attributes in expected.nodes(data=True):
+            self.assert_same_attributes(graph.nodes[node], attributes)
+        self.assertEqual(list(graph.edges(keys=True)), list(expected.edges(keys=True)))
+        for u, v, key, attributes in expected.edges(keys=True, data=True):
+            self.assert_same_attributes(graph[u][v][key], attributes)
+
+    def assert_same_attributes(self, attributes, expected):
+        self.assertEqual(attributes.keys(), expected.keys())
+        for name, value in expected.items():
+            if name == 'geometry':
+                self.assertEqual(list(attributes[name].coords), list(value.coords))
+            else:
+                self.assertEqual(attributes[name], value)
+                self.assertIs(type(attributes[name]), type(value), name)
+
+    def test_round_trip(self):
+        ensure_graph_snapshot(self.graphml_path, self.snapshot_path)
+        self.assert_same_graph(load_graph_snapshot(self.snapshot_path), ox.load_graphml(self.graphml_path))
+
+    def test_mixed_int_and_float_attributes(self):
+        graph = ox.load_graphml(self.graphml_path)
+        for i, (_, _, attributes) in enumerate(graph.edges(data=True)):
+            if i % 3: attributes['speed_kph'] = 30 if i % 2 else 32.5
+        save_graph_snapshot(graph, self.snapshot_path)
+        self.assert_same_graph(load_graph_snapshot(self.snapshot_path), graph)
+
+    def test_unreadable_snapshot_is_converted_again(self):
+        ensure_graph_snapshot(self.graphml_path, self.snapshot_path)
+        with open(self.snapshot_path, 'rb') as file: content = file.read()
+        with open(self.snapshot_path, 'wb') as file: file.write(content[:len(content) // 2])
+
+        ensure_graph_snapshot(self.graphml_path, self.snapshot_path)
+        self.assert_same_graph(load_graph_snapshot(self.snapshot_path), ox.load_graphml(self.graphml_path))
+        # no temporary file is left behind
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.snapshot_path))), ['graph.graphml', 'graph.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
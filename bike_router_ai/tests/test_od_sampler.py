@@ -0,0 +1,50 @@
+import random
+import unittest
+import numpy as np
+import osmnx as ox
+
+from bike_router_ai.compiled_graph import CompiledGraph
+from bike_router_ai.od_sampler import ODSampler, get_distance_window
+from bike_router_ai.tests.graphs import make_grid_graph
+
+
+class ODSamplerTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.compiled_graph = CompiledGraph.from_graph(make_grid_graph(size=40))
+
+    def get_expected_destinations(self, origin, difficultie):
+        lat, lon = self.compiled_graph.lat, self.compiled_graph.lon
+        distances = np.asarray(ox.distance.great_circle_vec(lat[origin], lon[origin], lat, lon))
+        min_distance, max_distance = get_distance_window(difficultie)
+        destinations = np.flatnonzero((distances > min_distance) & (distances <= max_distance))
+        return set(destinations.tolist()) - {origin}
+
+    def test_destinations(self):
+        sampler = ODSampler(self.compiled_graph)
+        rng = random.Random(0)
+        for _ in range(100):
+            origin = rng.randrange(len(self.compiled_graph))
+            difficultie = rng.choice([0.3, 0.5, 1, 1.5, 2.5, 3, 4])
+            destinations = sampler.get_destinations(origin, difficultie)
+            self.assertEqual(set(destinations.tolist()), self.get_expected_destinations(origin, difficultie))
+
+    def test_bounded_cache(self):
+        num_nodes = len(self.compiled_graph)
+        sampler = ODSampler(self.compiled_graph, max_cached_destinations=5 * num_nodes)
+        rng = random.Random(1)
+        for _ in range(200):
+            origin, destination = sampler.sample(1, rng)
+            self.assertNotEqual(origin, destination)
+            self.assertLessEqual(sampler.cached_destinations, 5 * num_nodes)
+            self.assertEqual(sampler.cached_destinations, sum(len(destinations) for destinations, _ in sampler.rings.values()))
+        self.assertLessEqual(len(sampler.rings), 5)
+
+        # The rings of the origin drawn last are kept
+        origin = sampler.node_ids.tolist().index(origin)
+        self.assertEqual(next(reversed(sampler.rings)), origin)
+
+
+if __name__ == '__main__':
+    unittest.main()
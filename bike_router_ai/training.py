@@ -0,0 +1,108 @@
+"""
+Trains the PPO policy of the agent on several env workers at once, one process per worker (see <SubprocVecEnv>).
+
+The graph and crime data are loaded once by the main process and published in shared memory (see <SharedEnvData>),
+the workers attach them read-only and run their episodes on top of them, without loading the networkx graph.
+The throughput of the env workers is printed on every rollout as env steps/sec, in total and per core.
+
+Train with:
+    python -m bike_router_ai.training [--workers N] [--timesteps T] [--difficultie D] [--model <ppo.zip>] [--save <ppo.zip>]
+"""
+
+import os
+import time
+import random
+import argparse
+from functools import partial
+from decouple import config
+from stable_baselines3 import PPO
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+
+from bike_router_ai.agent import GRAPHML_PATH, GRAPH_SNAPSHOT_PATH, CRIME_DATA_PATH
+from bike_router_ai.bike_router_env import BikeRouterEnv
+from bike_router_ai.graph_snapshot import ensure_graph_snapshot
+from bike_router_ai.shared_env_data import SharedEnvData
+
+# Amount of env worker processes, each one runs its own <BikeRouterEnv>
+TRAINING_WORKERS = config('TRAINING_WORKERS', default=os.cpu_count() or 1, cast=int)
+# Where the trained policy is saved, the policy served by the agent (`agent.PPO_PATH`) is never overwritten
+TRAINED_PPO_PATH = f'{os.getcwd()}/SafeRideApi/bike_router_ai/trained_agents/ppo_trained.zip'
+
+
+def make_env(shared_data_handle, difficultie, seed):
+    """
+    Creates the env of a worker process on top of the shared graph and crime data of `shared_data_handle`
+    """
+    # The origins and destinations of the episodes are drawn with `random`, a forked worker would repeat the others
+    random.seed(seed)
+    env = BikeRouterEnv(
+        difficultie=difficultie,
+        flat_observations=True,
+        shared_data=SharedEnvData.attach(shared_data_handle),
+    )
+    env.reset(seed=seed)
+    return env
+
+
+class ThroughputCallback(BaseCallback):
+    """
+    Prints the env steps/sec of every rollout, in total and per core (each worker process runs on its own core).
+    The time of a rollout includes the forward passes of the policy for the actions of the workers
+    """
+
+    def _on_rollout_start(self):
+        self.rollout_start = time.perf_counter()
+        self.rollout_timesteps = self.num_timesteps
+
+    def _on_step(self):
+        return True
+
+    def _on_rollout_end(self):
+        steps_per_second = (self.num_timesteps - self.rollout_timesteps) / (time.perf_counter() - self.rollout_start)
+        num_workers = self.training_env.num_envs
+        cores = min(num_workers, os.cpu_count() or 1)
+        print(
+            f'Timesteps: {self.num_timesteps}  {steps_per_second:.0f} env steps/sec  '
+            f'{steps_per_second / cores:.0f} env steps/sec per core ({num_workers} workers on {cores} cores)'
+        )
+
+
+def train(num_workers=TRAINING_WORKERS, total_timesteps=100_000, difficultie=0.5, model_path=None, save_path=TRAINED_PPO_PATH, seed=0):
+    """
+    model_path: Optional trained policy to keep training, otherwise a new one is trained from scratch
+    """
+    ensure_graph_snapshot(GRAPHML_PATH, GRAPH_SNAPSHOT_PATH)
+    base_env = BikeRouterEnv(
+        graphml_path=GRAPH_SNAPSHOT_PATH,
+        crime_data_excel_path=CRIME_DATA_PATH,
+        difficultie=difficultie,
+        flat_observations=True,
+    )
+    shared_data = SharedEnvData.publish(base_env)
+    try:
+        env_fns = [partial(make_env, shared_data.handle, difficultie, seed + i) for i in range(num_workers)]
+        vec_env = SubprocVecEnv(env_fns) if num_workers > 1 else DummyVecEnv(env_fns)
+        try:
+            # The tensorboard logs of the saved policy point to the machine it was trained on
+            if model_path: model = PPO.load(model_path, env=vec_env, tensorboard_log=None)
+            else: model = PPO('MlpPolicy', vec_env, seed=seed)
+            model.learn(total_timesteps=total_timesteps, callback=ThroughputCallback(), reset_num_timesteps=not model_path)
+            model.save(save_path)
+            print(f'Saved {save_path}')
+        finally:
+            vec_env.close()
+    finally:
+        shared_data.unlink()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trains the PPO policy of the agent on several env worker processes')
+    parser.add_argument('--workers', type=int, default=TRAINING_WORKERS, help='Amount of env worker processes')
+    parser.add_argument('--timesteps', type=int, default=100_000, help='Total env steps to train for')
+    parser.add_argument('--difficultie', type=float, default=0.5, help='Difficultie level of the episodes, see <BikeRouterEnv>')
+    parser.add_argument('--model', default=None, help='Trained policy to keep training, eg. the one at agent.PPO_PATH')
+    parser.add_argument('--save', default=TRAINED_PPO_PATH, help='Where the trained policy is saved')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    train(args.workers, args.timesteps, args.difficultie, args.model, args.save, args.seed)
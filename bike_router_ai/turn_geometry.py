@@ -0,0 +1,81 @@
+import numpy as np
+import osmnx as ox
+
+# Turn geometry of an edge, used to classify the turn between 2 consecutive edges of a path (see `graph_utils.get_path_data`).
+# The turn from edge `a` to edge `b` is the relative bearing `(b.first_bearing - a.back_bearing + 360) % 360`
+TURN_GEOMETRY_DTYPE = np.dtype([
+    ('first_bearing', np.float64), # Bearing of the first segment of the edge polyline
+    ('back_bearing', np.float64),  # Bearing from the end node back to the last polyline point of the edge
+    ('name_id', np.int32),         # Street name, as an index of the street names list
+])
+
+
+def get_edge_points(attrs, u_latlon):
+    """
+    Same points as `graph_utils.convert_edge_to_coordinates` in 'latlon' for the edge with attributes `attrs`
+    starting at a node at `u_latlon`: every point of its geometry but the last one, or just `u_latlon` if it's straight
+    """
+    if 'geometry' not in attrs: return [list(u_latlon)]
+    geometry_coords = list(attrs['geometry'].coords)
+    # same check as convert_edge_to_coordinates
+    if list(u_latlon) == list(geometry_coords[-1]): geometry_coords.reverse()
+    return [[lat, lon] for lon, lat in geometry_coords[:-1]]
+
+
+def get_street_name_key(attrs):
+    """
+    Hashable street name of an edge, osmnx sometimes returns 'name' as a LIST of names
+    """
+    name = attrs.get('name', "Unknown")
+    return tuple(name) if type(name) == type([]) else name
+
+
+def extract_turn_geometry(edges_attributes, u_latlons, v_latlons, street_name_ids):
+    """
+    edges_attributes: list with the attributes dict of each edge
+    u_latlons, v_latlons: arrays of shape (n, 2) with the coordinates of the start and end node of each edge
+    street_name_ids: dict of street name (see `get_street_name_key`) -> id, the new names are added to it
+
+    Meant to run once when the graph is loaded (and for the edges added on each route request).
+    Returns a table (numpy structured array of `TURN_GEOMETRY_DTYPE`) with the turn geometry of each edge, in the given order.
+    The bearings of all the edges are computed in a single vectorized call.
+    """
+    u_latlons = np.asarray(u_latlons, dtype=np.float64).reshape(-1, 2)
+    v_latlons = np.asarray(v_latlons, dtype=np.float64).reshape(-1, 2)
+    first_points = np.empty((len(edges_attributes), 2), dtype=np.float64)
+    second_points = v_latlons.copy() # the bearing needs at least 2 points, so the end node is used for the straight edges
+    last_points = np.empty((len(edges_attributes), 2), dtype=np.float64)
+    table = np.empty(len(edges_attributes), dtype=TURN_GEOMETRY_DTYPE)
+    for i, attrs in enumerate(edges_attributes):
+        edge_points = get_edge_points(attrs, u_latlons[i].tolist())
+        first_points[i] = edge_points[0]
+        last_points[i] = edge_points[-1]
+        if len(edge_points) > 1: second_points[i] = edge_points[1]
+        street_name = get_street_name_key(attrs)
+        if street_name not in street_name_ids: street_name_ids[street_name] = len(street_name_ids)
+        table['name_id'][i] = street_name_ids[street_name]
+
+    table['first_bearing'] = ox.bearing.calculate_bearing(
+        first_points[:, 0], first_points[:, 1], second_points[:, 0], second_points[:, 1]
+    )
+    table['back_bearing'] = ox.bearing.calculate_bearing(
+        v_latlons[:, 0], v_latlons[:, 1], last_points[:, 0], last_points[:, 1]
+    )
+    return table
+
+
+def classify_turns(turn_geometry):
+    """
+    turn_geometry: `TURN_GEOMETRY_DTYPE` rows of the consecutive edges of a path
+
+    Returns the indexes of the edges where the street name changes, and the ending action
+    of the direction that ends right before each of them (same angles as `graph_utils.generate_route_directions`)
+    """
+    changes = np.flatnonzero(turn_geometry['name_id'][1:] != turn_geometry['name_id'][:-1]) + 1
+    angles = (turn_geometry['first_bearing'][changes] - turn_geometry['back_bearing'][changes - 1] + 360) % 360
+    ending_actions = np.select(
+        [(160 <= angles) & (angles <= 200), (0 <= angles) & (angles < 160), (200 < angles) & (angles < 360)],
+        ['go_straight', 'turn_left', 'turn_right'],
+        default='go_straight',
+    )
+    return changes.tolist(), ending_actions.tolist()